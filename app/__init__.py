@@ -1,11 +1,10 @@
 import asyncio
-import concurrent.futures
 
 import aiohttp.web
-import docker
-import sqlalchemy as sa
 
-from . import controllers, helper, models
+from . import (compression, controllers, db, helper, log_store, log_writer,
+               metrics, models, profiling, quota, sandbox, search, snapshot,
+               storage, ticket_cache)
 
 config = helper.config
 logger = helper.logger
@@ -24,8 +23,18 @@ class Webserver(object):
         self._loop.run_until_complete(self._prepare())
 
     async def _prepare(self):
+        middlewares = [metrics.metrics_middleware]
+        if config.QUOTA_LIMITS:
+            middlewares.append(quota.quota_middleware)
+        if config.PROFILING_ENABLED:
+            middlewares.append(profiling.profiling_middleware)
+        if config.COMPRESSION_ENABLED:
+            middlewares.append(compression.compression_middleware)
+        middlewares.append(db.db_session_middleware)
+
         app = self.app = aiohttp.web.Application(
-            client_max_size=100 * 1024 ** 2
+            client_max_size=100 * 1024 ** 2,
+            middlewares=middlewares
         )
 
         app.on_startup.append(self.startup)
@@ -44,20 +53,131 @@ class Webserver(object):
             logger.exception('Failed to run webserver.')
 
     async def startup(self, app):
-        engine = sa.create_engine(config.DB_URI)
+        app['metrics_worker'] = metrics.MetricsWorker(config.METRICS_DIR,
+                                                      config.METRICS_FLUSH_INTERVAL)
+        app['metrics_worker'].start()
+
+        app['storage_stats'] = storage.StorageStats()
+
+        engine = storage.create_engine(config.DB_URI,
+                                       config.DB_SQLITE_PROFILE,
+                                       app['storage_stats'])
+        storage.check_profile(engine, config.DB_SQLITE_PROFILE)
         models.Base.metadata.create_all(engine)
 
-        models.Session.configure(bind=engine)
-        app['db'] = models.SessionContext
+        app['is_search_enabled'] = False
+        if config.SEARCH_ENABLED:
+            if search.is_supported(engine):
+                indexed_count = search.create_index(engine)
+                if indexed_count is not None:
+                    logger.info('Built search index of %d elicasts', indexed_count)
+                app['is_search_enabled'] = True
+            else:
+                logger.warn('SQLite FTS5 is not available, search is disabled')
+
+        app['db'] = db.Database(engine,
+                                max_workers=config.DB_POOL_SIZE,
+                                slow_call_threshold=config.DB_SLOW_CALL_THRESHOLD)
+        app['db'].watch()
+        app['readonly_db_engine'] = storage.create_readonly_engine(config.DB_URI,
+                                                                   config.DB_SQLITE_PROFILE)
+
+        app['storage_maintenance'] = storage.StorageMaintenance(
+            engine,
+            app['db'],
+            app['storage_stats'],
+            interval=config.DB_SQLITE_MAINTENANCE_INTERVAL,
+            vacuum_pages=config.DB_SQLITE_INCREMENTAL_VACUUM_PAGES
+        )
+        app['storage_maintenance'].start()
+
+        app['executor'] = profiling.ProfiledThreadPoolExecutor(200, kind='executor')
+        metrics.watch_executor_queue('default', app['executor'])
 
-        app['docker'] = docker.DockerClient(base_url=config.DOCKER_URI)
+        app['sandbox'] = sandbox.create_backend(config.RUN_CODE_BACKEND,
+                                                app['executor'])
+        await app['sandbox'].start()
 
-        app['executor'] = concurrent.futures.ThreadPoolExecutor(200)
+        app['log_store'] = log_store.LogPartitionStore(
+            config.LOG_PARTITION_DIR,
+            config.LOG_PARTITION_PERIOD,
+            config.DB_SQLITE_PROFILE,
+            config.DB_URI,
+            seal_delay=config.LOG_PARTITION_SEAL_DELAY
+        )
+        app['log_store'].start(app['db'])
+
+        app['log_writer'] = log_writer.LogWriter(
+            app['db'],
+            app['log_store'],
+            max_batch=config.LOG_BUFFER_MAX_BATCH,
+            flush_interval=config.LOG_BUFFER_FLUSH_INTERVAL,
+            max_pending=config.LOG_BUFFER_MAX_PENDING
+        )
+        app['log_writer'].start()
+
+        app['ticket_cache'] = ticket_cache.TicketCache(
+            max_size=config.LOG_TICKET_CACHE_SIZE,
+            negative_max_size=config.LOG_TICKET_CACHE_NEGATIVE_SIZE,
+            negative_ttl=config.LOG_TICKET_CACHE_NEGATIVE_TTL
+        )
+
+        if config.QUOTA_LIMITS:
+            app['quota_store'] = quota.QuotaStore(config.QUOTA_DB_PATH,
+                                                  config.QUOTA_LIMITS,
+                                                  lease_ttl=config.QUOTA_LEASE_TTL,
+                                                  retention=config.QUOTA_RETENTION)
+
+        app['snapshot'] = None
+        if config.SNAPSHOT_PATH is not None:
+            if not config.IS_EDIT_BLOCKED:
+                raise ValueError('SNAPSHOT_PATH needs IS_EDIT_BLOCKED, or edits would not be served')
+            app['snapshot'] = snapshot.Snapshot(config.SNAPSHOT_PATH)
+            logger.info('Serving %d elicasts from snapshot %s',
+                        app['snapshot'].elicast_count(), config.SNAPSHOT_PATH)
+
+        if config.PROFILING_ENABLED:
+            app['profile_store'] = profiling.ProfileStore(
+                config.PROFILING_DIR,
+                max_files=config.PROFILING_MAX_FILES,
+                slow_threshold=config.PROFILING_SLOW_THRESHOLD,
+                sample_rate=config.PROFILING_SAMPLE_RATE,
+                executor=app['executor']
+            )
+
+        app['compressor'] = None
+        if config.COMPRESSION_ENABLED:
+            app['compressor'] = compression.Compressor(config.COMPRESSION_ENCODINGS,
+                                                       min_size=config.COMPRESSION_MIN_SIZE,
+                                                       cache_size=config.COMPRESSION_CACHE_SIZE,
+                                                       executor=app['executor'])
+            logger.info('Response compression: %s', ', '.join(app['compressor'].encodings))
 
     async def cleanup(self, app):
-        models.Session.remove()
+        await app['log_writer'].stop()
+
+        await app['log_store'].stop()
+
+        app['sandbox'].close()
+
+        if config.QUOTA_LIMITS:
+            app['quota_store'].close()
+
+        if app['snapshot'] is not None:
+            app['snapshot'].close()
+
+        await app['storage_maintenance'].stop()
+
+        app['db'].close()
+
+        await app['metrics_worker'].stop()
 
     async def response_prepare(self, request, response):
         response.headers['Access-Control-Allow-Origin'] = '*'
         response.headers['Access-Control-Allow-Methods'] = 'POST, GET, OPTIONS, PUT, DELETE'
-        response.headers['Access-Control-Allow-Headers'] = 'Content-Type'
+        response.headers['Access-Control-Allow-Headers'] = ', '.join([
+            'Content-Type',
+            profiling.PROFILE_HEADER,
+            quota.TICKET_HEADER,
+        ])
+        response.headers['Access-Control-Expose-Headers'] = profiling.PROFILE_ID_HEADER
@@ -0,0 +1,277 @@
+import asyncio
+import collections
+import threading
+import time
+import zlib
+
+from aiohttp import web
+
+from app import metrics
+
+try:
+    import brotli
+    BROTLI_AVAILABLE = True
+except ImportError:
+    BROTLI_AVAILABLE = False
+
+try:
+    import zstandard
+    ZSTD_AVAILABLE = True
+except ImportError:
+    ZSTD_AVAILABLE = False
+
+# Levels of bodies compressed on every request, and of bodies compressed
+# once and cached
+LEVELS = {'gzip': 6, 'br': 4, 'zstd': 3}
+CACHED_LEVELS = {'gzip': 9, 'br': 9, 'zstd': 12}
+
+# Smaller bodies are compressed on the event loop, as handing them to the
+# executor costs more than compressing them
+_EXECUTOR_MIN_SIZE = 32 * 1024
+
+_COMPRESSIBLE_CONTENT_TYPES = ('application/json', 'application/javascript', 'text/')
+
+COMPRESSION_BYTES = metrics.Counter('elicast_compression_bytes',
+                                    'Bytes of response bodies before and after compression',
+                                    ['encoding', 'kind'])
+COMPRESSION_DURATION = metrics.Histogram('elicast_compression_duration_seconds',
+                                         'Time of compressing response bodies',
+                                         ['encoding'])
+COMPRESSION_CACHE = metrics.Counter('elicast_compression_cache',
+                                    'Lookups of compressed immutable bodies',
+                                    ['result'])
+
+
+def _gzip(data, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _brotli(data, level):
+    return brotli.compress(bytes(data), quality=level)
+
+
+def _zstd(data, level):
+    return zstandard.ZstdCompressor(level=level).compress(data)
+
+
+_COMPRESSORS = {'gzip': _gzip}
+if BROTLI_AVAILABLE:
+    _COMPRESSORS['br'] = _brotli
+if ZSTD_AVAILABLE:
+    _COMPRESSORS['zstd'] = _zstd
+
+
+def available_encodings(encodings):
+    return [encoding for encoding in encodings if encoding in _COMPRESSORS]
+
+
+def compress(data, encoding, level):
+    started_at = time.perf_counter()
+    compressed = _COMPRESSORS[encoding](data, level)
+    COMPRESSION_DURATION.labels(encoding).observe(time.perf_counter() - started_at)
+    COMPRESSION_BYTES.labels(encoding, 'original').inc(len(data))
+    COMPRESSION_BYTES.labels(encoding, 'compressed').inc(len(compressed))
+    return compressed
+
+
+def _parse_accept_encoding(header):
+    # Returns {encoding: q}
+    qualities = {}
+    for item in header.split(','):
+        params = item.strip().split(';')
+        encoding = params[0].strip().lower()
+        if not encoding:
+            continue
+
+        q = 1.0
+        for param in params[1:]:
+            name, _, value = param.strip().partition('=')
+            if name.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qualities[encoding] = q
+    return qualities
+
+
+class _Cache:
+    # LRU of compressed bodies, bounded by their total size
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        if len(value) > self.max_size:
+            return
+        with self._lock:
+            old_value = self._items.pop(key, None)
+            if old_value is not None:
+                self.size -= len(old_value)
+
+            self._items[key] = value
+            self.size += len(value)
+
+            while self.size > self.max_size:
+                _, evicted = self._items.popitem(last=False)
+                self.size -= len(evicted)
+
+    def __len__(self):
+        return len(self._items)
+
+
+class Compressor:
+    # Compresses response bodies with the best encoding accepted by the
+    # client, in the server's order of `encodings` on ties. Bodies of
+    # immutable resources are compressed once per (ETag, encoding) and kept in
+    # a per-worker cache of `cache_size` bytes; concurrent requests of one
+    # uncached body wait for the same compression.
+
+    def __init__(self, encodings, min_size, cache_size, executor):
+        self.encodings = available_encodings(encodings)
+        self.min_size = min_size
+        self.executor = executor
+
+        self._cache = _Cache(cache_size)
+        self._pending = {}
+
+    def negotiate(self, accept_encoding):
+        # Returns the encoding, or None to send the body as is
+        if not accept_encoding:
+            return None
+
+        qualities = _parse_accept_encoding(accept_encoding)
+        default_q = qualities.get('*', 0.0)
+
+        best_encoding = None
+        best_q = 0.0
+        for encoding in self.encodings:
+            q = qualities.get(encoding, default_q)
+            if q > best_q:
+                best_encoding = encoding
+                best_q = q
+        return best_encoding
+
+    async def compress(self, data, encoding, etag=None):
+        if etag is None:
+            return await self._compress(data, encoding, LEVELS[encoding])
+
+        key = (etag, encoding)
+        compressed = self._cache.get(key)
+        if compressed is not None:
+            COMPRESSION_CACHE.labels('hit').inc()
+            return compressed
+        COMPRESSION_CACHE.labels('miss').inc()
+
+        future = self._pending.get(key)
+        if future is None:
+            future = self._pending[key] = asyncio.ensure_future(self._compress_to_cache(key, data, encoding))
+        # cached even if the requests waiting for it are cancelled
+        return await asyncio.shield(future)
+
+    async def _compress_to_cache(self, key, data, encoding):
+        try:
+            compressed = await self._compress(data, encoding, CACHED_LEVELS[encoding])
+            self._cache.put(key, compressed)
+            return compressed
+        finally:
+            del self._pending[key]
+
+    async def _compress(self, data, encoding, level):
+        if len(data) < _EXECUTOR_MIN_SIZE:
+            return compress(data, encoding, level)
+
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, compress, data, encoding, level)
+
+    def stats(self):
+        return {
+            'encodings': self.encodings,
+            'cache_items': len(self._cache),
+            'cache_size': self._cache.size,
+            'cache_max_size': self._cache.max_size,
+        }
+
+
+def _is_not_modified(request, etag):
+    if_none_match = request.headers.get('If-None-Match')
+    if not if_none_match:
+        return False
+    return if_none_match.strip() == '*' or etag in [tag.strip() for tag in if_none_match.split(',')]
+
+
+def _encoded_etag(etag, encoding):
+    # Every encoding of a body is a representation of its own, with its own
+    # strong ETag
+    return '%s-%s"' % (etag[:-1], encoding)
+
+
+async def respond(request, body, content_type, etag=None):
+    # Response of `body`, compressed if the client accepts it. `etag` is given
+    # for immutable bodies only: it answers If-None-Match with 304, and the
+    # compressed body is cached under it.
+    headers = {}
+
+    compressor = request.app['compressor']
+    encoding = None
+    if compressor is not None and len(body) >= compressor.min_size:
+        headers['Vary'] = 'Accept-Encoding'
+        encoding = compressor.negotiate(request.headers.get('Accept-Encoding'))
+
+    if etag is not None:
+        if encoding is not None:
+            etag = _encoded_etag(etag, encoding)
+        headers['ETag'] = etag
+        if _is_not_modified(request, etag):
+            return web.Response(status=304, headers=headers)
+
+    if encoding is None:
+        return web.Response(body=body, content_type=content_type, headers=headers)
+
+    headers['Content-Encoding'] = encoding
+    return web.Response(body=await compressor.compress(body, encoding, etag),
+                        content_type=content_type,
+                        headers=headers)
+
+
+def _is_compressible(response):
+    if type(response) is not web.Response or response.status != 200:
+        return False
+    if 'Content-Encoding' in response.headers:
+        return False
+    if not isinstance(response.body, (bytes, bytearray)):
+        return False  # e.g. a slice of the snapshot, which is sent as is
+    return response.content_type.startswith(_COMPRESSIBLE_CONTENT_TYPES)
+
+
+@web.middleware
+async def compression_middleware(request, handler):
+    # Compresses other responses with large bodies (e.g. from json_response),
+    # which are not cached
+    response = await handler(request)
+
+    compressor = request.app['compressor']
+    if not _is_compressible(response) or len(response.body) < compressor.min_size:
+        return response
+
+    response.headers['Vary'] = 'Accept-Encoding'
+
+    encoding = compressor.negotiate(request.headers.get('Accept-Encoding'))
+    if encoding is None:
+        return response
+
+    response.body = await compressor.compress(response.body, encoding)
+    response.headers['Content-Encoding'] = encoding
+    return response
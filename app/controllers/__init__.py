@@ -1,6 +1,6 @@
 import importlib
 
-_CONTROLLER_MODULE_NAMES = ['audio', 'code', 'elicast', 'log']
+_CONTROLLER_MODULE_NAMES = ['audio', 'code', 'elicast', 'export', 'log', 'metrics', 'profile', 'quota', 'stats']
 
 AVAILABLE_CONTROLLERS = []
 for module_name in _CONTROLLER_MODULE_NAMES:
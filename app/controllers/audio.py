@@ -12,6 +12,7 @@ from aiohttp import web
 
 from app import models as m
 from app import helper
+from app import metrics, profiling
 from app.utils.aiohttp_controller import Controller
 
 config = helper.config
@@ -22,20 +23,25 @@ FFMPEG_ENCODE_TIMEOUT = 60
 
 controller = Controller('audio')
 
+FFMPEG_DURATION = metrics.Histogram('elicast_ffmpeg_duration_seconds',
+                                    'Duration of ffmpeg runs',
+                                    ['operation'])
+
 
 def _any_audio_to_webm(source_f, target_f):
-    ffmpeg_run = subprocess.run(
-        [
-            '/usr/bin/ffmpeg',
-            '-i', source_f.name,  # input filename
-            '-acodec', 'copy',  # avoid re-encoding
-            '-y',  # overwrite file
-            target_f.name  # output filename
-        ],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
-        timeout=FFMPEG_ENCODE_TIMEOUT
-    )
+    with FFMPEG_DURATION.labels('convert').time(), profiling.span('subprocess', 'ffmpeg_convert'):
+        ffmpeg_run = subprocess.run(
+            [
+                config.FFMPEG_PATH,
+                '-i', source_f.name,  # input filename
+                '-acodec', 'copy',  # avoid re-encoding
+                '-y',  # overwrite file
+                target_f.name  # output filename
+            ],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            timeout=FFMPEG_ENCODE_TIMEOUT
+        )
 
     if ffmpeg_run.returncode != 0:
         logger.warn(ffmpeg_run.stdout.decode('utf-8'))
@@ -71,22 +77,23 @@ def _split_audio(source_data_list, segments):
         for start_ts, end_ts in segments:
             with tempfile.NamedTemporaryFile(suffix='.webm') as output_f:
                 try:
-                    ffmpeg_run = subprocess.run(
-                        [
-                            '/usr/bin/ffmpeg',
-                            '-f', 'concat',
-                            '-safe', '0',  # for concat on absolute path
-                            '-i', fielist_f.name,  # input filename
-                            '-ss', str(start_ts / 1000),  # audio start position
-                            '-t', str((end_ts - start_ts) / 1000),  # audio length
-                            '-acodec', 'copy',  # avoid re-encoding (seeking on iframe -> not accurate)
-                            '-y',  # overwrite file
-                            output_f.name  # output filename
-                        ],
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.STDOUT,
-                        timeout=FFMPEG_ENCODE_TIMEOUT
-                    )
+                    with FFMPEG_DURATION.labels('split').time(), profiling.span('subprocess', 'ffmpeg_split'):
+                        ffmpeg_run = subprocess.run(
+                            [
+                                config.FFMPEG_PATH,
+                                '-f', 'concat',
+                                '-safe', '0',  # for concat on absolute path
+                                '-i', fielist_f.name,  # input filename
+                                '-ss', str(start_ts / 1000),  # audio start position
+                                '-t', str((end_ts - start_ts) / 1000),  # audio length
+                                '-acodec', 'copy',  # avoid re-encoding (seeking on iframe -> not accurate)
+                                '-y',  # overwrite file
+                                output_f.name  # output filename
+                            ],
+                            stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT,
+                            timeout=FFMPEG_ENCODE_TIMEOUT
+                        )
                 except Exception:
                     logger.exception('Failed to call ffmpeg')
                     break
@@ -126,6 +133,84 @@ def _build_audio_pack(tf, voice_blobs):
             _add_to_tarfile(tf, '%d.webm' % idx, source_f.read())
 
 
+def _decode_voice_blobs(voice_blobs_str):
+    audio_bin_list = []
+    for voice_blob in json.loads(voice_blobs_str):
+        mtype, audio_data_base64 = voice_blob.split(',')
+        audio_bin_list.append(base64.b64decode(audio_data_base64))
+    return audio_bin_list
+
+
+def _build_audio_tar(voice_blobs_str):
+    with tempfile.NamedTemporaryFile(suffix='.tar') as output_f:
+        with tarfile.open(output_f.name, 'w') as tf:
+            _build_audio_pack(tf, _decode_voice_blobs(voice_blobs_str))
+
+        return output_f.read()
+
+
+def _convert_voice_file(voice_file, suffix):
+    # Returns the converted audio as a data-URI-format string
+    with tempfile.NamedTemporaryFile(suffix=suffix) as source_f:
+        source_f.write(voice_file.read())
+        source_f.flush()
+        with tempfile.NamedTemporaryFile(suffix='.webm') as target_f:
+            _any_audio_to_webm(source_f, target_f)
+
+            return WEBM_BASE64_HEADER + ',' + \
+                base64.b64encode(target_f.read()).decode('utf-8')
+
+
+def _get_voice_blobs(session, elicast_id):
+    elicast = session \
+        .query(m.Elicast.voice_blobs) \
+        .filter(
+            (m.Elicast.id == elicast_id) &
+            ~m.Elicast.is_deleted
+        ) \
+        .first()
+
+    if elicast is None:
+        return None
+
+    return elicast.voice_blobs
+
+
+def _count_voice_blobs(session, elicast_id):
+    voice_blobs_str = _get_voice_blobs(session, elicast_id)
+
+    if voice_blobs_str is None:
+        return None
+
+    return len(json.loads(voice_blobs_str))
+
+
+def _replace_voice_blob(session, elicast_id, chunk_idx, voice_blob):
+    # Returns False if the elicast or the chunk does not exist anymore
+    elicast = session \
+        .query(m.Elicast) \
+        .filter(
+            (m.Elicast.id == elicast_id) &
+            ~m.Elicast.is_deleted
+        ) \
+        .first()
+
+    if elicast is None:
+        return False
+
+    voice_blobs = json.loads(elicast.voice_blobs)
+
+    if not (0 <= chunk_idx < len(voice_blobs)):
+        return False
+
+    voice_blobs[chunk_idx] = voice_blob
+
+    elicast.voice_blobs = json.dumps(voice_blobs)
+    session.add(elicast)
+
+    return True
+
+
 @controller.route('/audio/split', 'POST')
 async def audio_split(request):
     if config.IS_EDIT_BLOCKED:
@@ -192,39 +277,22 @@ async def audio_download(request):
 
     elicast_id = request.match_info['elicast_id']
 
-    with request.app['db']() as session:
-        elicast = session \
-            .query(m.Elicast) \
-            .filter(
-                (m.Elicast.id == elicast_id) &
-                ~m.Elicast.is_deleted
-            ) \
-            .first()
+    voice_blobs_str = await request['db'].run(_get_voice_blobs, elicast_id)
 
-        if elicast is None:
-            return web.HTTPNotFound(text='elicast -- Not exist')
+    if voice_blobs_str is None:
+        return web.HTTPNotFound(text='elicast -- Not exist')
 
-        voice_blobs = json.loads(elicast.voice_blobs)
-
-        audio_bin_list = []
-        for voice_blob in voice_blobs:
-            mtype, audio_data_base64 = voice_blob.split(',')
-            audio_bin_list.append(base64.b64decode(audio_data_base64))
-
-        with tempfile.NamedTemporaryFile(suffix='.tar') as output_f:
-            with tarfile.open(output_f.name, 'w') as tf:
-                loop = asyncio.get_event_loop()
-                await loop.run_in_executor(request.app['executor'],
-                                           _build_audio_pack,
-                                           tf,
-                                           audio_bin_list)
-
-            return web.Response(
-                body=output_f.read(),
-                headers={
-                    'Content-Disposition': 'attachment; filename="%s"' % ('voice_%d.tar' % elicast.id)
-                }
-            )
+    loop = asyncio.get_event_loop()
+    audio_pack = await loop.run_in_executor(request.app['executor'],
+                                            _build_audio_tar,
+                                            voice_blobs_str)
+
+    return web.Response(
+        body=audio_pack,
+        headers={
+            'Content-Disposition': 'attachment; filename="%s"' % ('voice_%s.tar' % elicast_id)
+        }
+    )
 
 
 @controller.route('/audio/replace/{elicast_id:[1-9]+\d*}', 'POST')
@@ -245,37 +313,21 @@ async def audio_replace(request):
     if not isinstance(voice_file, aiohttp.web.FileField):
         return web.HTTPNotFound(text='voice_file -- Shoule be a file')
 
-    with request.app['db']() as session:
-        elicast = session \
-            .query(m.Elicast) \
-            .filter(
-                (m.Elicast.id == elicast_id) &
-                ~m.Elicast.is_deleted
-            ) \
-            .first()
-
-        if elicast is None:
-            return web.HTTPNotFound(text='elicast -- Not exist')
+    voice_blob_count = await request['db'].run(_count_voice_blobs, elicast_id)
 
-        voice_blobs = json.loads(elicast.voice_blobs)
+    if voice_blob_count is None:
+        return web.HTTPNotFound(text='elicast -- Not exist')
 
-        if not (0 <= chunk_idx < len(voice_blobs)):
-            return web.HTTPNotFound(text='chunk_idx -- Invalid chunk index')
+    if not (0 <= chunk_idx < voice_blob_count):
+        return web.HTTPNotFound(text='chunk_idx -- Invalid chunk index')
 
-        with tempfile.NamedTemporaryFile(suffix=os.path.splitext(voice_file.filename)[1]) as source_f:
-            source_f.write(voice_file.file.read())
-            source_f.flush()
-            with tempfile.NamedTemporaryFile(suffix='.webm') as target_f:
-                loop = asyncio.get_event_loop()
-                await loop.run_in_executor(request.app['executor'],
-                                           _any_audio_to_webm,
-                                           source_f,
-                                           target_f)
-
-                voice_blobs[chunk_idx] = WEBM_BASE64_HEADER + ',' + \
-                    base64.b64encode(target_f.read()).decode('utf-8')
+    loop = asyncio.get_event_loop()
+    voice_blob = await loop.run_in_executor(request.app['executor'],
+                                            _convert_voice_file,
+                                            voice_file.file,
+                                            os.path.splitext(voice_file.filename)[1])
 
-                elicast.voice_blobs = json.dumps(voice_blobs)
-                session.add(elicast)
+    if not await request['db'].run(_replace_voice_blob, elicast_id, chunk_idx, voice_blob):
+        return web.HTTPNotFound(text='elicast -- Not exist')
 
-        return web.json_response({})
+    return web.json_response({})
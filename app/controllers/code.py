@@ -1,75 +1,71 @@
-import asyncio
 import json
-import tempfile
 
 from aiohttp import web
 
 from app import models as m
-from app import helper
+from app import exercise_stats, helper
+from app.sandbox import SandboxUnavailable
+from app.ticket_cache import resolve_ticket
 from app.utils.aiohttp_controller import Controller
 
 logger = helper.logger
 
-RUN_CODE_MAX_OUTPUT = 1 * 1024 * 1024  # 1 MB
-RUN_CODE_MAX_TTL = 5 * 60  # 5 min
-RUN_CODE_MAX_MEMORY = 256 * 1024 * 1024  # 256 MB
-
 controller = Controller('code')
 
 
 async def _run_code(app, code):
-    container_output = ''
-    container_exit_code = -1
-
-    with tempfile.NamedTemporaryFile() as codefile:
-        codefile.write(code.encode('utf-8'))
-        codefile.flush()
-
-        container = app['docker'].containers.run(
-            'python:3.6',
-            'python -u /codefile.py',
-            detach=True,
-            log_config={
-                'type': 'json-file',
-                'config': {
-                    'max-size': str(RUN_CODE_MAX_OUTPUT)
-                }
-            },
-            mem_limit=RUN_CODE_MAX_MEMORY,
-            network='none',
-            stdout=True,
-            stderr=True,
-            volumes={
-                codefile.name: {
-                    'bind': '/codefile.py',
-                    'mode': 'ro'
-                }
-            }
-        )
-
-        try:
-            loop = asyncio.get_event_loop()
-
-            try:
-                is_timeout = False
-                container_exit_code = (await asyncio.wait_for(
-                    loop.run_in_executor(app['executor'], container.wait),
-                    timeout=RUN_CODE_MAX_TTL
-                ))['StatusCode']
-            except asyncio.TimeoutError:
-                logger.warn('Code run TIMEOUT')
-                is_timeout = True
-                container_exit_code = -1
-
-            container_output = container.logs().decode('utf-8', 'replace')
-
-            if is_timeout:
-                container_output += '\n<TIMEOUT>'
-
-        finally:
-            container.remove(force=True)
-
-    return container_output, container_exit_code
+    # Returns (output, exit_code), or None if there is nowhere to run the code
+    try:
+        return await app['sandbox'].run(code)
+    except SandboxUnavailable as e:
+        logger.warn('Sandbox unavailable: %s', e)
+        return None
+
+
+def _save_code_run(session, code, output, exit_code):
+    code_run = m.CodeRun(
+        code=code,
+        output=output,
+        exit_code=exit_code
+    )
+
+    session.add(code_run)
+
+    session.flush()
+
+    return code_run.id
+
+
+def _is_elicast_exist(session, elicast_id):
+    return session \
+        .query(m.Elicast.id) \
+        .filter(m.Elicast.id == elicast_id) \
+        .first() is not None
+
+
+def _save_code_run_exercise(session, elicast_id, ex_id, solve_ots, code, output, exit_code, log_ticket_id):
+    # Updates the exercise aggregates in the same transaction
+    code_run_exercise = m.CodeRunExercise(
+        elicast_id=elicast_id,
+        ex_id=ex_id,
+        solve_ots=json.dumps(solve_ots),
+        code=code,
+        output=output,
+        exit_code=exit_code
+    )
+
+    session.add(code_run_exercise)
+
+    session.flush()
+
+    exercise_stats.record_answer(session,
+                                 elicast_id,
+                                 ex_id,
+                                 log_ticket_id,
+                                 exit_code == 0,
+                                 code_run_exercise.created)
+
+    return code_run_exercise.id
 
 
 @controller.route('/code/run', 'POST')
@@ -81,31 +77,28 @@ async def code_run(request):
     except KeyError:
         return web.HTTPBadRequest()
 
-    with request.app['db']() as session:
-        container_output, container_exit_code = await _run_code(request.app, code)
-
-        code_run = m.CodeRun(
-            code=code,
-            output=container_output,
-            exit_code=container_exit_code
-        )
+    result = await _run_code(request.app, code)
+    if result is None:
+        return web.HTTPServiceUnavailable(text='sandbox -- No available host')
+    container_output, container_exit_code = result
 
-        session.add(code_run)
+    code_run_id = await request['db'].run(_save_code_run,
+                                          code,
+                                          container_output,
+                                          container_exit_code)
 
-        session.flush()
-
-        return web.json_response({
-            'code_run': {
-                'id': code_run.id,
-            },
-            'output': container_output,
-            'exit_code': container_exit_code
-        })
+    return web.json_response({
+        'code_run': {
+            'id': code_run_id,
+        },
+        'output': container_output,
+        'exit_code': container_exit_code
+    })
 
 
 @controller.route('/code/answer/{elicast_id:[1-9]+\d*}', 'POST')
 async def code_answer(request):
-    elicast_id = request.match_info['elicast_id']
+    elicast_id = int(request.match_info['elicast_id'])
 
     post_data = await request.post()
 
@@ -116,6 +109,15 @@ async def code_answer(request):
     except KeyError:
         return web.HTTPBadRequest()
 
+    ticket = post_data.get('ticket')
+    if ticket is not None and len(ticket) != 36:
+        return web.HTTPBadRequest(text='ticket -- Invalid string format (36~36)')
+
+    try:
+        ex_id = int(ex_id)
+    except ValueError:
+        return web.HTTPBadRequest(text='ex_id -- Invalid int format')
+
     try:
         solve_ots = json.loads(solve_ots_str)
         if not isinstance(solve_ots, list):
@@ -124,33 +126,31 @@ async def code_answer(request):
     except ValueError:
         return web.HTTPBadRequest(text='solve_ots -- Invliad json format')
 
-    with request.app['db']() as session:
-        elicast = session \
-            .query(m.Elicast) \
-            .filter(m.Elicast.id == elicast_id) \
-            .first()
-
-        if elicast is None:
-            return web.HTTPNotFound(text='elicast -- Not exist')
-
-        container_output, container_exit_code = await _run_code(request.app, code)
-
-        code_run_exercise = m.CodeRunExercise(
-            elicast=elicast,
-            ex_id=ex_id,
-            solve_ots=json.dumps(solve_ots),
-            code=code,
-            output=container_output,
-            exit_code=container_exit_code
-        )
-
-        session.add(code_run_exercise)
-
-        session.flush()
-
-        return web.json_response({
-            'code_run_exercise': {
-                'id': code_run_exercise.id
-            },
-            'exit_code': container_exit_code
-        })
+    if not await request['db'].run(_is_elicast_exist, elicast_id):
+        return web.HTTPNotFound(text='elicast -- Not exist')
+
+    # Answers with an unknown ticket only count in the per-exercise totals
+    log_ticket_id = None
+    if ticket is not None:
+        log_ticket_id = await resolve_ticket(request, ticket)
+
+    result = await _run_code(request.app, code)
+    if result is None:
+        return web.HTTPServiceUnavailable(text='sandbox -- No available host')
+    container_output, container_exit_code = result
+
+    code_run_exercise_id = await request['db'].run(_save_code_run_exercise,
+                                                   elicast_id,
+                                                   ex_id,
+                                                   solve_ots,
+                                                   code,
+                                                   container_output,
+                                                   container_exit_code,
+                                                   log_ticket_id)
+
+    return web.json_response({
+        'code_run_exercise': {
+            'id': code_run_exercise_id
+        },
+        'exit_code': container_exit_code
+    })
@@ -1,9 +1,14 @@
+import asyncio
+import base64
+import hashlib
 import json
 
 from aiohttp import web
 
 from app import models as m
-from app import helper
+from app import compression, exercise_stats, helper, search
+from app.elicast_json import elicast_json_body, elicast_summary
+from app.ticket_cache import resolve_ticket
 from app.utils.aiohttp_controller import Controller
 
 config = helper.config
@@ -13,6 +18,179 @@ WEBM_BASE64_HEADER = 'data:audio/webm;base64'
 controller = Controller('elicast')
 
 
+def _list_elicasts(session, teacher, page, count):
+    elicasts = session \
+        .query(m.Elicast.id,
+               m.Elicast.created,
+               m.Elicast.title,
+               m.Elicast.teacher,
+               m.Elicast.is_protected) \
+        .filter(
+            (m.Elicast.teacher == teacher) &
+            ~m.Elicast.is_deleted
+        ) \
+        .order_by(m.Elicast.created.desc()) \
+        .offset(count * page) \
+        .limit(count)
+
+    return [elicast_summary(elicast) for elicast in elicasts]
+
+
+def _validate_elicast_json(ots_str, voice_blobs_str):
+    # Returns an error message, or None if valid
+    try:
+        ots = json.loads(ots_str)
+        if not isinstance(ots, list):
+            raise ValueError()
+        # TODO : ot validation
+    except ValueError:
+        return 'ots -- Invliad json format'
+
+    try:
+        voice_blobs = json.loads(voice_blobs_str)
+        if not isinstance(voice_blobs, list):
+            raise ValueError()
+
+        for voice_blob in voice_blobs:
+            mtype, voice_data_base64 = voice_blob.split(',')
+            if mtype != WEBM_BASE64_HEADER:
+                return 'voice_blobs -- only support audio/webm'
+    except ValueError:
+        return 'voice_blobs -- Invliad json format'
+
+    return None
+
+
+def _save_elicast(session, elicast_id, title, ots_str, voice_blobs_str, teacher, code):
+    # Returns id of the elicast, or None if the elicast does not exist. `code`
+    # is the final code to index for search, or None if search is disabled.
+    if elicast_id is None:
+        elicast = m.Elicast(
+            title=title,
+            ots=ots_str,
+            voice_blobs=voice_blobs_str,
+            teacher=teacher
+        )
+    else:
+        elicast = session \
+            .query(m.Elicast) \
+            .filter(
+                (m.Elicast.id == elicast_id) &
+                ~m.Elicast.is_deleted &
+                ~m.Elicast.is_protected
+            ) \
+            .first()
+
+        if elicast is None:
+            return None
+
+        elicast.title = title
+        elicast.ots = ots_str
+        elicast.voice_blobs = voice_blobs_str
+        elicast.teacher = teacher
+
+    session.add(elicast)
+
+    session.flush()
+
+    if code is not None:
+        search.index_elicast(session, elicast.id, title, code, teacher, elicast.created, elicast.is_protected)
+
+    return elicast.id
+
+
+def _immutable_etag(elicast, body):
+    # Protected elicasts are rarely changed (only their voice through
+    # /audio/replace, or by hand in the DB), so their compressed bodies are
+    # cached. The ETag is derived from the body, so a change is never hidden.
+    if not elicast.is_protected:
+        return None
+    return '"elicast-%d-%s"' % (elicast.id, hashlib.sha1(body).hexdigest())
+
+
+def _get_elicast_json_body(session, elicast_id):
+    # Returns (body, ETag if the elicast is immutable), or (None, None)
+    elicast = session \
+        .query(m.Elicast) \
+        .filter(
+            (m.Elicast.id == elicast_id) &
+            ~m.Elicast.is_deleted
+        ) \
+        .first()
+
+    if elicast is None:
+        return None, None
+
+    body = elicast_json_body(elicast)
+    return body, _immutable_etag(elicast, body)
+
+
+def _get_voice_chunk(session, elicast_id, chunk_idx):
+    # Returns (is_elicast_exist, raw audio of the chunk or None)
+    elicast = session \
+        .query(m.Elicast.voice_blobs) \
+        .filter(
+            (m.Elicast.id == elicast_id) &
+            ~m.Elicast.is_deleted
+        ) \
+        .first()
+
+    if elicast is None:
+        return False, None
+
+    voice_blobs = json.loads(elicast.voice_blobs)
+
+    if not 0 <= chunk_idx < len(voice_blobs):
+        return True, None
+
+    return True, base64.b64decode(voice_blobs[chunk_idx].split(',', 1)[1])
+
+
+def _delete_elicast(session, elicast_id, is_search_enabled):
+    # Returns False if the elicast does not exist
+    elicast = session \
+        .query(m.Elicast) \
+        .filter(
+            (m.Elicast.id == elicast_id) &
+            ~m.Elicast.is_deleted &
+            ~m.Elicast.is_protected
+        ) \
+        .first()
+
+    if elicast is None:
+        return False
+
+    elicast.is_deleted = True
+    session.add(elicast)
+
+    if is_search_enabled:
+        search.remove_elicast(session, elicast.id)
+
+    return True
+
+
+def _get_exercise_stats(session, elicast_id, log_ticket_id):
+    # Returns None if the elicast does not exist
+    elicast = session \
+        .query(m.Elicast.id) \
+        .filter(
+            (m.Elicast.id == elicast_id) &
+            ~m.Elicast.is_deleted
+        ) \
+        .first()
+
+    if elicast is None:
+        return None
+
+    if log_ticket_id is not None:
+        return exercise_stats.ticket_exercise_stats(session, elicast_id, log_ticket_id)
+    return exercise_stats.exercise_stats(session, elicast_id)
+
+
+def _search_elicasts(session, query, teacher, page, count):
+    return search.search(session, query, teacher, page, count)
+
+
 @controller.route('/elicast', 'GET')
 async def elicast_list(request):
     try:
@@ -33,31 +211,66 @@ async def elicast_list(request):
     if not (teacher is None or (isinstance(teacher, str) and 1 <= len(teacher) <= 64)):
         return web.HTTPBadRequest(text='teacher -- should be null or str format (length 1~64)')
 
-    with request.app['db']() as session:
-        elicasts = session \
-            .query(m.Elicast) \
-            .filter(
-                (m.Elicast.teacher == teacher) &
-                ~m.Elicast.is_deleted
-            ) \
-            .order_by(m.Elicast.created.desc()) \
-            .offset(count * page) \
-            .limit(count)
-
-        elicasts_json = []
-        for elicast in elicasts:
-            elicasts_json.append({
-                'id': elicast.id,
-                'created': elicast.created,
-                'title': elicast.title,
-                'teacher': elicast.teacher,
-                'is_protected': elicast.is_protected
-            })
+    snapshot = request.app['snapshot']
+    if snapshot is not None:
+        chunks = snapshot.list_body(teacher, page, count)
 
+        response = web.StreamResponse()
+        response.content_type = 'application/json'
+        response.charset = 'utf-8'
+        response.content_length = sum(len(chunk) for chunk in chunks)
+        await response.prepare(request)
+        for chunk in chunks:
+            await response.write(chunk)
+        await response.write_eof()
+        return response
+
+    elicasts_json = await request['db'].run(_list_elicasts, teacher, page, count)
+
+    return web.json_response({
+        'elicasts': elicasts_json
+    })
+
+
+@controller.route('/elicast/search', 'GET')
+async def elicast_search(request):
+    if not request.app['is_search_enabled']:
+        return web.HTTPForbidden()
+
+    try:
+        q = request.query['q']
+        page = int(request.query.get('page', 0))
+        count = int(request.query.get('count', 20))
+        teacher = request.query.get('teacher')
+        if not teacher:
+            teacher = None
+    except (KeyError, ValueError):
+        return web.HTTPBadRequest()
+
+    if not 1 <= len(q) <= 256:
+        return web.HTTPBadRequest(text='q -- Invalid str format (length 1~256)')
+
+    if not 0 <= page:
+        return web.HTTPBadRequest(text='page -- Invalid int format (0~)')
+
+    if not 1 <= count <= 100:
+        return web.HTTPBadRequest(text='count -- Invalid int format (1~100)')
+
+    if not (teacher is None or (isinstance(teacher, str) and 1 <= len(teacher) <= 64)):
+        return web.HTTPBadRequest(text='teacher -- should be null or str format (length 1~64)')
+
+    query = search.match_query(q)
+    if query is None:
         return web.json_response({
-            'elicasts': elicasts_json
+            'elicasts': []
         })
 
+    elicasts_json = await request['db'].run(_search_elicasts, query, teacher, page, count)
+
+    return web.json_response({
+        'elicasts': elicasts_json
+    })
+
 
 @controller.route('/elicast', 'PUT')
 async def elicast_put(request):
@@ -93,95 +306,101 @@ async def eliceast_put_or_post(request, elicast_id):
     if not 1 <= len(title) <= 128:
         return web.HTTPBadRequest(text='title -- Invalid str format (length 1~128)')
 
-    try:
-        ots = json.loads(ots_str)
-        if not isinstance(ots, list):
-            raise ValueError()
-        # TODO : ot validation
-    except ValueError:
-        return web.HTTPBadRequest(text='ots -- Invliad json format')
-
-    try:
-        voice_blobs = json.loads(voice_blobs_str)
-        if not isinstance(voice_blobs, list):
-            raise ValueError()
-
-        for voice_blob in voice_blobs:
-            mtype, voice_data_base64 = voice_blob.split(',')
-            if mtype != WEBM_BASE64_HEADER:
-                return web.HTTPBadRequest(text='voice_blobs -- only support audio/webm')
-    except ValueError:
-        return web.HTTPBadRequest(text='voice_blobs -- Invliad json format')
+    loop = asyncio.get_event_loop()
+    error_text = await loop.run_in_executor(request.app['executor'],
+                                            _validate_elicast_json,
+                                            ots_str,
+                                            voice_blobs_str)
+    if error_text is not None:
+        return web.HTTPBadRequest(text=error_text)
 
     if not (teacher is None or (isinstance(teacher, str) and 1 <= len(teacher) <= 64)):
         return web.HTTPBadRequest(text='teacher -- should be null or str format (length 1~64)')
 
-    with request.app['db']() as session:
-        if elicast_id is None:
-            elicast = m.Elicast(
-                title=title,
-                ots=ots_str,
-                voice_blobs=voice_blobs_str,
-                teacher=teacher
-            )
-        else:
-            elicast = session \
-                .query(m.Elicast) \
-                .filter(
-                    (m.Elicast.id == elicast_id) &
-                    ~m.Elicast.is_deleted &
-                    ~m.Elicast.is_protected
-                ) \
-                .first()
-
-            if elicast is None:
-                return web.HTTPNotFound(text='elicast -- Not exist')
-
-            elicast.title = title
-            elicast.ots = ots_str
-            elicast.voice_blobs = voice_blobs_str
-            elicast.teacher = teacher
-
-        session.add(elicast)
-
-        session.flush()
-
-        return web.json_response({
-            'elicast': {
-                'id': elicast.id
-            }
-        })
+    code = None
+    if request.app['is_search_enabled']:
+        # replayed before the write transaction, which should stay short
+        code = await loop.run_in_executor(request.app['executor'],
+                                          search.final_code_of_json,
+                                          ots_str)
+
+    elicast_id = await request['db'].run(_save_elicast,
+                                         elicast_id,
+                                         title,
+                                         ots_str,
+                                         voice_blobs_str,
+                                         teacher,
+                                         code)
+
+    if elicast_id is None:
+        return web.HTTPNotFound(text='elicast -- Not exist')
+
+    return web.json_response({
+        'elicast': {
+            'id': elicast_id
+        }
+    })
 
 
 @controller.route('/elicast/{elicast_id:[1-9]+\d*}', 'GET')
 async def elicast_get(request):
     elicast_id = request.match_info['elicast_id']
 
-    with request.app['db']() as session:
-        elicast = session \
-            .query(m.Elicast) \
-            .filter(
-                (m.Elicast.id == elicast_id) &
-                ~m.Elicast.is_deleted
-            ) \
-            .first()
+    snapshot = request.app['snapshot']
+    if snapshot is not None:
+        body = snapshot.get_body(elicast_id)
+        etag = '"snapshot-%d-%s"' % (snapshot.created, elicast_id)
+    else:
+        body, etag = await request['db'].run(_get_elicast_json_body, elicast_id)
 
-        if elicast is None:
-            return web.HTTPNotFound(text='elicast -- Not exist')
-
-        elicast_json = {
-            'id': elicast.id,
-            'created': elicast.created,
-            'title': elicast.title,
-            'ots': json.loads(elicast.ots),
-            'voice_blobs': json.loads(elicast.voice_blobs),
-            'teacher': elicast.teacher,
-            'is_protected': elicast.is_protected
-        }
+    if body is None:
+        return web.HTTPNotFound(text='elicast -- Not exist')
 
-        return web.json_response({
-            'elicast': elicast_json
-        })
+    return await compression.respond(request, body, 'application/json', etag)
+
+
+@controller.route('/elicast/{elicast_id:[1-9]+\d*}/voice/{chunk_idx:\d+}', 'GET')
+async def elicast_voice_get(request):
+    elicast_id = request.match_info['elicast_id']
+    chunk_idx = int(request.match_info['chunk_idx'])
+
+    snapshot = request.app['snapshot']
+    if snapshot is not None:
+        is_exist, voice_chunk = snapshot.get_voice_chunk(elicast_id, chunk_idx)
+    else:
+        is_exist, voice_chunk = await request['db'].run(_get_voice_chunk, elicast_id, chunk_idx)
+
+    if not is_exist:
+        return web.HTTPNotFound(text='elicast -- Not exist')
+
+    if voice_chunk is None:
+        return web.HTTPNotFound(text='chunk_idx -- Invalid chunk index')
+
+    return web.Response(body=voice_chunk, content_type='audio/webm')
+
+
+@controller.route('/elicast/{elicast_id:[1-9]+\d*}/exercise_stats', 'GET')
+async def elicast_exercise_stats(request):
+    elicast_id = int(request.match_info['elicast_id'])
+
+    log_ticket_id = None
+    ticket = request.query.get('ticket')
+    if ticket is not None:
+        if len(ticket) != 36:
+            return web.HTTPBadRequest(text='ticket -- Invalid string format (36~36)')
+
+        log_ticket_id = await resolve_ticket(request, ticket)
+        if log_ticket_id is None:
+            return web.HTTPNotFound(text='ticket -- Not exist')
+
+    exercises_json = await request['db'].run(_get_exercise_stats, elicast_id, log_ticket_id)
+
+    if exercises_json is None:
+        return web.HTTPNotFound(text='elicast -- Not exist')
+
+    return web.json_response({
+        'exercises': exercises_json
+    })
 
 
 @controller.route('/elicast/{elicast_id:[1-9]+\d*}', 'DELETE')
@@ -191,20 +410,9 @@ async def elicast_delete(request):
 
     elicast_id = request.match_info['elicast_id']
 
-    with request.app['db']() as session:
-        elicast = session \
-            .query(m.Elicast) \
-            .filter(
-                (m.Elicast.id == elicast_id) &
-                ~m.Elicast.is_deleted &
-                ~m.Elicast.is_protected
-            ) \
-            .first()
-
-        if elicast is None:
-            return web.HTTPNotFound(text='elicast -- Not exist')
+    is_deleted = await request['db'].run(_delete_elicast, elicast_id, request.app['is_search_enabled'])
 
-        elicast.is_deleted = True
-        session.add(elicast)
+    if not is_deleted:
+        return web.HTTPNotFound(text='elicast -- Not exist')
 
-        return web.json_response({})
+    return web.json_response({})
@@ -0,0 +1,56 @@
+from aiohttp import web
+
+from app import export, helper
+from app.utils.aiohttp_controller import Controller
+
+config = helper.config
+
+controller = Controller('export')
+
+
+def _next_chunk(table_export, encoder):
+    rows = table_export.fetch_batch()
+    if not rows:
+        return None
+    return encoder.encode(rows)
+
+
+@controller.route('/export/{table:(log_entry|code_run|code_run_exercise)}', 'GET')
+async def export_table(request):
+    if config.IS_EXPORT_BLOCKED:
+        return web.HTTPForbidden()
+
+    table = request.match_info['table']
+
+    try:
+        filters = export.parse_filters(table, request.query)
+        table_export = export.Export(request.app['readonly_db_engine'],
+                                     table,
+                                     filters,
+                                     config.EXPORT_BATCH_SIZE,
+                                     request.app['log_store'])
+        encoder = export.Encoder(table_export.column_names,
+                                 request.query.get('format', 'ndjson'),
+                                 request.query.get('gzip') == '1')
+    except ValueError as e:
+        return web.HTTPBadRequest(text=str(e))
+
+    response = web.StreamResponse(headers={
+        'Content-Type': encoder.content_type,
+        'Content-Disposition': 'attachment; filename="%s"' % encoder.filename(table)
+    })
+    response.enable_chunked_encoding()
+    await response.prepare(request)
+
+    while True:
+        chunk = await request.app['db'].run_sync(_next_chunk, table_export, encoder)
+        if chunk is None:
+            break
+
+        if chunk:
+            await response.write(chunk)
+
+    await response.write(encoder.finish())
+    await response.write_eof()
+
+    return response
@@ -1,4 +1,5 @@
 import json
+import re
 import uuid
 
 from aiohttp import web
@@ -6,17 +7,133 @@ from multidict import istr
 
 from app import models as m
 from app import helper
+from app.log_writer import LogBufferFull
+from app.ticket_cache import resolve_ticket
 from app.utils.aiohttp_controller import Controller
 
+config = helper.config
 logger = helper.logger
 
 RUN_CODE_MAX_OUTPUT = 1 * 1024 * 1024  # 1 MB
 RUN_CODE_MAX_TTL = 5 * 60  # 5 min
 RUN_CODE_MAX_MEMORY = 256 * 1024 * 1024  # 256 MB
 
+NDJSON_CONTENT_TYPE = 'application/x-ndjson'
+
+_JSON_DECODER = json.JSONDecoder()
+_JSON_WHITESPACE = re.compile(r'[ \t\n\r]*')
+
 controller = Controller('log')
 
 
+def _skip_json_element(text, idx):
+    # Index of the ',' or ']' which ends the malformed array element at
+    # `idx`, skipping nested arrays, objects and strings
+    depth = 0
+    is_in_string = False
+    while idx < len(text):
+        c = text[idx]
+        if is_in_string:
+            if c == '\\':
+                idx += 1
+            elif c == '"':
+                is_in_string = False
+        elif c == '"':
+            is_in_string = True
+        elif c in '[{':
+            depth += 1
+        elif c in ']}':
+            if depth == 0:
+                if c == ']':
+                    return idx
+                raise ValueError()
+            depth -= 1
+        elif c == ',' and depth == 0:
+            return idx
+        idx += 1
+
+    raise ValueError()
+
+
+def _iter_json_array(text):
+    # Yield (data, error) per element of a JSON array, with the raw text of
+    # each valid element, parsing one element at a time instead of building
+    # the whole list. A malformed element is reported and skipped; raises
+    # ValueError only if the array itself cannot be delimited.
+    idx = _JSON_WHITESPACE.match(text, 0).end()
+    if text[idx:idx + 1] != '[':
+        raise ValueError()
+
+    idx = _JSON_WHITESPACE.match(text, idx + 1).end()
+    if text[idx:idx + 1] == ']':
+        idx += 1
+    else:
+        while True:
+            try:
+                _, end = _JSON_DECODER.raw_decode(text, idx)
+                delimiter_idx = _JSON_WHITESPACE.match(text, end).end()
+                if text[delimiter_idx:delimiter_idx + 1] not in (',', ']'):
+                    raise ValueError()
+            except ValueError:
+                delimiter_idx = _skip_json_element(text, idx)
+                yield None, 'data -- Invliad json format'
+            else:
+                yield text[idx:end], None
+
+            idx = delimiter_idx
+            if text[idx] == ',':
+                idx = _JSON_WHITESPACE.match(text, idx + 1).end()
+            else:
+                idx += 1
+                break
+
+    if _JSON_WHITESPACE.match(text, idx).end() != len(text):
+        raise ValueError()
+
+
+async def _read_ndjson_events(stream, max_count):
+    # Returns a list of (data, error) per non-empty line. Raises ValueError if
+    # a line is too long to be read or there are more than `max_count` lines.
+    events = []
+    while True:
+        line = await stream.readline()
+        if not line:
+            break
+
+        line = line.strip()
+        if not line:
+            continue
+
+        if len(events) == max_count:
+            raise ValueError('Too many events')
+
+        try:
+            data = line.decode('utf-8')
+            json.loads(data)
+        except ValueError:
+            events.append((None, 'data -- Invliad json format'))
+        else:
+            events.append((data, None))
+
+    return events
+
+
+def _issue_ticket(session, ip, user_agent, referer, name):
+    log_ticket = m.LogTicket(
+        ticket=str(uuid.uuid4()),
+        ip=ip,
+        user_agent=user_agent,
+        referer=referer,
+        name=name
+    )
+
+    session.add(log_ticket)
+
+    session.flush()
+
+    return log_ticket.ticket, log_ticket.id
+
+
 @controller.route('/log/ticket', 'POST')
 async def log_ticket(request):
     user_agent = request.headers.get(istr('USER-AGENT'))
@@ -38,20 +155,17 @@ async def log_ticket(request):
     if not 1 <= len(name) <= 64:
         return web.HTTPBadRequest(text='name -- Invalid string format (1~64)')
 
-    with request.app['db']() as session:
-        log_ticket = m.LogTicket(
-            ticket=str(uuid.uuid4()),
-            ip=request.remote,
-            user_agent=user_agent,
-            referer=referer,
-            name=name
-        )
+    ticket, log_ticket_id = await request['db'].run(_issue_ticket,
+                                                    request.remote,
+                                                    user_agent,
+                                                    referer,
+                                                    name)
 
-        session.add(log_ticket)
+    request.app['ticket_cache'].put(ticket, log_ticket_id)
 
-        return web.json_response({
-            'ticket': log_ticket.ticket
-        })
+    return web.json_response({
+        'ticket': ticket
+    })
 
 
 @controller.route('/log/submit', 'POST')
@@ -72,20 +186,75 @@ async def log_submit(request):
     except ValueError:
         return web.HTTPBadRequest(text='data -- Invliad json format')
 
-    with request.app['db']() as session:
-        log_ticket = session \
-            .query(m.LogTicket) \
-            .filter(m.LogTicket.ticket == ticket) \
-            .first()
+    log_ticket_id = await resolve_ticket(request, ticket)
+    if log_ticket_id is None:
+        return web.HTTPNotFound(text='ticket -- Not exist')
+
+    try:
+        request.app['log_writer'].submit(log_ticket_id, data)
+    except LogBufferFull:
+        return web.HTTPServiceUnavailable(text='log -- Too many pending entries')
+
+    return web.json_response({})
+
+
+@controller.route('/log/stats', 'GET')
+async def log_stats(request):
+    return web.json_response({
+        'ticket_cache': request.app['ticket_cache'].stats(),
+        'log_buffer': request.app['log_writer'].stats()
+    })
+
+
+@controller.route('/log/submit_batch', 'POST')
+async def log_submit_batch(request):
+    max_count = config.LOG_BATCH_MAX_EVENTS
+
+    if request.content_type == NDJSON_CONTENT_TYPE:
+        ticket = request.query.get('ticket')
+
+        try:
+            events = await _read_ndjson_events(request.content, max_count)
+        except ValueError:
+            return web.HTTPBadRequest(text='events -- Too many or too long lines (~%d)' % max_count)
+    else:
+        post_data = await request.post()
+
+        ticket = post_data.get('ticket')
+        events_str = post_data.get('events')
+        if events_str is None:
+            return web.HTTPBadRequest()
+
+        events = []
+        try:
+            for event in _iter_json_array(events_str):
+                if len(events) == max_count:
+                    return web.HTTPBadRequest(text='events -- Too many events (~%d)' % max_count)
+                events.append(event)
+        except ValueError:
+            return web.HTTPBadRequest(text='events -- Invliad json format')
+
+    if ticket is None:
+        return web.HTTPBadRequest()
+
+    if len(ticket) != 36:
+        return web.HTTPBadRequest(text='ticket -- Invalid string format (36~36)')
 
-        if log_ticket is None:
-            return web.HTTPNotFound(text='ticket -- Not exist')
+    log_ticket_id = await resolve_ticket(request, ticket)
+    if log_ticket_id is None:
+        return web.HTTPNotFound(text='ticket -- Not exist')
 
-        log_entry = m.LogEntry(
-            log_ticket=log_ticket,
-            data=data
-        )
+    entries = []
+    results = []
+    for data, error in events:
+        if error is None:
+            entries.append((log_ticket_id, data))
+            results.append({'status': 'ok'})
+        else:
+            results.append({'status': 'error', 'reason': error})
 
-        session.add(log_entry)
+    await request.app['log_writer'].write(entries)
 
-        return web.json_response({})
+    return web.json_response({
+        'results': results
+    })
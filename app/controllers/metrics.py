@@ -0,0 +1,19 @@
+import asyncio
+
+from aiohttp import web
+
+from app import metrics
+from app.utils.aiohttp_controller import Controller
+
+controller = Controller('metrics')
+
+
+@controller.route('/metrics', 'GET')
+async def metrics_get(request):
+    loop = asyncio.get_event_loop()
+    text = await loop.run_in_executor(request.app['executor'],
+                                      request.app['metrics_worker'].render)
+
+    response = web.Response(text=text)
+    response.headers['Content-Type'] = metrics.CONTENT_TYPE
+    return response
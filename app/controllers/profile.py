@@ -0,0 +1,42 @@
+import asyncio
+
+from aiohttp import web
+
+from app import helper
+from app.utils.aiohttp_controller import Controller
+
+config = helper.config
+
+controller = Controller('profile')
+
+
+@controller.route('/profile', 'GET')
+async def profile_list(request):
+    if not config.PROFILING_ENABLED:
+        return web.HTTPForbidden()
+
+    loop = asyncio.get_event_loop()
+    profiles = await loop.run_in_executor(request.app['executor'],
+                                          request.app['profile_store'].list)
+
+    return web.json_response({
+        'profiles': profiles
+    })
+
+
+@controller.route('/profile/{profile_id:[0-9A-Za-z-]+}', 'GET')
+async def profile_get(request):
+    if not config.PROFILING_ENABLED:
+        return web.HTTPForbidden()
+
+    profile_id = request.match_info['profile_id']
+
+    loop = asyncio.get_event_loop()
+    profile_json = await loop.run_in_executor(request.app['executor'],
+                                              request.app['profile_store'].get,
+                                              profile_id)
+
+    if profile_json is None:
+        return web.HTTPNotFound(text='profile -- Not exist')
+
+    return web.Response(text=profile_json, content_type='application/json')
@@ -0,0 +1,25 @@
+from aiohttp import web
+
+from app import helper
+from app.utils.aiohttp_controller import Controller
+
+config = helper.config
+
+controller = Controller('quota')
+
+
+@controller.route('/quota/usage', 'GET')
+async def quota_usage(request):
+    if not config.QUOTA_LIMITS:
+        return web.HTTPForbidden()
+
+    client = request.query.get('client')
+    if not client:
+        client = None
+
+    usage = await request.app['quota_store'].usage(client)
+
+    return web.json_response({
+        'limits': config.QUOTA_LIMITS,
+        'usage': usage
+    })
@@ -0,0 +1,32 @@
+from aiohttp import web
+
+from app.utils.aiohttp_controller import Controller
+
+controller = Controller('stats')
+
+
+@controller.route('/stats/db', 'GET')
+async def stats_db(request):
+    db_stats = request.app['db'].stats()
+    db_stats['storage'] = request.app['storage_stats'].stats()
+
+    return web.json_response(db_stats)
+
+
+@controller.route('/stats/compression', 'GET')
+async def stats_compression(request):
+    compressor = request.app['compressor']
+    if compressor is None:
+        return web.HTTPForbidden()
+
+    return web.json_response(compressor.stats())
+
+
+@controller.route('/stats/sandbox', 'GET')
+async def stats_sandbox(request):
+    sandbox = request.app['sandbox']
+
+    sandbox_stats = sandbox.stats()
+    sandbox_stats['backend'] = sandbox.name
+
+    return web.json_response(sandbox_stats)
@@ -0,0 +1,191 @@
+import asyncio
+import collections
+import concurrent.futures
+import functools
+import threading
+import time
+
+from aiohttp import web
+from sqlalchemy.orm import sessionmaker
+
+from app import helper, metrics, profiling
+
+logger = helper.logger
+
+DB_CALL_DURATION = metrics.Histogram('elicast_db_call_duration_seconds',
+                                     'Time of DB calls waiting for a thread of the DB pool and running there',
+                                     ['name', 'phase'])
+DB_LIVE_SESSIONS = metrics.Gauge('elicast_db_live_sessions',
+                                 'Open sessions of the DB')
+
+
+class Database:
+    # Runs blocking DB work on a dedicated, bounded thread pool so that it
+    # never blocks the event loop. `run(unit_of_work, *args)` calls
+    # `unit_of_work(session, *args)` in a new session which is committed when
+    # it returns and rolled back when it raises. Loaded objects are not
+    # expired on commit, so they can be read on the loop afterwards, but
+    # should not be used to lazy-load relationships there.
+    #
+    # Request handlers use `request['db']` (RequestSession) instead, which
+    # shares one session among the units of work of the request.
+
+    def __init__(self, engine, max_workers, slow_call_threshold):
+        self.engine = engine
+        self.session_factory = sessionmaker(bind=engine, expire_on_commit=False)
+        self.slow_call_threshold = slow_call_threshold
+
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers,
+                                                               thread_name_prefix='db')
+
+        self._live_session_count = 0
+        self._call_stats = collections.defaultdict(lambda: {
+            'count': 0,
+            'error_count': 0,
+            'wait_time': 0.0,
+            'run_time': 0.0,
+            'max_run_time': 0.0,
+        })
+        self._stats_lock = threading.Lock()
+
+    @property
+    def live_session_count(self):
+        return self._live_session_count
+
+    async def run(self, unit_of_work, *args):
+        return await self._submit(unit_of_work.__name__,
+                                  functools.partial(self._run_unit_of_work, None, unit_of_work, args))
+
+    async def run_sync(self, fn, *args):
+        # Run `fn(*args)` on the DB thread pool without a session (e.g. for
+        # work on a connection of another engine)
+        return await self._submit(fn.__name__, functools.partial(fn, *args))
+
+    async def _submit(self, name, fn):
+        loop = asyncio.get_event_loop()
+        with profiling.span('db', name):
+            return await loop.run_in_executor(self._executor,
+                                              self._timed_call,
+                                              name,
+                                              fn,
+                                              time.perf_counter())
+
+    def _timed_call(self, name, fn, submitted_at):
+        started_at = time.perf_counter()
+        is_error = True
+        try:
+            result = fn()
+            is_error = False
+            return result
+        finally:
+            finished_at = time.perf_counter()
+            self._record(name, started_at - submitted_at, finished_at - started_at, is_error)
+
+    def _open_session(self):
+        session = self.session_factory()
+        with self._stats_lock:
+            self._live_session_count += 1
+        return session
+
+    def _close_session(self, session, commit):
+        try:
+            if commit:
+                session.commit()
+            else:
+                session.rollback()
+        finally:
+            session.close()
+            with self._stats_lock:
+                self._live_session_count -= 1
+
+    def _run_unit_of_work(self, request_session, unit_of_work, args):
+        if request_session is None:
+            session = self._open_session()
+        else:
+            if request_session.session is None:
+                request_session.session = self._open_session()
+            session = request_session.session
+
+        try:
+            result = unit_of_work(session, *args)
+            session.commit()
+            return result
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            if request_session is None:
+                self._close_session(session, commit=False)
+
+    def _record(self, name, wait_time, run_time, is_error):
+        with self._stats_lock:
+            stats = self._call_stats[name]
+            stats['count'] += 1
+            stats['wait_time'] += wait_time
+            stats['run_time'] += run_time
+            stats['max_run_time'] = max(stats['max_run_time'], run_time)
+            if is_error:
+                stats['error_count'] += 1
+
+        DB_CALL_DURATION.labels(name, 'wait').observe(wait_time)
+        DB_CALL_DURATION.labels(name, 'run').observe(run_time)
+
+        if run_time + wait_time >= self.slow_call_threshold:
+            logger.warn('Slow DB call %s : %.1f ms (waited %.1f ms in the queue)',
+                        name, run_time * 1000, wait_time * 1000)
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                'live_sessions': self._live_session_count,
+                'calls': {name: dict(stats) for name, stats in self._call_stats.items()},
+            }
+
+    def watch(self):
+        metrics.watch_executor_queue('db', self._executor)
+        DB_LIVE_SESSIONS.set_function(lambda: self._live_session_count)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self.engine.dispose()
+
+
+class RequestSession:
+    # Session of a request, created on the first unit of work and disposed by
+    # `db_session_middleware` when the request is done. Every unit of work is
+    # still committed on its own, so no transaction (and no sqlite lock) is
+    # held while the handler awaits something else.
+
+    def __init__(self, db):
+        self.db = db
+        self.session = None
+
+        self._lock = asyncio.Lock()
+
+    async def run(self, unit_of_work, *args):
+        async with self._lock:
+            return await self.db._submit(unit_of_work.__name__,
+                                         functools.partial(self.db._run_unit_of_work, self, unit_of_work, args))
+
+    async def close(self, commit):
+        async with self._lock:
+            if self.session is None:
+                return
+
+            session = self.session
+            self.session = None
+            await self.db._submit('close_session',
+                                  functools.partial(self.db._close_session, session, commit))
+
+
+@web.middleware
+async def db_session_middleware(request, handler):
+    request_session = request['db'] = RequestSession(request.app['db'])
+
+    is_succeeded = False
+    try:
+        response = await handler(request)
+        is_succeeded = True
+        return response
+    finally:
+        await request_session.close(commit=is_succeeded)
@@ -0,0 +1,26 @@
+import json
+
+
+def elicast_summary(elicast):
+    # An item of the elicast list
+    return {
+        'id': elicast.id,
+        'created': elicast.created,
+        'title': elicast.title,
+        'teacher': elicast.teacher,
+        'is_protected': elicast.is_protected
+    }
+
+
+def elicast_json_body(elicast):
+    # `ots` and `voice_blobs` are stored as validated JSON, so they are spliced
+    # into the response as is instead of being decoded and encoded again
+    meta_json = json.dumps(elicast_summary(elicast))
+
+    return ''.join((
+        '{"elicast": ',
+        meta_json[:-1],
+        ', "ots": ', elicast.ots,
+        ', "voice_blobs": ', elicast.voice_blobs,
+        '}}'
+    )).encode('utf-8')
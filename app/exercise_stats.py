@@ -0,0 +1,167 @@
+import sqlalchemy as sa
+from sqlalchemy.orm import sessionmaker
+
+from app import models as m
+
+_exercise = m.ExerciseStats.__table__
+_ticket = m.ExerciseTicketStats.__table__
+
+
+def record_answer(session, elicast_id, ex_id, log_ticket_id, is_passed, created):
+    # Adds an answer to the aggregates. Called in the unit of work which
+    # inserted the code_run_exercise row, so the transaction already holds
+    # the write lock and the ticket row cannot change between read and update.
+    is_new_learner = False
+    first_pass_attempts = None
+    first_pass_time = None
+
+    if log_ticket_id is not None:
+        ticket_key = (
+            (_ticket.c.elicast_id == elicast_id) &
+            (_ticket.c.ex_id == ex_id) &
+            (_ticket.c.log_ticket_id == log_ticket_id)
+        )
+        ticket_stats = session.execute(
+            sa.select([_ticket.c.attempt_count, _ticket.c.first_attempt, _ticket.c.first_pass])
+            .where(ticket_key)
+        ).first()
+
+        if ticket_stats is None:
+            is_new_learner = True
+            if is_passed:
+                first_pass_attempts = 1
+                first_pass_time = 0
+            session.execute(_ticket.insert().values(
+                elicast_id=elicast_id,
+                ex_id=ex_id,
+                log_ticket_id=log_ticket_id,
+                attempt_count=1,
+                pass_count=int(is_passed),
+                first_attempt=created,
+                last_attempt=created,
+                first_pass=created if is_passed else None,
+                first_pass_attempts=first_pass_attempts
+            ))
+        else:
+            values = {
+                'attempt_count': _ticket.c.attempt_count + 1,
+                'pass_count': _ticket.c.pass_count + int(is_passed),
+                'last_attempt': created,
+            }
+            if is_passed and ticket_stats.first_pass is None:
+                first_pass_attempts = ticket_stats.attempt_count + 1
+                first_pass_time = created - ticket_stats.first_attempt
+                values['first_pass'] = created
+                values['first_pass_attempts'] = first_pass_attempts
+            session.execute(_ticket.update().where(ticket_key).values(**values))
+
+    session.execute(_exercise.insert().prefix_with('OR IGNORE').values(
+        elicast_id=elicast_id,
+        ex_id=ex_id,
+        attempt_count=0,
+        pass_count=0,
+        learner_count=0,
+        passed_learner_count=0,
+        first_pass_attempts_total=0,
+        first_pass_time_total=0
+    ))
+    session.execute(
+        _exercise.update()
+        .where((_exercise.c.elicast_id == elicast_id) & (_exercise.c.ex_id == ex_id))
+        .values(
+            attempt_count=_exercise.c.attempt_count + 1,
+            pass_count=_exercise.c.pass_count + int(is_passed),
+            last_attempt=created,
+            learner_count=_exercise.c.learner_count + int(is_new_learner),
+            passed_learner_count=_exercise.c.passed_learner_count + int(first_pass_attempts is not None),
+            first_pass_attempts_total=_exercise.c.first_pass_attempts_total + (first_pass_attempts or 0),
+            first_pass_time_total=_exercise.c.first_pass_time_total + (first_pass_time or 0)
+        )
+    )
+
+
+def _mean(total, count):
+    return round(total / count, 3) if count else None
+
+
+def exercise_stats(session, elicast_id):
+    # One row per exercise of the elicast, without reading code_run_exercise
+    return [{
+        'ex_id': stats.ex_id,
+        'attempt_count': stats.attempt_count,
+        'pass_count': stats.pass_count,
+        'pass_rate': _mean(stats.pass_count, stats.attempt_count),
+        'last_attempt': stats.last_attempt,
+        'learner_count': stats.learner_count,
+        'passed_learner_count': stats.passed_learner_count,
+        'learner_pass_rate': _mean(stats.passed_learner_count, stats.learner_count),
+        'mean_attempts_to_first_pass': _mean(stats.first_pass_attempts_total, stats.passed_learner_count),
+        'mean_time_to_first_pass': _mean(stats.first_pass_time_total, stats.passed_learner_count),
+    } for stats in session.execute(
+        sa.select([_exercise])
+        .where(_exercise.c.elicast_id == elicast_id)
+        .order_by(_exercise.c.ex_id)
+    )]
+
+
+def ticket_exercise_stats(session, elicast_id, log_ticket_id):
+    return [{
+        'ex_id': stats.ex_id,
+        'attempt_count': stats.attempt_count,
+        'pass_count': stats.pass_count,
+        'first_attempt': stats.first_attempt,
+        'last_attempt': stats.last_attempt,
+        'first_pass': stats.first_pass,
+        'first_pass_attempts': stats.first_pass_attempts,
+    } for stats in session.execute(
+        sa.select([_ticket])
+        .where((_ticket.c.elicast_id == elicast_id) & (_ticket.c.log_ticket_id == log_ticket_id))
+        .order_by(_ticket.c.ex_id)
+    )]
+
+
+_BACKFILL_EXERCISES = '''
+INSERT INTO exercise_stats (elicast_id, ex_id, created, attempt_count, pass_count, last_attempt,
+                            learner_count, passed_learner_count,
+                            first_pass_attempts_total, first_pass_time_total)
+SELECT elicast_id, ex_id, MIN(created), COUNT(*), SUM(exit_code = 0), MAX(created), 0, 0, 0, 0
+FROM code_run_exercise
+GROUP BY elicast_id, ex_id
+'''
+
+_BACKFILL_LEARNERS = '''
+UPDATE exercise_stats SET
+    learner_count = (SELECT COUNT(*) FROM exercise_ticket_stats t
+                     WHERE t.elicast_id = exercise_stats.elicast_id AND t.ex_id = exercise_stats.ex_id),
+    passed_learner_count = (SELECT COUNT(*) FROM exercise_ticket_stats t
+                            WHERE t.elicast_id = exercise_stats.elicast_id AND t.ex_id = exercise_stats.ex_id
+                            AND t.first_pass IS NOT NULL),
+    first_pass_attempts_total = (SELECT COALESCE(SUM(t.first_pass_attempts), 0) FROM exercise_ticket_stats t
+                                 WHERE t.elicast_id = exercise_stats.elicast_id AND t.ex_id = exercise_stats.ex_id),
+    first_pass_time_total = (SELECT COALESCE(SUM(t.first_pass - t.first_attempt), 0) FROM exercise_ticket_stats t
+                             WHERE t.elicast_id = exercise_stats.elicast_id AND t.ex_id = exercise_stats.ex_id
+                             AND t.first_pass IS NOT NULL)
+'''
+
+
+def backfill(engine):
+    # Recomputes exercise_stats from every code_run_exercise row, in one
+    # transaction. Answers were not linked to log tickets before the
+    # aggregates existed, so learner columns come from exercise_ticket_stats
+    # as recorded so far. Returns the number of exercises.
+    m.Base.metadata.create_all(engine, tables=[_exercise, _ticket])
+
+    session = sessionmaker(bind=engine)()
+    try:
+        session.execute(_exercise.delete())
+        session.execute(sa.text(_BACKFILL_EXERCISES))
+        session.execute(sa.text(_BACKFILL_LEARNERS))
+        exercise_count = session.execute(sa.select([sa.func.count()]).select_from(_exercise)).scalar()
+        session.commit()
+    except BaseException:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+    return exercise_count
@@ -0,0 +1,249 @@
+import collections
+import csv
+import io
+import json
+import zlib
+
+import sqlalchemy as sa
+
+from app import models as m
+from app.log_store import TICKET_SCHEMA
+
+FORMATS = {
+    'ndjson': ('application/x-ndjson', 'ndjson'),
+    'csv': ('text/csv', 'csv'),
+}
+
+FILTER_NAMES = ['ticket_name', 'elicast_id', 'ex_id', 'created_from', 'created_to']
+
+MAIN_PARTITION = 'main'
+
+_ATTACHED_LOG_TICKET = m.LogTicket.__table__.tometadata(sa.MetaData(), schema=TICKET_SCHEMA)
+
+_Source = collections.namedtuple('_Source', ['columns', 'from_clause', 'id_column', 'filters'])
+
+
+def _log_entry_source():
+    # Entries written before log partitioning, in the main DB
+    return _Source(
+        columns=[
+            sa.literal(MAIN_PARTITION).label('partition'),
+            m.LogEntry.id,
+            m.LogEntry.created,
+            m.LogEntry.log_ticket_id,
+            m.LogTicket.ticket,
+            m.LogTicket.name.label('ticket_name'),
+            m.LogEntry.data,
+        ],
+        from_clause=m.LogEntry.__table__.join(m.LogTicket.__table__),
+        id_column=m.LogEntry.id,
+        filters={
+            'ticket_name': lambda v: m.LogTicket.name == v,
+            'created_from': lambda v: m.LogEntry.created >= v,
+            'created_to': lambda v: m.LogEntry.created < v,
+        }
+    )
+
+
+def _log_partition_source(name):
+    log_entry = m.PartitionedLogEntry.__table__
+    log_ticket = _ATTACHED_LOG_TICKET
+
+    return _Source(
+        columns=[
+            sa.literal(name).label('partition'),
+            log_entry.c.id,
+            log_entry.c.created,
+            log_entry.c.log_ticket_id,
+            log_ticket.c.ticket,
+            log_ticket.c.name.label('ticket_name'),
+            log_entry.c.data,
+        ],
+        from_clause=log_entry.join(log_ticket, log_entry.c.log_ticket_id == log_ticket.c.id),
+        id_column=log_entry.c.id,
+        filters={
+            'ticket_name': lambda v: log_ticket.c.name == v,
+            'created_from': lambda v: log_entry.c.created >= v,
+            'created_to': lambda v: log_entry.c.created < v,
+        }
+    )
+
+
+def _code_run_source():
+    return _Source(
+        columns=[
+            m.CodeRun.id,
+            m.CodeRun.created,
+            m.CodeRun.code,
+            m.CodeRun.output,
+            m.CodeRun.exit_code,
+        ],
+        from_clause=m.CodeRun.__table__,
+        id_column=m.CodeRun.id,
+        filters={
+            'created_from': lambda v: m.CodeRun.created >= v,
+            'created_to': lambda v: m.CodeRun.created < v,
+        }
+    )
+
+
+def _code_run_exercise_source():
+    return _Source(
+        columns=[
+            m.CodeRunExercise.id,
+            m.CodeRunExercise.created,
+            m.CodeRunExercise.elicast_id,
+            m.CodeRunExercise.ex_id,
+            m.CodeRunExercise.solve_ots,
+            m.CodeRunExercise.code,
+            m.CodeRunExercise.output,
+            m.CodeRunExercise.exit_code,
+        ],
+        from_clause=m.CodeRunExercise.__table__,
+        id_column=m.CodeRunExercise.id,
+        filters={
+            'elicast_id': lambda v: m.CodeRunExercise.elicast_id == v,
+            'ex_id': lambda v: m.CodeRunExercise.ex_id == v,
+            'created_from': lambda v: m.CodeRunExercise.created >= v,
+            'created_to': lambda v: m.CodeRunExercise.created < v,
+        }
+    )
+
+
+_SOURCES = {
+    'log_entry': _log_entry_source,
+    'code_run': _code_run_source,
+    'code_run_exercise': _code_run_exercise_source,
+}
+
+TABLES = sorted(_SOURCES.keys())
+
+
+def parse_filters(table, params):
+    # Returns a dict of filters from `params` (str values). Raises ValueError
+    # with a message for a filter which is malformed or not supported by `table`.
+    source = _SOURCES[table]()
+
+    filters = {}
+    for name in FILTER_NAMES:
+        value = params.get(name)
+        if value is None or value == '':
+            continue
+
+        if name not in source.filters:
+            raise ValueError('%s -- Not supported for %s' % (name, table))
+
+        if name == 'ticket_name':
+            if not 1 <= len(value) <= 64:
+                raise ValueError('ticket_name -- Invalid string format (1~64)')
+            filters[name] = value
+        else:
+            try:
+                filters[name] = int(value)
+            except ValueError:
+                raise ValueError('%s -- Invalid int format' % name)
+
+    return filters
+
+
+class Export:
+    # Reads the rows of a table in primary key order, one batch per short read
+    # transaction (keyset pagination), so memory stays constant and writers
+    # are never blocked for longer than a batch. log_entry is read from the
+    # main DB and then from every log partition in `log_store`, oldest first.
+
+    def __init__(self, engine, table, filters, batch_size, log_store=None):
+        self.batch_size = batch_size
+
+        sources = [(engine, _SOURCES[table]())]
+        if table == 'log_entry' and log_store is not None:
+            for name in log_store.partitions(filters.get('created_from'), filters.get('created_to')):
+                sources.append((log_store.readonly_engine(name), _log_partition_source(name)))
+
+        self.column_names = [column.key for column in sources[0][1].columns]
+        self._id_idx = self.column_names.index('id')
+
+        self._segments = []
+        for segment_engine, source in sources:
+            query = sa.select(source.columns).select_from(source.from_clause)
+            for name, value in filters.items():
+                query = query.where(source.filters[name](value))
+            query = query.order_by(source.id_column).limit(batch_size)
+
+            self._segments.append((segment_engine, query, source.id_column))
+
+        self._segment_idx = 0
+        self._last_id = 0
+
+    def fetch_batch(self):
+        # Returns an empty list when all rows have been read
+        while self._segment_idx < len(self._segments):
+            engine, query, id_column = self._segments[self._segment_idx]
+
+            with engine.connect() as conn:
+                rows = conn.execute(query.where(id_column > self._last_id)).fetchall()
+
+            if rows:
+                self._last_id = rows[-1][self._id_idx]
+                return rows
+
+            self._segment_idx += 1
+            self._last_id = 0
+
+        return []
+
+    def __iter__(self):
+        while True:
+            rows = self.fetch_batch()
+            if not rows:
+                return
+            yield rows
+
+
+class Encoder:
+
+    def __init__(self, column_names, format, is_gzip):
+        if format not in FORMATS:
+            raise ValueError('format -- should be one of %s' % ', '.join(sorted(FORMATS)))
+
+        self.column_names = column_names
+        self.format = format
+
+        self._compressor = zlib.compressobj(wbits=16 + zlib.MAX_WBITS) if is_gzip else None
+        self._is_header_written = False
+
+    @property
+    def content_type(self):
+        if self._compressor is not None:
+            return 'application/gzip'
+        return FORMATS[self.format][0]
+
+    def filename(self, name):
+        filename = '%s.%s' % (name, FORMATS[self.format][1])
+        if self._compressor is not None:
+            filename += '.gz'
+        return filename
+
+    def encode(self, rows):
+        if self.format == 'csv':
+            buf = io.StringIO()
+            writer = csv.writer(buf)
+            if not self._is_header_written:
+                writer.writerow(self.column_names)
+                self._is_header_written = True
+            writer.writerows(rows)
+            data = buf.getvalue().encode('utf-8')
+        else:
+            data = ''.join(
+                json.dumps(dict(zip(self.column_names, row)), ensure_ascii=False) + '\n'
+                for row in rows
+            ).encode('utf-8')
+
+        if self._compressor is not None:
+            return self._compressor.compress(data)
+        return data
+
+    def finish(self):
+        if self._compressor is not None:
+            return self._compressor.flush()
+        return b''
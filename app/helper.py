@@ -8,7 +8,7 @@ import traceback
 @functools.lru_cache()
 def load_config():
     config_path = os.getenv('CONFIG_PATH', 'configs/dev.py')
-    print('Config Path :', config_path)
+    print('Config Path :', config_path, file=sys.stderr)
 
     try:
         with open(config_path, encoding='utf-8') as f:
@@ -0,0 +1,237 @@
+import asyncio
+import collections
+import datetime
+import fcntl
+import os
+import os.path
+import shutil
+import sqlite3
+import threading
+
+from app import helper, storage
+from app import models as m
+
+logger = helper.logger
+
+PERIODS = {
+    'day': datetime.timedelta(days=1),
+    'week': datetime.timedelta(weeks=1),
+}
+
+TICKET_SCHEMA = 'ticket_db'
+
+_PARTITION_SUFFIX = '.sqlite3'
+_PARTITION_NAME_FORMAT = '%Y-%m-%d'
+_SEALED_USER_VERSION = 1
+_SEAL_CHECK_INTERVAL = 60  # sec
+
+
+class LogPartitionStore:
+    # Stores log entries in one sqlite file per period (day or week, in UTC),
+    # named after the first day of the period. Once a period has ended (plus
+    # `seal_delay` seconds for late flushes), its partition is sealed:
+    # compacted with VACUUM and marked with user_version. A sealed partition
+    # is never written again, so it can be archived or dropped as a file.
+    # Entries which arrive for a sealed partition go to the current one.
+
+    def __init__(self, directory, period, profile, main_db_uri, seal_delay):
+        if period not in PERIODS:
+            raise Exception('Unsupported log partition period', period)
+
+        self.directory = directory
+        self.period = period
+        self.profile = profile
+        self.seal_delay = seal_delay
+
+        self._main_db_path = storage.sqlite_path(main_db_uri)
+
+        self._engines = {}
+        self._engines_lock = threading.Lock()
+        self._sealed = set()
+        self._task = None
+
+        os.makedirs(directory, exist_ok=True)
+
+    def partition_of(self, timestamp):
+        day = datetime.datetime.utcfromtimestamp(timestamp / 1000).date()
+        if self.period == 'week':
+            day -= datetime.timedelta(days=day.weekday())
+        return day.strftime(_PARTITION_NAME_FORMAT)
+
+    def period_of(self, name):
+        # Returns (start, end) timestamps in ms of the partition
+        start = datetime.datetime.strptime(name, _PARTITION_NAME_FORMAT) \
+            .replace(tzinfo=datetime.timezone.utc)
+        end = start + PERIODS[self.period]
+        return int(start.timestamp() * 1000), int(end.timestamp() * 1000)
+
+    def path(self, name):
+        return os.path.join(self.directory, name + _PARTITION_SUFFIX)
+
+    def partitions(self, created_from=None, created_to=None):
+        # Names of the partitions, oldest first, which may have entries in [created_from, created_to)
+        names = []
+        for filename in os.listdir(self.directory):
+            if not filename.endswith(_PARTITION_SUFFIX):
+                continue
+
+            name = filename[:-len(_PARTITION_SUFFIX)]
+            try:
+                start, end = self.period_of(name)
+            except ValueError:
+                continue
+
+            if created_from is not None and end <= created_from:
+                continue
+            if created_to is not None and created_to <= start:
+                continue
+
+            names.append(name)
+
+        return sorted(names)
+
+    def is_sealed(self, name):
+        if name in self._sealed:
+            return True
+
+        try:
+            conn = sqlite3.connect(storage.readonly_uri(self.path(name)), uri=True)
+        except sqlite3.OperationalError:
+            return False  # not created yet
+
+        try:
+            is_sealed = conn.execute('PRAGMA user_version').fetchone()[0] == _SEALED_USER_VERSION
+        finally:
+            conn.close()
+
+        if is_sealed:
+            self._sealed.add(name)
+        return is_sealed
+
+    def _engine(self, name):
+        with self._engines_lock:
+            engine = self._engines.get(name)
+            if engine is None:
+                engine = storage.create_engine('sqlite:///' + self.path(name), self.profile)
+                m.LogPartitionBase.metadata.create_all(engine)
+                self._engines[name] = engine
+            return engine
+
+    def _dispose_engine(self, name):
+        with self._engines_lock:
+            engine = self._engines.pop(name, None)
+        if engine is not None:
+            engine.dispose()
+
+    def readonly_engine(self, name):
+        # log_ticket of the main DB is available as `TICKET_SCHEMA`.log_ticket
+        return storage.create_readonly_engine('sqlite:///' + self.path(name),
+                                              self.profile,
+                                              attachments={TICKET_SCHEMA: self._main_db_path})
+
+    def insert(self, rows):
+        # One transaction per partition; all rows fall in the current
+        # partition except around the end of a period
+        current_name = self.partition_of(m.now_timestamp())
+
+        rows_by_name = collections.OrderedDict()
+        for row in rows:
+            name = self.partition_of(row['created'])
+            if name != current_name and self.is_sealed(name):
+                name = current_name
+            rows_by_name.setdefault(name, []).append(row)
+
+        for name, partition_rows in rows_by_name.items():
+            with self._engine(name).begin() as conn:
+                conn.execute(m.PartitionedLogEntry.__table__.insert(), partition_rows)
+
+    def _is_ended(self, name, now):
+        start, end = self.period_of(name)
+        return end + self.seal_delay * 1000 <= now
+
+    def seal(self, name, now=None):
+        # Only a partition whose period has ended (plus `seal_delay`) can be
+        # sealed, as entries of the current period are still written to it
+        if now is None:
+            now = m.now_timestamp()
+
+        if not os.path.exists(self.path(name)):
+            raise ValueError('log partition -- Not exist (%s)' % name)
+        if not self._is_ended(name, now):
+            raise ValueError('log partition -- Not ended yet (%s)' % name)
+
+        self._dispose_engine(name)
+
+        conn = sqlite3.connect(self.path(name), isolation_level=None)
+        try:
+            conn.execute('PRAGMA busy_timeout = 30000')
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+            conn.execute('PRAGMA journal_mode = DELETE')
+            conn.execute('VACUUM')
+            conn.execute('PRAGMA user_version = %d' % _SEALED_USER_VERSION)
+        finally:
+            conn.close()
+
+        self._sealed.add(name)
+        logger.info('Sealed log partition %s', name)
+
+    def seal_ended(self, now=None):
+        # Seal every partition whose period has ended, in one worker at a time
+        if now is None:
+            now = m.now_timestamp()
+
+        with open(os.path.join(self.directory, '.seal.lock'), 'a') as lock_f:
+            try:
+                fcntl.flock(lock_f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+
+            try:
+                for name in self.partitions():
+                    if self._is_ended(name, now) and not self.is_sealed(name):
+                        self.seal(name, now)
+            finally:
+                fcntl.flock(lock_f, fcntl.LOCK_UN)
+
+    def _check_removable(self, name):
+        if not os.path.exists(self.path(name)):
+            raise ValueError('log partition -- Not exist (%s)' % name)
+        if not self.is_sealed(name):
+            raise ValueError('log partition -- Not sealed yet (%s)' % name)
+
+    def archive(self, name, target_directory):
+        self._check_removable(name)
+        self._dispose_engine(name)
+        shutil.move(self.path(name), os.path.join(target_directory, name + _PARTITION_SUFFIX))
+
+    def drop(self, name):
+        self._check_removable(name)
+        self._dispose_engine(name)
+        os.remove(self.path(name))
+
+    def start(self, db):
+        self._task = asyncio.ensure_future(self._seal_periodically(db))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+        with self._engines_lock:
+            engines = list(self._engines.values())
+            self._engines.clear()
+        for engine in engines:
+            engine.dispose()
+
+    async def _seal_periodically(self, db):
+        while True:
+            try:
+                await db.run_sync(self.seal_ended)
+            except Exception:
+                logger.exception('Failed to seal log partitions')
+
+            await asyncio.sleep(_SEAL_CHECK_INTERVAL)
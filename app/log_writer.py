@@ -0,0 +1,132 @@
+import asyncio
+
+from app import helper
+from app import models as m
+
+logger = helper.logger
+
+
+class LogBufferFull(Exception):
+    pass
+
+
+def _row(log_ticket_id, data):
+    return {
+        'log_ticket_id': log_ticket_id,
+        'data': data,
+        'created': m.now_timestamp(),
+    }
+
+
+class LogWriter:
+    # Write-behind buffer for log entries. Entries are acknowledged as soon as
+    # they are buffered, and written to the log partition store with one bulk
+    # INSERT per transaction when `max_batch` entries are pending or every
+    # `flush_interval` seconds.
+
+    def __init__(self, db, log_store, max_batch, flush_interval, max_pending):
+        self.db = db
+        self.log_store = log_store
+
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+
+        self.accepted_count = 0
+        self.written_count = 0
+        self.dropped_count = 0
+        self.failed_flush_count = 0
+
+        self._pending = []
+        self._flush_lock = asyncio.Lock()
+        self._flush_task = None
+        self._periodic_task = None
+        self._stopping = asyncio.Event()
+
+    @property
+    def pending_count(self):
+        return len(self._pending)
+
+    def start(self):
+        self._periodic_task = asyncio.ensure_future(self._flush_periodically())
+
+    async def stop(self):
+        # The periodic flush is not cancelled, as the rows of a cancelled
+        # flush may be written by the executor anyway
+        if self._periodic_task is not None:
+            self._stopping.set()
+            await self._periodic_task
+            self._periodic_task = None
+
+        await self.flush()
+
+        if self._pending:
+            logger.error('Lost %d log entries on shutdown', len(self._pending))
+
+    def submit(self, log_ticket_id, data):
+        if len(self._pending) >= self.max_pending:
+            raise LogBufferFull()
+
+        self._pending.append(_row(log_ticket_id, data))
+        self.accepted_count += 1
+
+        if len(self._pending) >= self.max_batch \
+                and (self._flush_task is None or self._flush_task.done()):
+            self._flush_task = asyncio.ensure_future(self.flush())
+
+    async def write(self, entries):
+        # Write (log_ticket_id, data) pairs right away in a single transaction,
+        # bypassing the buffer
+        rows = [_row(log_ticket_id, data) for log_ticket_id, data in entries]
+        if not rows:
+            return
+
+        self.accepted_count += len(rows)
+
+        await self.db.run_sync(self.log_store.insert, rows)
+
+        self.written_count += len(rows)
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._pending:
+                return
+
+            rows = self._pending
+            self._pending = []
+
+            try:
+                await self.db.run_sync(self.log_store.insert, rows)
+            except asyncio.CancelledError:
+                # not kept, as the insert may still complete on the executor
+                raise
+            except Exception:
+                logger.exception('Failed to flush %d log entries', len(rows))
+                self.failed_flush_count += 1
+
+                # Keep the entries for the next flush, but do not grow unbounded
+                self._pending[:0] = rows
+                overflow = len(self._pending) - self.max_pending
+                if overflow > 0:
+                    logger.error('Dropped %d log entries', overflow)
+                    del self._pending[:overflow]
+                    self.dropped_count += overflow
+                return
+
+            self.written_count += len(rows)
+
+    async def _flush_periodically(self):
+        while not self._stopping.is_set():
+            try:
+                await asyncio.wait_for(self._stopping.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                await self.flush()
+
+    def stats(self):
+        return {
+            'pending': self.pending_count,
+            'accepted': self.accepted_count,
+            'written': self.written_count,
+            'dropped': self.dropped_count,
+            'failed_flushes': self.failed_flush_count,
+        }
@@ -0,0 +1,516 @@
+import asyncio
+import bisect
+import fcntl
+import json
+import math
+import os
+import os.path
+import threading
+import time
+import uuid
+
+from aiohttp import web
+
+from app import helper
+
+logger = helper.logger
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, math.inf)
+
+_SNAPSHOT_SUFFIX = '.json'
+
+# Counters and histograms of exited worker processes, folded into one file
+_TOMBSTONE_NAME = 'tombstone'
+_TOMBSTONE_LOCK_NAME = '.tombstone.lock'
+
+
+def _start_time(pid):
+    # Start time of the process in clock ticks since boot, or None if unknown
+    try:
+        with open('/proc/%d/stat' % pid, encoding='utf-8') as f:
+            stat = f.read()
+    except OSError:
+        return None
+    # fields after the command name, which may contain spaces; starttime is
+    # the 22nd field
+    return stat.rsplit(')', 1)[1].split()[19]
+
+
+_process_key = None
+_process_key_pid = None
+
+
+def process_key():
+    # Name of the snapshot of this process: the pid and the start time of the
+    # process (or a random id), so that a new process which reuses the pid of
+    # an exited one does not overwrite its snapshot
+    global _process_key, _process_key_pid
+    pid = os.getpid()
+    if _process_key_pid != pid:
+        _process_key = '%d-%s' % (pid, _start_time(pid) or uuid.uuid4().hex)
+        _process_key_pid = pid
+    return _process_key
+
+
+class Registry:
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+
+    def snapshot(self):
+        return {metric.name: metric.snapshot() for metric in self._metrics}
+
+    def write_snapshot(self, directory):
+        # Snapshots of every worker process are merged by `render`
+        _write_json(os.path.join(directory, process_key() + _SNAPSHOT_SUFFIX), self.snapshot())
+
+    def render(self, directory=None):
+        key = process_key()
+        if directory is None:
+            snapshots = [(key, self.snapshot())]
+        else:
+            self.write_snapshot(directory)
+            _fold_exited(directory)
+            # The snapshot of this process comes first, so that its help
+            # texts and buckets are used for the merged metrics
+            snapshots = sorted(_read_snapshots(directory), key=lambda s: s[0] != key)
+
+        return ''.join(_render_metric(name, metric) for name, metric in sorted(_merge(snapshots).items()))
+
+
+REGISTRY = Registry()
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), multiprocess_mode='sum', registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        # How gauges of worker processes are combined ('sum' or 'max'). Only
+        # alive processes count for gauges, while counters and histograms of
+        # exited processes are kept so that totals never go backwards.
+        self.multiprocess_mode = multiprocess_mode
+
+        self._values = {}
+        self._lock = threading.Lock()
+
+        registry.register(self)
+
+    def labels(self, *labelvalues):
+        if len(labelvalues) != len(self.labelnames):
+            raise ValueError('Invalid labels of metric', self.name, labelvalues)
+        return _LabeledMetric(self, tuple(str(v) for v in labelvalues))
+
+    def _samples(self):
+        with self._lock:
+            return [[list(k), v] for k, v in self._values.items()]
+
+    def snapshot(self):
+        return {
+            'type': self.type,
+            'help': self.documentation,
+            'labelnames': list(self.labelnames),
+            'mode': self.multiprocess_mode,
+            'samples': self._samples(),
+        }
+
+
+class _LabeledMetric:
+
+    def __init__(self, metric, labelvalues):
+        self._metric = metric
+        self._labelvalues = labelvalues
+
+    def __getattr__(self, name):
+        method = getattr(self._metric, '_' + name)
+        return lambda *args, **kwargs: method(self._labelvalues, *args, **kwargs)
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def inc(self, amount=1):
+        self._inc((), amount)
+
+    def _inc(self, labelvalues, amount=1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._functions = {}
+
+    def set(self, value):
+        self._set((), value)
+
+    def inc(self, amount=1):
+        self._inc((), amount)
+
+    def dec(self, amount=1):
+        self._inc((), -amount)
+
+    def set_function(self, fn):
+        self._set_function((), fn)
+
+    def _set(self, labelvalues, value):
+        with self._lock:
+            self._values[labelvalues] = value
+
+    def _inc(self, labelvalues, amount=1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def _dec(self, labelvalues, amount=1):
+        self._inc(labelvalues, -amount)
+
+    def _set_function(self, labelvalues, fn):
+        # `fn` is called whenever the metric is collected
+        self._functions[labelvalues] = fn
+
+    def _samples(self):
+        samples = super()._samples()
+        for labelvalues, fn in list(self._functions.items()):
+            try:
+                samples.append([list(labelvalues), fn()])
+            except Exception:
+                logger.exception('Failed to collect metric %s', self.name)
+        return samples
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, **kwargs):
+        super().__init__(name, documentation, labelnames, **kwargs)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value):
+        self._observe((), value)
+
+    def time(self):
+        return self._time(())
+
+    def _observe(self, labelvalues, value):
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labelvalues)
+            if state is None:
+                state = self._values[labelvalues] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            if idx < len(self.buckets):
+                state['buckets'][idx] += 1
+            state['sum'] += value
+            state['count'] += 1
+
+    def _time(self, labelvalues):
+        return _Timer(lambda duration: self._observe(labelvalues, duration))
+
+    def snapshot(self):
+        snapshot = super().snapshot()
+        snapshot['buckets'] = [_format_value(b) for b in self.buckets]
+        return snapshot
+
+    def _samples(self):
+        with self._lock:
+            return [[list(k), {'buckets': list(v['buckets']), 'sum': v['sum'], 'count': v['count']}]
+                    for k, v in self._values.items()]
+
+
+class _Timer:
+
+    def __init__(self, callback):
+        self._callback = callback
+
+    def __enter__(self):
+        self._started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._callback(time.perf_counter() - self._started_at)
+
+
+def _is_alive(key):
+    if key == process_key():
+        return True
+    if key == _TOMBSTONE_NAME:
+        return False
+
+    try:
+        pid_str, _, start_time = key.partition('-')
+        pid = int(pid_str)
+    except ValueError:
+        return False
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    # the pid may have been reused by another process
+    current_start_time = _start_time(pid)
+    return current_start_time is None or current_start_time == start_time
+
+
+def _write_json(path, value):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(value, f)
+    os.replace(tmp_path, path)
+
+
+def _read_json(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (ValueError, OSError):
+        return None
+
+
+def _read_snapshots(directory):
+    # Returns (key, snapshot) of every process, and of the tombstone
+    snapshots = []
+    for filename in os.listdir(directory):
+        if not filename.endswith(_SNAPSHOT_SUFFIX):
+            continue
+
+        key = filename[:-len(_SNAPSHOT_SUFFIX)]
+        snapshot = _read_json(os.path.join(directory, filename))
+        if snapshot is None:
+            continue
+        if key == _TOMBSTONE_NAME:
+            snapshot = snapshot['metrics']
+        snapshots.append((key, snapshot))
+    return snapshots
+
+
+def _fold_exited(directory):
+    # Moves the counters and histograms of exited processes into the
+    # tombstone and removes their snapshots, so that totals never go
+    # backwards and the directory does not grow with every restart. The
+    # tombstone lists the folded snapshots, in case a snapshot could not be
+    # removed after the tombstone was written.
+    exited_filenames = [filename for filename in os.listdir(directory)
+                        if filename.endswith(_SNAPSHOT_SUFFIX)
+                        and filename != _TOMBSTONE_NAME + _SNAPSHOT_SUFFIX
+                        and not _is_alive(filename[:-len(_SNAPSHOT_SUFFIX)])]
+    if not exited_filenames:
+        return
+
+    with open(os.path.join(directory, _TOMBSTONE_LOCK_NAME), 'a') as lock_f:
+        fcntl.flock(lock_f, fcntl.LOCK_EX)
+        try:
+            tombstone_path = os.path.join(directory, _TOMBSTONE_NAME + _SNAPSHOT_SUFFIX)
+            tombstone = _read_json(tombstone_path) or {'metrics': {}, 'folded': []}
+            folded_filenames = set(tombstone['folded'])
+
+            snapshots = [(_TOMBSTONE_NAME, tombstone['metrics'])]
+            filenames = []
+            for filename in exited_filenames:
+                if filename in folded_filenames:
+                    filenames.append(filename)
+                    continue
+
+                snapshot = _read_json(os.path.join(directory, filename))
+                if snapshot is not None:  # else folded by another worker meanwhile
+                    snapshots.append((filename[:-len(_SNAPSHOT_SUFFIX)], snapshot))
+                    filenames.append(filename)
+
+            merged = _merge(snapshots)
+            _write_json(tombstone_path, {
+                'metrics': {
+                    name: dict(metric, samples=[[list(k), v] for k, v in metric['samples'].items()])
+                    for name, metric in merged.items() if metric['type'] != 'gauge'
+                },
+                'folded': filenames,
+            })
+
+            for filename in filenames:
+                try:
+                    os.remove(os.path.join(directory, filename))
+                except FileNotFoundError:
+                    pass
+        finally:
+            fcntl.flock(lock_f, fcntl.LOCK_UN)
+
+
+def _merge(snapshots):
+    merged = {}
+    for snapshot_key, snapshot in snapshots:
+        is_alive = None
+        for name, metric in snapshot.items():
+            if metric['type'] == 'gauge':
+                if is_alive is None:
+                    is_alive = _is_alive(snapshot_key)
+                if not is_alive:
+                    continue
+
+            merged_metric = merged.get(name)
+            if merged_metric is None:
+                merged_metric = merged[name] = dict(metric, samples={})
+            elif merged_metric['type'] != metric['type'] \
+                    or merged_metric.get('buckets') != metric.get('buckets'):
+                continue  # written by a process of another version
+
+            samples = merged_metric['samples']
+            for labelvalues, value in metric['samples']:
+                key = tuple(labelvalues)
+                if key not in samples:
+                    samples[key] = value
+                elif metric['type'] == 'histogram':
+                    samples[key] = {
+                        'buckets': [a + b for a, b in zip(samples[key]['buckets'], value['buckets'])],
+                        'sum': samples[key]['sum'] + value['sum'],
+                        'count': samples[key]['count'] + value['count'],
+                    }
+                elif metric['type'] == 'gauge' and metric['mode'] == 'max':
+                    samples[key] = max(samples[key], value)
+                else:
+                    samples[key] = samples[key] + value
+    return merged
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, str):
+        return value
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, _escape(v)) for k, v in pairs)
+
+
+def _render_metric(name, metric):
+    lines = [
+        '# HELP %s %s' % (name, metric['help']),
+        '# TYPE %s %s' % (name, metric['type']),
+    ]
+    labelnames = metric['labelnames']
+
+    for labelvalues, value in sorted(metric['samples'].items()):
+        if metric['type'] == 'histogram':
+            cumulative = 0
+            for bucket, count in zip(metric['buckets'], value['buckets']):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (name, _format_labels(labelnames, labelvalues, [('le', bucket)]),
+                                                 cumulative))
+            lines.append('%s_sum%s %s' % (name, _format_labels(labelnames, labelvalues), _format_value(value['sum'])))
+            lines.append('%s_count%s %d' % (name, _format_labels(labelnames, labelvalues), value['count']))
+        else:
+            lines.append('%s%s %s' % (name, _format_labels(labelnames, labelvalues), _format_value(value)))
+
+    return '\n'.join(lines) + '\n'
+
+
+HTTP_REQUEST_DURATION = Histogram('elicast_http_request_duration_seconds',
+                                  'Latency of HTTP requests',
+                                  ['method', 'route', 'status'])
+HTTP_REQUESTS_IN_FLIGHT = Gauge('elicast_http_requests_in_flight',
+                                'HTTP requests being handled',
+                                ['method', 'route'])
+EXECUTOR_QUEUE_DEPTH = Gauge('elicast_executor_queue_depth',
+                             'Tasks waiting for a thread of the executor',
+                             ['executor'])
+EVENT_LOOP_LAG = Histogram('elicast_event_loop_lag_seconds',
+                           'Delay of the event loop to wake up a sleeping task',
+                           buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5, math.inf))
+
+
+def route_name(request):
+    match_info = request.match_info
+    if match_info.http_exception is not None:
+        return ''  # not matched to any route
+    info = match_info.route.resource.get_info()
+    return info.get('path') or info.get('formatter') or ''
+
+
+@web.middleware
+async def metrics_middleware(request, handler):
+    method = request.method
+    route = route_name(request)
+
+    in_flight = HTTP_REQUESTS_IN_FLIGHT.labels(method, route)
+    in_flight.inc()
+    started_at = time.perf_counter()
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        HTTP_REQUEST_DURATION.labels(method, route, status).observe(time.perf_counter() - started_at)
+        in_flight.dec()
+
+
+def watch_executor_queue(name, executor):
+    EXECUTOR_QUEUE_DEPTH.labels(name).set_function(lambda: executor._work_queue.qsize())
+
+
+class MetricsWorker:
+    # Measures the event loop lag and, in multiprocess mode, writes the
+    # snapshot of this worker process periodically
+
+    def __init__(self, directory, flush_interval):
+        self.directory = directory
+        self.flush_interval = flush_interval
+
+        self._task = None
+
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+        if self.directory is not None:
+            REGISTRY.write_snapshot(self.directory)
+
+    async def _run(self):
+        loop = asyncio.get_event_loop()
+        last_flushed_at = loop.time()
+        while True:
+            started_at = loop.time()
+            await asyncio.sleep(0.5)
+            EVENT_LOOP_LAG.observe(max(0.0, loop.time() - started_at - 0.5))
+
+            if self.directory is not None and loop.time() - last_flushed_at >= self.flush_interval:
+                last_flushed_at = loop.time()
+                try:
+                    REGISTRY.write_snapshot(self.directory)
+                except OSError:
+                    logger.exception('Failed to write metrics snapshot')
+
+    def render(self):
+        return REGISTRY.render(self.directory)
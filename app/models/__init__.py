@@ -1,42 +1,26 @@
-import asyncio
 import datetime
-from contextlib import contextmanager
 
 from sqlalchemy import ForeignKey, types
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, scoped_session, sessionmaker
+from sqlalchemy.orm import relationship
 from sqlalchemy.schema import Column
 
-__all__ = ['Session', 'SessionContext', 'Base',
+__all__ = ['now_timestamp', 'Base',
            'Elicast',
            'CodeRun', 'CodeRunExercise',
-           'LogTicket', 'LogEntry']
+           'ExerciseStats', 'ExerciseTicketStats',
+           'LogTicket', 'LogEntry',
+           'LogPartitionBase', 'PartitionedLogEntry']
 
-Session = scoped_session(
-    sessionmaker(),
-    scopefunc=asyncio.Task.current_task
-)
 
-
-@contextmanager
-def SessionContext():
-    session = Session()
-    try:
-        yield session
-        session.commit()
-    except Exception:
-        session.rollback()
-        raise
-    finally:
-        session.close()
+def now_timestamp():
+    return int(datetime.datetime.now().timestamp() * 1000)
 
 
 class _Base:
-    query = Session.query_property()
-
     created = Column(types.BigInteger,
                      nullable=False,
-                     default=lambda: int(datetime.datetime.now().timestamp() * 1000))
+                     default=now_timestamp)
 
 
 Base = declarative_base(cls=_Base)
@@ -84,6 +68,45 @@ class CodeRunExercise(Base, _CodeRunMixin):
     solve_ots = Column(types.Text, nullable=False)
 
 
+class ExerciseStats(Base):
+    # Aggregates of the code_run_exercise rows of an exercise, updated with
+    # every answer (see app.exercise_stats). The learner columns only count
+    # answers sent with a log ticket.
+    __tablename__ = 'exercise_stats'
+
+    elicast_id = Column(types.Integer, ForeignKey('elicast.id'),
+                        primary_key=True)
+    ex_id = Column(types.Integer, primary_key=True)
+
+    attempt_count = Column(types.Integer, nullable=False, default=0)
+    pass_count = Column(types.Integer, nullable=False, default=0)
+    last_attempt = Column(types.BigInteger, nullable=True)
+
+    learner_count = Column(types.Integer, nullable=False, default=0)
+    passed_learner_count = Column(types.Integer, nullable=False, default=0)
+    # Sums over the passed learners, of their attempts and ms until the
+    # first pass
+    first_pass_attempts_total = Column(types.BigInteger, nullable=False, default=0)
+    first_pass_time_total = Column(types.BigInteger, nullable=False, default=0)
+
+
+class ExerciseTicketStats(Base):
+    __tablename__ = 'exercise_ticket_stats'
+
+    elicast_id = Column(types.Integer, ForeignKey('elicast.id'),
+                        primary_key=True)
+    ex_id = Column(types.Integer, primary_key=True)
+    log_ticket_id = Column(types.Integer, ForeignKey('log_ticket.id'),
+                           primary_key=True)
+
+    attempt_count = Column(types.Integer, nullable=False, default=0)
+    pass_count = Column(types.Integer, nullable=False, default=0)
+    first_attempt = Column(types.BigInteger, nullable=False)
+    last_attempt = Column(types.BigInteger, nullable=False)
+    first_pass = Column(types.BigInteger, nullable=True)
+    first_pass_attempts = Column(types.Integer, nullable=True)
+
+
 class LogTicket(Base):
     __tablename__ = 'log_ticket'
 
@@ -108,3 +131,18 @@ class LogEntry(Base):
     log_ticket = relationship('LogTicket')
 
     data = Column(types.Text, nullable=False)
+
+
+# Tables of a log partition file (see app.log_store), apart from the main DB
+LogPartitionBase = declarative_base(cls=_Base)
+
+
+class PartitionedLogEntry(LogPartitionBase):
+    __tablename__ = 'log_entry'
+
+    id = Column(types.Integer, primary_key=True)
+
+    # log_ticket.id of the main DB
+    log_ticket_id = Column(types.Integer, nullable=False, index=True)
+
+    data = Column(types.Text, nullable=False)
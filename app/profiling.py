@@ -0,0 +1,300 @@
+import asyncio
+import concurrent.futures
+import cProfile
+import io
+import itertools
+import json
+import os
+import os.path
+import pstats
+import random
+import re
+import threading
+import time
+import weakref
+
+from aiohttp import web
+
+from app import helper
+
+logger = helper.logger
+
+PROFILE_HEADER = 'X-Elicast-Profile'
+PROFILE_ID_HEADER = 'X-Elicast-Profile-Id'
+
+PROFILE_ID_PATTERN = re.compile(r'^[0-9A-Za-z-]+$')
+
+_CPROFILE_MAX_LINES = 60
+
+# Profile of the request handled by a task, and of the request which
+# submitted the job running in an executor thread
+_profiles = weakref.WeakKeyDictionary()
+_thread_local = threading.local()
+
+try:
+    _current_task = asyncio.current_task
+except AttributeError:  # Python 3.6
+    _current_task = asyncio.Task.current_task
+
+
+class Profile:
+
+    def __init__(self, request, is_forced, use_cprofile):
+        self.id = None
+        self.method = request.method
+        self.path = request.path_qs
+        self.created = int(time.time() * 1000)
+        self.is_forced = is_forced
+        self.status = None
+        self.duration = None
+        self.spans = []
+        self.cprofile = cProfile.Profile() if use_cprofile else None
+
+        self._started_at = time.perf_counter()
+
+    def add_span(self, kind, name, started_at, duration, **extra):
+        span = {
+            'kind': kind,
+            'name': name,
+            'start_ms': round((started_at - self._started_at) * 1000, 3),
+            'duration_ms': round(duration * 1000, 3),
+        }
+        span.update(extra)
+        self.spans.append(span)
+
+    def finish(self, status):
+        self.status = status
+        self.duration = time.perf_counter() - self._started_at
+
+    def summary(self):
+        return {
+            'id': self.id,
+            'method': self.method,
+            'path': self.path,
+            'created': self.created,
+            'status': self.status,
+            'duration_ms': round(self.duration * 1000, 3),
+        }
+
+    def to_json(self):
+        profile_json = self.summary()
+        profile_json['spans'] = sorted(self.spans, key=lambda span: span['start_ms'])
+
+        profile_json['cprofile'] = None
+        if self.cprofile is not None:
+            # cProfile sees every coroutine run on the loop while the request
+            # is handled, not only the ones of this request
+            output = io.StringIO()
+            pstats.Stats(self.cprofile, stream=output).sort_stats('cumulative').print_stats(_CPROFILE_MAX_LINES)
+            profile_json['cprofile'] = output.getvalue()
+
+        return profile_json
+
+
+class _Span:
+
+    def __init__(self, profile, kind, name):
+        self.profile = profile
+        self.kind = kind
+        self.name = name
+
+    def __enter__(self):
+        self._started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profile.add_span(self.kind, self.name, self._started_at, time.perf_counter() - self._started_at)
+
+
+class _NullSpan:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def current():
+    if not _profiles:
+        return None  # no profiled request at all
+
+    profile = getattr(_thread_local, 'profile', None)
+    if profile is not None:
+        return profile
+
+    try:
+        task = _current_task()
+    except RuntimeError:
+        return None  # not on the event loop
+    return _profiles.get(task) if task is not None else None
+
+
+def span(kind, name):
+    # Records the time of the block in the profile of the current request, if
+    # it is profiled
+    profile = current()
+    if profile is None:
+        return _NULL_SPAN
+    return _Span(profile, kind, name)
+
+
+def _name_of(fn):
+    name = getattr(fn, '__name__', None)
+    if name is None:
+        name = getattr(getattr(fn, 'func', None), '__name__', repr(fn))
+    return name
+
+
+def _run_profiled(profile, kind, fn, submitted_at, args, kwargs):
+    started_at = time.perf_counter()
+    _thread_local.profile = profile
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        _thread_local.profile = None
+        profile.add_span(kind, _name_of(fn), submitted_at, time.perf_counter() - submitted_at,
+                         wait_ms=round((started_at - submitted_at) * 1000, 3))
+
+
+class ProfiledThreadPoolExecutor(concurrent.futures.ThreadPoolExecutor):
+    # Records a span of every job submitted by a profiled request, and makes
+    # the profile available to `span` in the worker thread
+
+    def __init__(self, max_workers, kind, **kwargs):
+        super().__init__(max_workers, **kwargs)
+
+        self.kind = kind
+
+    def submit(self, fn, *args, **kwargs):
+        profile = current()
+        if profile is None:
+            return super().submit(fn, *args, **kwargs)
+        return super().submit(_run_profiled, profile, self.kind, fn, time.perf_counter(), args, kwargs)
+
+
+class ProfileStore:
+    # Profiles are written as JSON files to `directory`, which is shared by
+    # the worker processes. Only the newest `max_files` are kept.
+
+    def __init__(self, directory, max_files, slow_threshold, sample_rate, executor):
+        self.directory = directory
+        self.max_files = max_files
+        self.slow_threshold = slow_threshold
+        self.sample_rate = sample_rate
+        self.executor = executor
+
+        self._seq = itertools.count()
+
+        # cProfile profiles the whole thread, so one request at a time
+        self.cprofile_lock = asyncio.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+
+    def save(self, profile):
+        # Written in the background, so that the response is not delayed
+        profile.id = '%s-%d-%d' % (time.strftime('%Y%m%dT%H%M%S', time.gmtime(profile.created / 1000)),
+                                   os.getpid(),
+                                   next(self._seq))
+        loop = asyncio.get_event_loop()
+        loop.run_in_executor(self.executor, self._write, profile)
+
+    def _write(self, profile):
+        try:
+            path = self._path(profile.id)
+            with open(path + '.tmp', 'w', encoding='utf-8') as f:
+                json.dump(profile.to_json(), f)
+            os.replace(path + '.tmp', path)
+
+            self._rotate()
+        except Exception:
+            logger.exception('Failed to save profile %s', profile.id)
+
+    def _rotate(self):
+        for profile_id in self._profile_ids()[:-self.max_files]:
+            try:
+                os.remove(self._path(profile_id))
+            except FileNotFoundError:
+                pass  # removed by another worker
+
+    def _path(self, profile_id):
+        return os.path.join(self.directory, profile_id + '.json')
+
+    def _profile_ids(self):
+        return sorted(filename[:-len('.json')]
+                      for filename in os.listdir(self.directory)
+                      if filename.endswith('.json'))
+
+    def list(self):
+        # Newest first, without spans
+        summaries = []
+        for profile_id in reversed(self._profile_ids()):
+            profile_json = self.get(profile_id)
+            if profile_json is None:
+                continue
+            profile_json = json.loads(profile_json)
+            profile_json['span_count'] = len(profile_json.pop('spans'))
+            profile_json['has_cprofile'] = profile_json.pop('cprofile') is not None
+            summaries.append(profile_json)
+        return summaries
+
+    def get(self, profile_id):
+        # Returns the profile as a JSON string, or None if it does not exist
+        if not PROFILE_ID_PATTERN.match(profile_id):
+            return None
+        try:
+            with open(self._path(profile_id), encoding='utf-8') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+
+@web.middleware
+async def profiling_middleware(request, handler):
+    # Installed only if PROFILING_ENABLED. Requests with the profile header
+    # ('cprofile' to run cProfile as well) are always saved, sampled ones only
+    # when they are slower than the threshold.
+    store = request.app['profile_store']
+
+    mode = request.headers.get(PROFILE_HEADER)
+    if mode is None and not random.random() < store.sample_rate:
+        return await handler(request)
+
+    if mode == 'cprofile':
+        async with store.cprofile_lock:
+            return await _handle_profiled(request, handler, store, mode)
+    return await _handle_profiled(request, handler, store, mode)
+
+
+async def _handle_profiled(request, handler, store, mode):
+    task = _current_task()
+    profile = _profiles[task] = Profile(request,
+                                        is_forced=mode is not None,
+                                        use_cprofile=mode == 'cprofile')
+
+    if profile.cprofile is not None:
+        profile.cprofile.enable()
+
+    response = None
+    status = 500
+    try:
+        response = await handler(request)
+        status = response.status
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        if profile.cprofile is not None:
+            profile.cprofile.disable()
+        del _profiles[task]
+
+        profile.finish(status)
+        if profile.is_forced or profile.duration >= store.slow_threshold:
+            store.save(profile)
+            if response is not None and not response.prepared:
+                response.headers[PROFILE_ID_HEADER] = profile.id
+
+    return response
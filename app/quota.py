@@ -0,0 +1,236 @@
+import asyncio
+import concurrent.futures
+import math
+import os
+import os.path
+import sqlite3
+import time
+
+from aiohttp import web
+
+from app import helper, metrics
+
+logger = helper.logger
+
+TICKET_HEADER = 'X-Elicast-Ticket'
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS bucket (
+    endpoint TEXT NOT NULL,
+    client TEXT NOT NULL,
+    tokens REAL NOT NULL,
+    updated REAL NOT NULL,
+    allowed INTEGER NOT NULL DEFAULT 0,
+    rejected INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (endpoint, client)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS lease (
+    id INTEGER PRIMARY KEY,
+    endpoint TEXT NOT NULL,
+    client TEXT NOT NULL,
+    expires REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_lease_client ON lease (endpoint, client);
+CREATE INDEX IF NOT EXISTS ix_lease_expires ON lease (expires);
+'''
+
+_PRUNE_INTERVAL = 1000  # calls
+
+QUOTA_REJECTIONS = metrics.Counter('elicast_quota_rejections',
+                                   'Requests rejected by quotas',
+                                   ['route', 'reason'])
+
+
+class QuotaStore:
+    # Token buckets and in-flight leases of every (endpoint, client), shared
+    # by the worker processes through a local sqlite file. A client is
+    # 'ip:<address>' or 'ticket:<log ticket>', limited by `limits[endpoint]`
+    # of its kind ('ip' or 'ticket'), if any. Every check is one IMMEDIATE
+    # transaction, run on a thread of its own so that waiting for the lock
+    # never blocks the event loop.
+    #
+    # In-flight requests hold a lease which expires after `lease_ttl` sec, so
+    # requests of a killed worker do not count forever.
+
+    def __init__(self, path, limits, lease_ttl, retention):
+        self.path = path
+        self.limits = limits
+        self.lease_ttl = lease_ttl
+        self.retention = retention
+
+        self._executor = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix='quota')
+        self._connection = None
+        self._call_count = 0
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def _connect(self):
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute('PRAGMA synchronous=OFF')
+            self._connection.executescript(_SCHEMA)
+        return self._connection
+
+    async def _call(self, fn, *args):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, fn, *args)
+
+    async def acquire(self, endpoint, clients):
+        # Returns (lease ids, None, None) if allowed, or (None, seconds to
+        # retry after, 'rate' or 'in_flight')
+        return await self._call(self._acquire, endpoint, clients, time.time())
+
+    async def release(self, lease_ids):
+        await self._call(self._release, lease_ids)
+
+    async def usage(self, client=None):
+        return await self._call(self._usage, client, time.time())
+
+    def _limit(self, endpoint, client):
+        return self.limits.get(endpoint, {}).get(client.partition(':')[0])
+
+    def _refilled(self, limit, tokens, updated, now):
+        return min(limit['burst'], tokens + max(0.0, now - updated) * limit['rate'])
+
+    def _acquire(self, endpoint, clients, now):
+        conn = self._connect()
+
+        self._call_count += 1
+        if self._call_count % _PRUNE_INTERVAL == 1:
+            self._prune(conn, now)
+
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            conn.execute('DELETE FROM lease WHERE expires < ?', (now,))
+
+            retry_after = None
+            reason = None
+            tokens_by_client = {}
+            for client in clients:
+                limit = self._limit(endpoint, client)
+                if limit is None:
+                    continue
+
+                row = conn.execute('SELECT tokens, updated FROM bucket WHERE endpoint = ? AND client = ?',
+                                   (endpoint, client)).fetchone()
+                tokens = limit['burst'] if row is None else self._refilled(limit, row[0], row[1], now)
+                tokens_by_client[client] = tokens
+
+                in_flight = conn.execute('SELECT COUNT(*) FROM lease WHERE endpoint = ? AND client = ?',
+                                         (endpoint, client)).fetchone()[0]
+                if in_flight >= limit['max_in_flight']:
+                    # unknown when a running request ends
+                    retry_after = max(retry_after or 0, 1)
+                    reason = 'in_flight'
+                elif tokens < 1:
+                    retry_after = max(retry_after or 0, (1 - tokens) / limit['rate'])
+                    reason = reason or 'rate'
+
+            is_allowed = retry_after is None
+            lease_ids = []
+            for client, tokens in tokens_by_client.items():
+                conn.execute('INSERT OR IGNORE INTO bucket (endpoint, client, tokens, updated) VALUES (?, ?, 0, 0)',
+                             (endpoint, client))
+                conn.execute('UPDATE bucket SET tokens = ?, updated = ?, '
+                             'allowed = allowed + ?, rejected = rejected + ? '
+                             'WHERE endpoint = ? AND client = ?',
+                             (tokens - 1 if is_allowed else tokens, now, int(is_allowed), int(not is_allowed),
+                              endpoint, client))
+                if is_allowed:
+                    lease_ids.append(conn.execute('INSERT INTO lease (endpoint, client, expires) VALUES (?, ?, ?)',
+                                                  (endpoint, client, now + self.lease_ttl)).lastrowid)
+
+            conn.execute('COMMIT')
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+
+        if not is_allowed:
+            return None, retry_after, reason
+        return lease_ids, None, None
+
+    def _release(self, lease_ids):
+        conn = self._connect()
+        conn.executemany('DELETE FROM lease WHERE id = ?', [(lease_id,) for lease_id in lease_ids])
+
+    def _prune(self, conn, now):
+        # Buckets unused for `retention` sec are full again, so only their
+        # usage counters are lost
+        conn.execute('DELETE FROM bucket WHERE updated < ?', (now - self.retention,))
+
+    def _usage(self, client, now):
+        conn = self._connect()
+
+        query = 'SELECT endpoint, client, tokens, updated, allowed, rejected FROM bucket'
+        params = ()
+        if client is not None:
+            query += ' WHERE client = ?'
+            params = (client,)
+        query += ' ORDER BY updated DESC'
+
+        in_flight = {}
+        for endpoint, lease_client, count in conn.execute(
+                'SELECT endpoint, client, COUNT(*) FROM lease WHERE expires >= ? GROUP BY endpoint, client', (now,)):
+            in_flight[(endpoint, lease_client)] = count
+
+        usage = []
+        for endpoint, bucket_client, tokens, updated, allowed, rejected in conn.execute(query, params):
+            limit = self._limit(endpoint, bucket_client)
+            usage.append({
+                'endpoint': endpoint,
+                'client': bucket_client,
+                'tokens': None if limit is None else round(self._refilled(limit, tokens, updated, now), 3),
+                'in_flight': in_flight.get((endpoint, bucket_client), 0),
+                'allowed': allowed,
+                'rejected': rejected,
+                'last_seen': int(updated * 1000),
+            })
+        return usage
+
+    def _close_connection(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def close(self):
+        # the connection can only be used by the thread which opened it
+        self._executor.submit(self._close_connection).result()
+        self._executor.shutdown(wait=True)
+
+
+async def _clients(request):
+    clients = ['ip:%s' % request.remote]
+
+    # Learners behind one NAT address share the IP, so they are mostly
+    # limited by their tickets. Browsers send the ticket as a form field, like
+    # /log/submit; the form is cached by aiohttp for the handler.
+    ticket = request.headers.get(TICKET_HEADER)
+    if ticket is None:
+        ticket = (await request.post()).get('ticket')
+    if isinstance(ticket, str) and len(ticket) == 36:
+        clients.append('ticket:%s' % ticket)
+
+    return clients
+
+
+@web.middleware
+async def quota_middleware(request, handler):
+    store = request.app['quota_store']
+
+    route = metrics.route_name(request)
+    if route not in store.limits:
+        return await handler(request)
+
+    lease_ids, retry_after, reason = await store.acquire(route, await _clients(request))
+    if lease_ids is None:
+        QUOTA_REJECTIONS.labels(route, reason).inc()
+        return web.HTTPTooManyRequests(text='quota -- Too many requests',
+                                       headers={'Retry-After': str(max(1, math.ceil(retry_after)))})
+
+    try:
+        return await handler(request)
+    finally:
+        await store.release(lease_ids)
@@ -0,0 +1,45 @@
+import importlib
+
+RUN_CODE_MAX_OUTPUT = 1 * 1024 * 1024  # 1 MB
+RUN_CODE_MAX_TTL = 5 * 60  # 5 min
+RUN_CODE_MAX_MEMORY = 256 * 1024 * 1024  # 256 MB
+
+_BACKEND_MODULE_NAMES = {
+    'docker': 'docker_engine',
+    'local': 'local_process',
+}
+
+
+class SandboxUnavailable(Exception):
+    pass
+
+
+class Backend:
+    name = None
+
+    def __init__(self, executor):
+        self.executor = executor
+
+    async def start(self):
+        pass
+
+    async def run(self, code):
+        # Returns a tuple of (output, exit_code). Raises SandboxUnavailable if
+        # there is nowhere to run the code.
+        raise NotImplementedError()
+
+    def stats(self):
+        return {}
+
+    def close(self):
+        pass
+
+
+def create_backend(name, executor):
+    try:
+        module_name = _BACKEND_MODULE_NAMES[name]
+    except KeyError:
+        raise Exception('Unsupported sandbox backend', name)
+
+    module = importlib.import_module('.' + module_name, __name__)
+    return module.create_backend(executor)
@@ -0,0 +1,227 @@
+# Executed as a standalone script (`python -I -S _launcher.py SPEC`) by the
+# local process backend. It confines itself and then replaces itself with the
+# interpreter running the user code, so it must only depend on the stdlib.
+# The seccomp module is imported from `spec['seccomp_path']`, as site-packages
+# are not on sys.path here.
+import ctypes
+import ctypes.util
+import errno
+import json
+import os
+import platform
+import resource
+import signal
+import sys
+
+CLONE_NEWNS = 0x00020000
+CLONE_NEWUTS = 0x04000000
+CLONE_NEWIPC = 0x08000000
+CLONE_NEWUSER = 0x10000000
+CLONE_NEWNET = 0x40000000
+
+MS_RDONLY = 0x1
+MS_NOSUID = 0x2
+MS_NODEV = 0x4
+MS_NOEXEC = 0x8
+MS_REMOUNT = 0x20
+MS_NOATIME = 0x400
+MS_NODIRATIME = 0x800
+MS_BIND = 0x1000
+MS_REC = 0x4000
+MS_PRIVATE = 0x40000
+MS_RELATIME = 0x200000
+
+MNT_DETACH = 0x2
+
+PR_SET_PDEATHSIG = 1
+PR_SET_NO_NEW_PRIVS = 38
+
+_SYS_PIVOT_ROOT = {
+    'x86_64': 155,
+    'aarch64': 41,
+}
+
+# The user code runs as this uid/gid of its user namespace, so it has no
+# capabilities in it after exec
+SANDBOX_UID = 1000
+SANDBOX_GID = 1000
+
+# Where the working directory is mounted in the new root
+SANDBOX_WORKDIR = '/tmp'
+
+_DEVICES = ['null', 'zero', 'random', 'urandom']
+
+ISOLATION_FAILED_EXIT_CODE = 125
+
+_SECCOMP_DENIED_SYSCALLS = [
+    'socket', 'socketpair', 'connect', 'bind', 'listen', 'accept', 'accept4',
+    'ptrace', 'process_vm_readv', 'process_vm_writev',
+    'mount', 'umount2', 'pivot_root', 'chroot', 'unshare', 'setns',
+    'keyctl', 'add_key', 'request_key', 'bpf', 'perf_event_open',
+    'kexec_load', 'init_module', 'finit_module', 'delete_module', 'reboot',
+]
+
+
+def _libc_call(libc, name, *args):
+    if getattr(libc, name)(*args) != 0:
+        err = ctypes.get_errno()
+        raise OSError(err, '%s: %s' % (name, os.strerror(err)))
+
+
+def _write(path, content):
+    with open(path, 'w') as f:
+        f.write(content)
+
+
+def _mount(libc, source, target, fstype, flags, data=None):
+    _libc_call(libc, 'mount',
+               source.encode() if source else None,
+               target.encode(),
+               fstype.encode() if fstype else None,
+               ctypes.c_ulong(flags),
+               data.encode() if data else None)
+
+
+def _locked_flags(path):
+    # Flags of the mount at `path` which a user namespace cannot clear on
+    # remount
+    st_flags = os.statvfs(path).f_flag
+    flags = 0
+    for st_flag, ms_flag in [(os.ST_NOSUID, MS_NOSUID),
+                             (os.ST_NODEV, MS_NODEV),
+                             (os.ST_NOEXEC, MS_NOEXEC),
+                             (os.ST_NOATIME, MS_NOATIME),
+                             (os.ST_NODIRATIME, MS_NODIRATIME),
+                             (os.ST_RELATIME, MS_RELATIME)]:
+        if st_flags & st_flag:
+            flags |= ms_flag
+    return flags
+
+
+def _bind(libc, source, target, is_writable):
+    _mount(libc, source, target, None, MS_BIND | MS_REC)
+    if not is_writable:
+        _mount(libc, None, target, None, MS_REMOUNT | MS_BIND | MS_RDONLY | _locked_flags(target))
+
+
+def _pivot_root(libc, new_root):
+    try:
+        syscall_number = _SYS_PIVOT_ROOT[platform.machine()]
+    except KeyError:
+        raise OSError(errno.ENOSYS, 'pivot_root: unsupported architecture %s' % platform.machine())
+
+    old_root = os.path.join(new_root, '.old_root')
+    os.mkdir(old_root)
+    _libc_call(libc, 'syscall', syscall_number, new_root.encode(), old_root.encode())
+    os.chdir('/')
+    _libc_call(libc, 'umount2', b'/.old_root', MNT_DETACH)
+    os.rmdir('/.old_root')
+
+
+def _isolate_namespaces(libc):
+    uid = os.getuid()
+    gid = os.getgid()
+
+    # A fresh network namespace only has a loopback interface which is down
+    _libc_call(libc, 'unshare',
+               CLONE_NEWUSER | CLONE_NEWNS | CLONE_NEWNET | CLONE_NEWIPC | CLONE_NEWUTS)
+
+    _write('/proc/self/setgroups', 'deny')
+    _write('/proc/self/uid_map', '%d %d 1' % (SANDBOX_UID, uid))
+    _write('/proc/self/gid_map', '%d %d 1' % (SANDBOX_GID, gid))
+
+
+def _isolate_filesystem(libc, root, workdir, read_only_paths):
+    # The new root is an empty tmpfs at `root` with `read_only_paths` (the
+    # python installation and system libraries), a few devices and `workdir`
+    # at SANDBOX_WORKDIR. It is made read-only, and the old root is unmounted,
+    # so nothing else of the host filesystem (e.g. the DB files and configs)
+    # is reachable.
+    _mount(libc, None, '/', None, MS_REC | MS_PRIVATE)
+    _mount(libc, 'tmpfs', root, 'tmpfs', MS_NOSUID | MS_NODEV, 'size=1m,mode=755')
+
+    for path in read_only_paths:
+        target = os.path.join(root, path.lstrip('/'))
+        if os.path.lexists(target):
+            continue
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if os.path.islink(path):
+            os.symlink(os.readlink(path), target)
+        elif os.path.isdir(path):
+            os.mkdir(target)
+            _bind(libc, path, target, is_writable=False)
+
+    os.mkdir(os.path.join(root, 'dev'))
+    for device in _DEVICES:
+        target = os.path.join(root, 'dev', device)
+        open(target, 'w').close()
+        _bind(libc, '/dev/' + device, target, is_writable=True)
+
+    target = os.path.join(root, SANDBOX_WORKDIR.lstrip('/'))
+    os.mkdir(target)
+    _bind(libc, workdir, target, is_writable=True)
+
+    _pivot_root(libc, root)
+    _mount(libc, None, '/', None, MS_REMOUNT | MS_RDONLY | MS_NOSUID | MS_NODEV)
+
+
+def _apply_seccomp(seccomp):
+    syscall_filter = seccomp.SyscallFilter(defaction=seccomp.ALLOW)
+    for syscall in _SECCOMP_DENIED_SYSCALLS:
+        try:
+            syscall_filter.add_rule(seccomp.ERRNO(errno.EPERM), syscall)
+        except (RuntimeError, ValueError):
+            pass  # not available on this architecture
+    syscall_filter.load()
+
+
+def _fail(message, e):
+    print('sandbox -- %s (%s)' % (message, e), file=sys.stderr)
+    sys.exit(ISOLATION_FAILED_EXIT_CODE)
+
+
+def main():
+    spec = json.loads(sys.argv[1])
+
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+
+    # Do not outlive the worker which spawned us
+    libc.prctl(PR_SET_PDEATHSIG, signal.SIGKILL, 0, 0, 0)
+
+    # Imported before the old root is gone
+    seccomp = None
+    if spec['seccomp']:
+        sys.path.insert(0, spec['seccomp_path'])
+        try:
+            import seccomp
+        except ImportError as e:
+            _fail('Failed to import seccomp', e)
+
+    workdir = spec['workdir']
+    if spec['namespaces']:
+        try:
+            _isolate_namespaces(libc)
+            _isolate_filesystem(libc, spec['root'], workdir, spec['read_only_paths'])
+            workdir = SANDBOX_WORKDIR
+        except OSError as e:
+            if spec['strict']:
+                _fail('Failed to isolate namespaces', e)
+
+    for name, limit in spec['rlimits'].items():
+        resource.setrlimit(getattr(resource, name), (limit, limit))
+
+    try:
+        _libc_call(libc, 'prctl', PR_SET_NO_NEW_PRIVS, 1, 0, 0, 0)
+        if seccomp is not None:
+            _apply_seccomp(seccomp)
+    except Exception as e:
+        # never run unfiltered when the backend reports a filter
+        if spec['strict'] or seccomp is not None:
+            _fail('Failed to apply seccomp filter', e)
+
+    os.chdir(workdir)
+    os.execve(spec['argv'][0], spec['argv'], dict(spec['env'], HOME=workdir))
+
+
+if __name__ == '__main__':
+    main()
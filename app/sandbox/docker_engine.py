@@ -0,0 +1,337 @@
+import asyncio
+import io
+import tarfile
+import time
+
+import docker
+import requests
+
+from app import helper, metrics, profiling
+from app.sandbox import (RUN_CODE_MAX_MEMORY, RUN_CODE_MAX_OUTPUT,
+                         RUN_CODE_MAX_TTL, Backend, SandboxUnavailable)
+
+config = helper.config
+logger = helper.logger
+
+RUN_CODE_IMAGE = 'python:3.6'
+
+_HEALTH_CHECK_TIMEOUT = 5  # sec
+
+# Errors of the Engine API or of the connection to it
+_ENGINE_ERRORS = (docker.errors.DockerException, requests.exceptions.RequestException)
+
+DOCKER_OPERATION_DURATION = metrics.Histogram('elicast_docker_operation_duration_seconds',
+                                              'Duration of Docker Engine operations of code runs',
+                                              ['operation'])
+DOCKER_HOST_IN_FLIGHT = metrics.Gauge('elicast_docker_host_in_flight',
+                                      'Code runs in flight on a Docker host',
+                                      ['host'])
+DOCKER_HOST_HEALTHY = metrics.Gauge('elicast_docker_host_healthy',
+                                    '1 if a Docker host is admitted, 0 if ejected',
+                                    ['host'])
+DOCKER_CREATE_FAILURES = metrics.Counter('elicast_docker_create_failures',
+                                         'Containers failed to be created on a Docker host',
+                                         ['host'])
+
+
+def _code_archive(code):
+    # /codefile.py as a tar archive for put_archive. The code is copied into
+    # the container, so the Docker host does not need to share a filesystem
+    # with the server.
+    data = code.encode('utf-8')
+
+    info = tarfile.TarInfo('codefile.py')
+    info.size = len(data)
+    info.mode = 0o444
+    info.mtime = int(time.time())
+
+    archive = io.BytesIO()
+    with tarfile.open(fileobj=archive, mode='w') as tar:
+        tar.addfile(info, io.BytesIO(data))
+    return archive.getvalue()
+
+
+class DockerHost:
+
+    def __init__(self, uri):
+        self.uri = uri
+        self.client = docker.DockerClient(base_url=uri)
+        self.health_client = docker.DockerClient(base_url=uri, timeout=_HEALTH_CHECK_TIMEOUT)
+
+        self.is_healthy = True
+        self.failures = 0  # in a row
+        self.successes = 0  # health checks in a row while ejected
+
+        # Unknown until the first health check, then the run memory of the
+        # in-flight runs is reserved against it
+        self.mem_total = None
+        self.ncpu = None
+        self.in_flight = 0
+        self.reserved_memory = 0
+
+        self.runs = 0
+        self.create_failures = 0
+        self.ejections = 0
+
+        DOCKER_HOST_IN_FLIGHT.labels(uri).set_function(lambda: self.in_flight)
+        DOCKER_HOST_HEALTHY.labels(uri).set_function(lambda: int(self.is_healthy))
+
+    def can_reserve(self, memory, memory_overcommit):
+        if self.mem_total is None:
+            return True
+        return self.reserved_memory + memory <= self.mem_total * memory_overcommit
+
+    def load(self):
+        memory_load = self.reserved_memory / self.mem_total if self.mem_total else 0
+        return memory_load, self.in_flight
+
+    def stats(self):
+        return {
+            'uri': self.uri,
+            'is_healthy': self.is_healthy,
+            'failures': self.failures,
+            'mem_total': self.mem_total,
+            'ncpu': self.ncpu,
+            'in_flight': self.in_flight,
+            'reserved_memory': self.reserved_memory,
+            'runs': self.runs,
+            'create_failures': self.create_failures,
+            'ejections': self.ejections,
+        }
+
+    def close(self):
+        self.client.close()
+        self.health_client.close()
+
+
+class DockerBackend(Backend):
+    # Runs every code in a new container on one of `uris`. A run is placed on
+    # the least loaded admitted host which has RUN_CODE_MAX_MEMORY left, or
+    # waits for one. A host is ejected after `eject_failures` failed container
+    # creations or health checks in a row, and admitted again after
+    # `readmit_successes` health checks in a row. When a container cannot be
+    # created, the run is retried on another host.
+    name = 'docker'
+
+    def __init__(self, executor, uris, health_check_interval, eject_failures,
+                 readmit_successes, memory_overcommit):
+        super().__init__(executor)
+
+        self.hosts = [DockerHost(uri) for uri in uris]
+        self.health_check_interval = health_check_interval
+        self.eject_failures = eject_failures
+        self.readmit_successes = readmit_successes
+        self.memory_overcommit = memory_overcommit
+
+        self._available = None
+        self._health_check_task = None
+
+    async def start(self):
+        self._available = asyncio.Condition()
+        self._health_check_task = asyncio.ensure_future(self._check_health_forever())
+
+    async def _acquire(self, excluded_hosts):
+        async with self._available:
+            while True:
+                hosts = [host for host in self.hosts if host.is_healthy and host not in excluded_hosts]
+                if not hosts:
+                    raise SandboxUnavailable('No available docker host')
+
+                hosts = [host for host in hosts if host.can_reserve(RUN_CODE_MAX_MEMORY, self.memory_overcommit)]
+                if hosts:
+                    host = min(hosts, key=lambda host: host.load())
+                    host.in_flight += 1
+                    host.reserved_memory += RUN_CODE_MAX_MEMORY
+                    return host
+
+                try:
+                    await asyncio.wait_for(self._available.wait(), timeout=RUN_CODE_MAX_TTL)
+                except asyncio.TimeoutError:
+                    raise SandboxUnavailable('Every docker host is full')
+
+    async def _release(self, host):
+        async with self._available:
+            host.in_flight -= 1
+            host.reserved_memory -= RUN_CODE_MAX_MEMORY
+            self._available.notify_all()
+
+    async def _set_healthy(self, host, is_healthy):
+        # changed before waiting for the lock, so that concurrent failures
+        # eject the host only once
+        host.is_healthy = is_healthy
+        host.failures = 0
+        host.successes = 0
+        async with self._available:
+            # waiting runs may be placed on it, or have nowhere to go
+            self._available.notify_all()
+
+    async def _record_failure(self, host):
+        host.failures += 1
+        if host.is_healthy and host.failures >= self.eject_failures:
+            logger.warn('Docker host %s ejected after %d failures', host.uri, host.failures)
+            host.ejections += 1
+            await self._set_healthy(host, False)
+
+    def _create_container(self, host, code):
+        kwargs = dict(
+            command='python -u /codefile.py',
+            log_config={
+                'type': 'json-file',
+                'config': {
+                    'max-size': str(RUN_CODE_MAX_OUTPUT)
+                }
+            },
+            mem_limit=RUN_CODE_MAX_MEMORY,
+            network='none',
+        )
+
+        try:
+            container = host.client.containers.create(RUN_CODE_IMAGE, **kwargs)
+        except docker.errors.ImageNotFound:
+            host.client.images.pull(RUN_CODE_IMAGE)
+            container = host.client.containers.create(RUN_CODE_IMAGE, **kwargs)
+
+        try:
+            container.put_archive('/', _code_archive(code))
+            container.start()
+        except BaseException:
+            container.remove(force=True)
+            raise
+
+        return container
+
+    async def run(self, code):
+        loop = asyncio.get_event_loop()
+
+        tried_hosts = []
+        while True:
+            host = await self._acquire(tried_hosts)
+            try:
+                try:
+                    with DOCKER_OPERATION_DURATION.labels('create').time(), \
+                            profiling.span('subprocess', 'docker_create'):
+                        container = await loop.run_in_executor(self.executor, self._create_container, host, code)
+                except _ENGINE_ERRORS as e:
+                    logger.warn('Failed to create a container on docker host %s: %s', host.uri, e)
+                    host.create_failures += 1
+                    DOCKER_CREATE_FAILURES.labels(host.uri).inc()
+                    await self._record_failure(host)
+                    tried_hosts.append(host)
+                    continue
+
+                host.failures = 0
+                host.runs += 1
+                try:
+                    return await self._run_container(container)
+                except _ENGINE_ERRORS as e:
+                    # the code may have run, so it is not retried
+                    logger.warn('Lost docker host %s during a run: %s', host.uri, e)
+                    await self._record_failure(host)
+                    raise SandboxUnavailable('Lost docker host during a run')
+            finally:
+                await self._release(host)
+
+    async def _run_container(self, container):
+        container_output = ''
+        container_exit_code = -1
+
+        try:
+            loop = asyncio.get_event_loop()
+
+            wait_started_at = time.perf_counter()
+            try:
+                is_timeout = False
+                with profiling.span('subprocess', 'docker_wait'):
+                    container_exit_code = (await asyncio.wait_for(
+                        loop.run_in_executor(self.executor, container.wait),
+                        timeout=RUN_CODE_MAX_TTL
+                    ))['StatusCode']
+            except asyncio.TimeoutError:
+                logger.warn('Code run TIMEOUT')
+                is_timeout = True
+                container_exit_code = -1
+            DOCKER_OPERATION_DURATION.labels('wait').observe(time.perf_counter() - wait_started_at)
+
+            container_output = (await loop.run_in_executor(self.executor, container.logs)).decode('utf-8', 'replace')
+
+            if is_timeout:
+                container_output += '\n<TIMEOUT>'
+
+        finally:
+            with DOCKER_OPERATION_DURATION.labels('remove').time(), profiling.span('subprocess', 'docker_remove'):
+                try:
+                    await loop.run_in_executor(self.executor, lambda: container.remove(force=True))
+                except _ENGINE_ERRORS as e:
+                    logger.warn('Failed to remove container %s: %s', container.id, e)
+
+        return container_output, container_exit_code
+
+    def _ping(self, host):
+        host.health_client.ping()
+        return host.health_client.info()
+
+    async def check_health(self):
+        loop = asyncio.get_event_loop()
+
+        results = await asyncio.gather(*[loop.run_in_executor(self.executor, self._ping, host)
+                                         for host in self.hosts],
+                                       return_exceptions=True)
+
+        for host, result in zip(self.hosts, results):
+            if isinstance(result, Exception):
+                if host.is_healthy:
+                    logger.warn('Health check of docker host %s failed: %s', host.uri, result)
+                    await self._record_failure(host)
+                else:
+                    host.successes = 0
+                continue
+
+            host.mem_total = result.get('MemTotal') or None
+            host.ncpu = result.get('NCPU')
+
+            if host.is_healthy:
+                host.failures = 0
+            else:
+                host.successes += 1
+                if host.successes >= self.readmit_successes:
+                    logger.info('Docker host %s admitted again', host.uri)
+                    await self._set_healthy(host, True)
+
+        async with self._available:
+            # memory of the hosts may have changed
+            self._available.notify_all()
+
+    async def _check_health_forever(self):
+        while True:
+            try:
+                await self.check_health()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception('Failed to check health of docker hosts')
+            await asyncio.sleep(self.health_check_interval)
+
+    def stats(self):
+        return {
+            'hosts': [host.stats() for host in self.hosts],
+        }
+
+    def close(self):
+        if self._health_check_task is not None:
+            self._health_check_task.cancel()
+            self._health_check_task = None
+        for host in self.hosts:
+            host.close()
+
+
+def create_backend(executor):
+    uris = config.DOCKER_URI
+    if isinstance(uris, str):
+        uris = [uris]
+
+    return DockerBackend(executor,
+                         uris,
+                         health_check_interval=config.DOCKER_HEALTH_CHECK_INTERVAL,
+                         eject_failures=config.DOCKER_EJECT_FAILURES,
+                         readmit_successes=config.DOCKER_READMIT_SUCCESSES,
+                         memory_overcommit=config.DOCKER_MEMORY_OVERCOMMIT)
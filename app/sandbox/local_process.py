@@ -0,0 +1,180 @@
+import asyncio
+import importlib.util
+import json
+import os
+import os.path
+import signal
+import subprocess
+import sys
+import tempfile
+
+from app import helper, profiling
+from app.sandbox import (RUN_CODE_MAX_MEMORY, RUN_CODE_MAX_OUTPUT,
+                         RUN_CODE_MAX_TTL, Backend)
+from app.sandbox import _launcher
+
+config = helper.config
+logger = helper.logger
+
+_LAUNCHER_PATH = os.path.abspath(_launcher.__file__)
+
+_ENV_PATH = '/usr/local/bin:/usr/bin:/bin'
+
+# Mounted read-only in the new root of a run, with the installation of the
+# python running the code
+_READ_ONLY_PATHS = ['/usr', '/bin', '/sbin', '/lib', '/lib32', '/lib64', '/libx32', '/etc/alternatives']
+
+
+def _find_seccomp_path():
+    # Directory to import the seccomp module from in the launcher, or None
+    spec = importlib.util.find_spec('seccomp')
+    if spec is None or spec.origin is None:
+        return None
+    return os.path.dirname(spec.origin)
+
+
+def _kill_process_group(pid):
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+class LocalProcessBackend(Backend):
+    name = 'local'
+
+    def __init__(self, executor, python_path, tmpfs_dir, max_processes,
+                 require_isolation):
+        super().__init__(executor)
+
+        if not os.access(python_path, os.X_OK):
+            raise Exception('Cannot execute python for local sandbox', python_path)
+
+        # the link may be outside the read-only paths
+        self.python_path = os.path.realpath(python_path)
+        self.tmpfs_dir = tmpfs_dir if os.path.isdir(tmpfs_dir) else None
+        self.max_processes = max_processes
+        self.require_isolation = require_isolation
+
+        self.seccomp_path = _find_seccomp_path()
+        self.seccomp = self.seccomp_path is not None
+
+        python_prefix = os.path.dirname(os.path.dirname(self.python_path))
+        self.read_only_paths = _READ_ONLY_PATHS + [python_prefix]
+
+        self.namespaces = self._probe_namespaces()
+
+        if not self.namespaces:
+            logger.warn('Local sandbox runs WITHOUT namespace (network and filesystem) isolation')
+        if not self.seccomp:
+            logger.warn('Local sandbox runs WITHOUT seccomp filter (python seccomp module is not installed)')
+
+    def _spec(self, rundir, argv, namespaces, strict):
+        # `rundir` has an empty `root` directory for the new root and the
+        # working directory `work`. `argv` is run in the working directory.
+        root = os.path.join(rundir, 'root')
+        workdir = os.path.join(rundir, 'work')
+        os.mkdir(root)
+        os.mkdir(workdir)
+
+        return {
+            'namespaces': namespaces,
+            'seccomp': self.seccomp,
+            'seccomp_path': self.seccomp_path,
+            'strict': strict,
+            'root': root,
+            'read_only_paths': self.read_only_paths,
+            'rlimits': {
+                'RLIMIT_CPU': RUN_CODE_MAX_TTL,
+                'RLIMIT_AS': RUN_CODE_MAX_MEMORY,
+                'RLIMIT_FSIZE': RUN_CODE_MAX_OUTPUT,
+                'RLIMIT_NPROC': self.max_processes,
+                'RLIMIT_CORE': 0,
+            },
+            'workdir': workdir,
+            'argv': argv,
+            'env': {
+                'PATH': _ENV_PATH,
+                'LANG': 'C.UTF-8',
+            },
+        }
+
+    def _launcher_command(self, spec):
+        return [sys.executable, '-I', '-S', _LAUNCHER_PATH, json.dumps(spec)]
+
+    def _probe_namespaces(self):
+        with tempfile.TemporaryDirectory(dir=self.tmpfs_dir) as rundir:
+            spec = self._spec(rundir, [self.python_path, '-c', 'pass'],
+                              namespaces=True, strict=True)
+            probe = subprocess.run(self._launcher_command(spec),
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT,
+                                   timeout=30)
+
+        if probe.returncode == 0:
+            return True
+
+        message = probe.stdout.decode('utf-8', 'replace').strip()
+        if self.require_isolation:
+            raise Exception('Local sandbox cannot isolate the code', message)
+
+        logger.debug(message)
+        return False
+
+    async def run(self, code):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, self._run, code)
+
+    def _run(self, code):
+        with tempfile.TemporaryDirectory(prefix='elicast-run-', dir=self.tmpfs_dir) as rundir, \
+                tempfile.TemporaryFile(dir=self.tmpfs_dir) as output_f:
+            spec = self._spec(rundir, [self.python_path, '-u', '-I', 'codefile.py'],
+                              namespaces=self.namespaces,
+                              strict=self.require_isolation)
+
+            with open(os.path.join(spec['workdir'], 'codefile.py'), 'wb') as codefile:
+                codefile.write(code.encode('utf-8'))
+
+            # The output file shares RLIMIT_FSIZE, so a flood of output is cut
+            # off by SIGXFSZ instead of filling the memory of the worker
+            process = subprocess.Popen(self._launcher_command(spec),
+                                       stdin=subprocess.DEVNULL,
+                                       stdout=output_f,
+                                       stderr=subprocess.STDOUT,
+                                       start_new_session=True)
+
+            is_timeout = False
+            try:
+                with profiling.span('subprocess', 'local_run'):
+                    exit_code = process.wait(timeout=RUN_CODE_MAX_TTL)
+            except subprocess.TimeoutExpired:
+                logger.warn('Code run TIMEOUT')
+                is_timeout = True
+                _kill_process_group(process.pid)
+                process.wait()
+                exit_code = -1
+            else:
+                # Mimic the exit status reported by docker for signals
+                if exit_code < 0:
+                    exit_code = 128 - exit_code
+            finally:
+                # Clean up any process the code has left behind
+                _kill_process_group(process.pid)
+
+            output_f.seek(0)
+            output = output_f.read(RUN_CODE_MAX_OUTPUT).decode('utf-8', 'replace')
+
+            if is_timeout:
+                output += '\n<TIMEOUT>'
+
+        return output, exit_code
+
+
+def create_backend(executor):
+    return LocalProcessBackend(
+        executor,
+        python_path=config.RUN_CODE_LOCAL_PYTHON,
+        tmpfs_dir=config.RUN_CODE_LOCAL_TMPFS,
+        max_processes=config.RUN_CODE_LOCAL_MAX_PROCESSES,
+        require_isolation=config.RUN_CODE_LOCAL_REQUIRE_ISOLATION
+    )
@@ -0,0 +1,195 @@
+import json
+import re
+import sqlite3
+
+import sqlalchemy as sa
+from sqlalchemy.orm import sessionmaker
+
+from app import helper
+from app import models as m
+
+logger = helper.logger
+
+TABLE_NAME = 'elicast_search'
+
+# Everything a search result needs is kept in the index, so searching never
+# reads rows of `elicast` (and their large ots and voice_blobs columns).
+# rowid is elicast.id; deleted elicasts are removed from the index.
+_CREATE_TABLE = '''
+CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5(
+    title,
+    code,
+    teacher UNINDEXED,
+    created UNINDEXED,
+    is_protected UNINDEXED,
+    tokenize = 'unicode61'
+)
+''' % TABLE_NAME
+
+# bm25 weights of title and code
+_TITLE_WEIGHT = 10.0
+_CODE_WEIGHT = 1.0
+
+_SNIPPET_TOKENS = 12
+
+_TERM_PATTERN = re.compile(r'\w+', re.UNICODE)
+
+
+def final_code(ots):
+    # Code at the end of the recording. Text changes ({fromPos, toPos,
+    # insertedText}) are applied in order; other OTs (selections, runs, ...)
+    # do not change the code.
+    code = ''
+    for ot in ots:
+        if not isinstance(ot, dict):
+            continue
+
+        inserted_text = ot.get('insertedText')
+        from_pos = ot.get('fromPos')
+        to_pos = ot.get('toPos')
+        if not isinstance(inserted_text, str) or not isinstance(from_pos, int) or not isinstance(to_pos, int):
+            continue
+
+        from_pos = max(0, min(from_pos, len(code)))
+        to_pos = max(from_pos, min(to_pos, len(code)))
+        code = code[:from_pos] + inserted_text + code[to_pos:]
+    return code
+
+
+def final_code_of_json(ots_str):
+    return final_code(json.loads(ots_str))
+
+
+def match_query(q):
+    # FTS5 query of the words of `q`, all of which have to match; the last
+    # one may be a prefix (search as you type). Returns None if `q` has no
+    # words. Words are quoted, so `q` cannot use the FTS5 query syntax.
+    terms = _TERM_PATTERN.findall(q)
+    if not terms:
+        return None
+    return ' '.join('"%s"' % term for term in terms) + '*'
+
+
+def is_supported(engine):
+    if not engine.url.drivername.startswith('sqlite'):
+        return False
+
+    connection = sqlite3.connect(':memory:')
+    try:
+        connection.execute('CREATE VIRTUAL TABLE t USING fts5(a)')
+        return True
+    except sqlite3.OperationalError:
+        return False
+    finally:
+        connection.close()
+
+
+def create_index(engine):
+    # Creates the index if it does not exist, and fills it with the existing
+    # elicasts. Returns the number of indexed elicasts, or None if the index
+    # existed. Elicasts saved by other workers meanwhile are indexed by them,
+    # as the fill is one transaction.
+    with engine.begin() as connection:
+        is_exist = connection.execute(
+            sa.text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+            name=TABLE_NAME
+        ).first() is not None
+        if is_exist:
+            return None
+
+        connection.execute(sa.text(_CREATE_TABLE))
+
+    return rebuild(engine)
+
+
+def index_elicast(session, elicast_id, title, code, teacher, created, is_protected):
+    remove_elicast(session, elicast_id)
+    session.execute(
+        sa.text('INSERT INTO %s (rowid, title, code, teacher, created, is_protected) '
+                'VALUES (:id, :title, :code, :teacher, :created, :is_protected)' % TABLE_NAME),
+        {
+            'id': elicast_id,
+            'title': title,
+            'code': code,
+            'teacher': teacher,
+            'created': created,
+            'is_protected': int(is_protected),
+        }
+    )
+
+
+def remove_elicast(session, elicast_id):
+    session.execute(sa.text('DELETE FROM %s WHERE rowid = :id' % TABLE_NAME), {'id': elicast_id})
+
+
+def search(session, query, teacher, page, count):
+    # Best matches first: bm25 with titles weighted over code
+    sql = ('SELECT rowid AS id, title, teacher, created, is_protected, '
+           "snippet(%s, 1, '[', ']', '...', %d) AS snippet "
+           'FROM %s WHERE %s MATCH :query' % (TABLE_NAME, _SNIPPET_TOKENS, TABLE_NAME, TABLE_NAME))
+    params = {
+        'query': query,
+        'limit': count,
+        'offset': count * page,
+    }
+    if teacher is not None:
+        sql += ' AND teacher = :teacher'
+        params['teacher'] = teacher
+    sql += ' ORDER BY bm25(%s, %r, %r), created DESC LIMIT :limit OFFSET :offset' % (
+        TABLE_NAME, _TITLE_WEIGHT, _CODE_WEIGHT)
+
+    return [{
+        'id': row.id,
+        'created': row.created,
+        'title': row.title,
+        'teacher': row.teacher,
+        'is_protected': bool(row.is_protected),
+        'snippet': row.snippet,
+    } for row in session.execute(sa.text(sql), params)]
+
+
+def rebuild(engine):
+    # Replaces the whole index with the non-deleted elicasts. Returns the
+    # number of indexed elicasts.
+    with engine.begin() as connection:
+        connection.execute(sa.text(_CREATE_TABLE))
+
+    session = sessionmaker(bind=engine)()
+    try:
+        session.execute(sa.text('DELETE FROM %s' % TABLE_NAME))
+
+        elicast_ids = [
+            row.id
+            for row in session
+            .query(m.Elicast.id)
+            .filter(~m.Elicast.is_deleted)
+        ]
+
+        for elicast_id in elicast_ids:
+            # voice_blobs is never loaded
+            elicast = session \
+                .query(m.Elicast.title,
+                       m.Elicast.ots,
+                       m.Elicast.teacher,
+                       m.Elicast.created,
+                       m.Elicast.is_protected) \
+                .filter(m.Elicast.id == elicast_id) \
+                .first()
+
+            try:
+                code = final_code_of_json(elicast.ots)
+            except ValueError:
+                logger.warn('Invalid ots of elicast %d, only its title is indexed', elicast_id)
+                code = ''
+
+            index_elicast(session, elicast_id, elicast.title, code,
+                          elicast.teacher, elicast.created, elicast.is_protected)
+
+        session.commit()
+    except BaseException:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+    return len(elicast_ids)
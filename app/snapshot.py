@@ -0,0 +1,175 @@
+import base64
+import collections
+import json
+import mmap
+import os
+import os.path
+import struct
+
+from sqlalchemy.orm import sessionmaker
+
+from app import models as m
+from app.elicast_json import elicast_json_body, elicast_summary
+
+# A snapshot is an immutable file of every non-deleted elicast, built by
+# `manage.py build-snapshot` and memory-mapped by every worker process:
+#
+#   header | data (JSON bodies, raw voice chunks, list items) | index (JSON)
+#
+# The header is MAGIC, format version, offset and length of the index.
+MAGIC = b'ELICSNAP'
+VERSION = 1
+_HEADER = struct.Struct('<8sIQQ')
+
+_LIST_PREFIX = b'{"elicasts": ['
+_LIST_SUFFIX = b']}'
+_LIST_SEPARATOR = b', '
+
+
+class Snapshot:
+
+    def __init__(self, path):
+        self.path = path
+
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._mmap)
+
+        magic, version, index_offset, index_length = _HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('Invalid snapshot file', path)
+
+        index = json.loads(self._view[index_offset:index_offset + index_length].tobytes().decode('utf-8'))
+
+        self.created = index['created']
+        self._elicasts = {int(elicast_id): entry for elicast_id, entry in index['elicasts'].items()}
+        self._lists = {teacher: items for teacher, items in index['lists']}
+
+    def _slice(self, offset, length):
+        return self._view[offset:offset + length]
+
+    def elicast_count(self):
+        return len(self._elicasts)
+
+    def get_body(self, elicast_id):
+        # Returns the response body of GET /elicast/{id}, or None
+        entry = self._elicasts.get(int(elicast_id))
+        if entry is None:
+            return None
+        return self._slice(*entry['body'])
+
+    def get_voice_chunk(self, elicast_id, chunk_idx):
+        # Returns (is_elicast_exist, raw audio of the chunk or None)
+        entry = self._elicasts.get(int(elicast_id))
+        if entry is None:
+            return False, None
+        if not 0 <= chunk_idx < len(entry['voice']):
+            return True, None
+        return True, self._slice(*entry['voice'][chunk_idx])
+
+    def list_body(self, teacher, page, count):
+        # Returns the chunks of the response body of GET /elicast, to be
+        # written in order. Items of a teacher are stored next to each other,
+        # so a page is one slice of the file, which is not copied.
+        items = self._lists.get(teacher, [])[count * page:count * (page + 1)]
+        if not items:
+            return [_LIST_PREFIX + _LIST_SUFFIX]
+
+        start = items[0][0]
+        end = items[-1][0] + items[-1][1]
+        return [_LIST_PREFIX, self._view[start:end], _LIST_SUFFIX]
+
+    def close(self):
+        try:
+            self._view.release()
+            self._mmap.close()
+        except BufferError:
+            pass  # a slice is still being sent; unmapped when it is released
+
+
+class _Writer:
+
+    def __init__(self, f):
+        self.f = f
+        self.offset = f.tell()
+
+    def write(self, data):
+        offset = self.offset
+        self.f.write(data)
+        self.offset += len(data)
+        return [offset, len(data)]
+
+
+def _decode_voice_blobs(voice_blobs_str):
+    return [base64.b64decode(voice_blob.split(',', 1)[1])
+            for voice_blob in json.loads(voice_blobs_str)]
+
+
+def build(engine, path):
+    # Writes the snapshot to a temporary file which replaces `path` when
+    # completed, so running servers keep their mapping of the old file
+    session = sessionmaker(bind=engine)()
+
+    elicast_ids = [
+        row.id
+        for row in session
+        .query(m.Elicast.id)
+        .filter(~m.Elicast.is_deleted)
+        .order_by(m.Elicast.created.desc(), m.Elicast.id.desc())
+    ]
+
+    tmp_path = path + '.tmp'
+    elicasts = {}
+    summaries = collections.OrderedDict()
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(b'\0' * _HEADER.size)
+            writer = _Writer(f)
+
+            for elicast_id in elicast_ids:
+                elicast = session.query(m.Elicast).get(elicast_id)
+
+                elicasts[str(elicast_id)] = {
+                    'body': writer.write(elicast_json_body(elicast)),
+                    'voice': [writer.write(chunk) for chunk in _decode_voice_blobs(elicast.voice_blobs)],
+                }
+                summaries.setdefault(elicast.teacher, []).append(
+                    json.dumps(elicast_summary(elicast)).encode('utf-8')
+                )
+
+                # voice blobs can be large, so do not keep them in the session
+                session.expunge_all()
+
+            lists = []
+            for teacher, teacher_summaries in summaries.items():
+                items = []
+                for idx, summary in enumerate(teacher_summaries):
+                    if idx > 0:
+                        writer.write(_LIST_SEPARATOR)
+                    items.append(writer.write(summary))
+                lists.append([teacher, items])
+
+            index = json.dumps({
+                'created': m.now_timestamp(),
+                'elicasts': elicasts,
+                'lists': lists,
+            }).encode('utf-8')
+            index_offset, index_length = writer.write(index)
+
+            f.seek(0)
+            f.write(_HEADER.pack(MAGIC, VERSION, index_offset, index_length))
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    finally:
+        session.close()
+
+    return {
+        'elicasts': len(elicasts),
+        'size': os.path.getsize(path),
+    }
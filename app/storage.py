@@ -0,0 +1,249 @@
+import asyncio
+import fcntl
+import os.path
+import sqlite3
+import threading
+import time
+import urllib.parse
+
+import sqlalchemy as sa
+from sqlalchemy import event
+
+from app import helper, metrics
+
+logger = helper.logger
+
+# auto_vacuum has to be set before journal_mode, as the latter initializes a new DB file
+_PRAGMA_ORDER = ['auto_vacuum', 'journal_mode', 'synchronous', 'busy_timeout', 'mmap_size', 'cache_size']
+
+# Pragmas which can be applied to a read-only connection
+_READONLY_PRAGMAS = ['busy_timeout', 'mmap_size', 'cache_size']
+
+_WRITE_STATEMENT_PREFIXES = ('INSERT', 'UPDATE', 'DELETE', 'REPLACE')
+
+DB_STATEMENT_DURATION = metrics.Histogram('elicast_db_statement_duration_seconds',
+                                          'Duration of sqlite statements, including waits for locks',
+                                          ['kind'])
+
+
+class StorageStats:
+    # Counters of a sqlite DB, updated from any thread. sqlite waits for locks
+    # (up to busy_timeout) inside the statement which needs it, so the time of
+    # write statements includes the time spent waiting for the write lock.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = {
+            'read_statements': _new_timing(),
+            'write_statements': _new_timing(),
+            'lock_timeouts': 0,
+            'checkpoints': _new_timing(),
+            'last_checkpoint': None,
+            'incremental_vacuums': _new_timing(),
+            'vacuumed_pages': 0,
+        }
+
+    def record(self, name, duration):
+        with self._lock:
+            timing = self._stats[name]
+            timing['count'] += 1
+            timing['time'] += duration
+            timing['max_time'] = max(timing['max_time'], duration)
+
+    def update(self, name, value):
+        with self._lock:
+            self._stats[name] = value
+
+    def increase(self, name, value=1):
+        with self._lock:
+            self._stats[name] += value
+
+    def stats(self):
+        with self._lock:
+            return {k: dict(v) if isinstance(v, dict) else v for k, v in self._stats.items()}
+
+
+def _new_timing():
+    return {'count': 0, 'time': 0.0, 'max_time': 0.0}
+
+
+def sqlite_path(db_uri):
+    url = sa.engine.url.make_url(db_uri)
+    if not url.drivername.startswith('sqlite') or not url.database or url.database == ':memory:':
+        return None
+    return os.path.abspath(url.database)
+
+
+def _apply_pragmas(dbapi_connection, profile, names):
+    cursor = dbapi_connection.cursor()
+    try:
+        for name in names:
+            if name in profile:
+                cursor.execute('PRAGMA %s = %s' % (name, profile[name]))
+    finally:
+        cursor.close()
+
+
+def _instrument(engine, stats):
+    @event.listens_for(engine, 'before_cursor_execute')
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        duration = time.perf_counter() - conn.info['query_start_time'].pop()
+        if statement.lstrip()[:7].upper().startswith(_WRITE_STATEMENT_PREFIXES):
+            kind = 'write'
+        else:
+            kind = 'read'
+        stats.record(kind + '_statements', duration)
+        DB_STATEMENT_DURATION.labels(kind).observe(duration)
+
+    @event.listens_for(engine, 'handle_error')
+    def _handle_error(context):
+        start_times = context.connection.info.get('query_start_time') if context.connection else None
+        if start_times:
+            start_times.pop()
+        if isinstance(context.original_exception, sqlite3.OperationalError) \
+                and 'locked' in str(context.original_exception):
+            stats.increase('lock_timeouts')
+
+
+def create_engine(db_uri, profile, stats=None):
+    # `profile` is a dict of sqlite pragmas, applied to every new connection
+    engine = sa.create_engine(db_uri)
+
+    if profile and sqlite_path(db_uri) is not None:
+        @event.listens_for(engine, 'connect')
+        def _connect(dbapi_connection, connection_record):
+            _apply_pragmas(dbapi_connection, profile, _PRAGMA_ORDER)
+
+    if stats is not None:
+        _instrument(engine, stats)
+
+    return engine
+
+
+def readonly_uri(path):
+    return 'file:%s?mode=ro' % urllib.parse.quote(path)
+
+
+def create_readonly_engine(db_uri, profile, attachments=None):
+    # `attachments` is a dict of schema name -> path of sqlite DB, attached
+    # read-only to every connection
+    path = sqlite_path(db_uri)
+    if path is None:
+        return sa.create_engine(db_uri)
+
+    def _connect():
+        dbapi_connection = sqlite3.connect(readonly_uri(path), uri=True)
+        if profile:
+            _apply_pragmas(dbapi_connection, profile, _READONLY_PRAGMAS)
+        for schema, attachment_path in (attachments or {}).items():
+            dbapi_connection.execute('ATTACH DATABASE ? AS %s' % schema,
+                                     (readonly_uri(attachment_path),))
+        return dbapi_connection
+
+    return sa.create_engine('sqlite://', creator=_connect, poolclass=sa.pool.NullPool)
+
+
+def check_profile(engine, profile):
+    if not profile or 'auto_vacuum' not in profile or engine.dialect.name != 'sqlite':
+        return
+
+    auto_vacuum_modes = {'NONE': 0, 'FULL': 1, 'INCREMENTAL': 2}
+    expected = auto_vacuum_modes.get(str(profile['auto_vacuum']).upper(), profile['auto_vacuum'])
+    with engine.connect() as conn:
+        current = conn.execute('PRAGMA auto_vacuum').scalar()
+
+    if current != expected:
+        logger.warn('auto_vacuum of the DB is %s (not %s). Run VACUUM on the DB to change it.',
+                    current, profile['auto_vacuum'])
+
+
+class StorageMaintenance:
+    # Runs WAL checkpoints and incremental vacuums of a sqlite DB in the
+    # background. With several worker processes, only the one holding the
+    # lock file runs a round.
+
+    def __init__(self, engine, db, stats, interval, vacuum_pages):
+        self.engine = engine
+        self.db = db
+        self.stats = stats
+        self.interval = interval
+        self.vacuum_pages = vacuum_pages
+
+        self._lock_path = None
+        self._task = None
+
+    def start(self):
+        path = sqlite_path(self.engine.url)
+        if path is None or not self.interval:
+            return
+
+        self._lock_path = path + '.maintenance.lock'
+        self._task = asyncio.ensure_future(self._run_periodically())
+
+    async def stop(self):
+        if self._task is None:
+            return
+
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run_periodically(self):
+        while True:
+            await asyncio.sleep(self.interval)
+
+            try:
+                await self.db.run_sync(self.run_once)
+            except Exception:
+                logger.exception('Failed to run DB maintenance')
+
+    def run_once(self):
+        with open(self._lock_path, 'a') as lock_f:
+            try:
+                fcntl.flock(lock_f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return  # another worker is on it
+
+            try:
+                with self.engine.connect() as conn:
+                    self._checkpoint(conn)
+                    self._incremental_vacuum(conn)
+            finally:
+                fcntl.flock(lock_f, fcntl.LOCK_UN)
+
+    def _checkpoint(self, conn):
+        started_at = time.perf_counter()
+        busy, log_frames, checkpointed_frames = conn.execute('PRAGMA wal_checkpoint(PASSIVE)').first()
+        duration = time.perf_counter() - started_at
+
+        self.stats.record('checkpoints', duration)
+        self.stats.update('last_checkpoint', {
+            'time': duration,
+            'busy': busy,
+            'log_frames': log_frames,
+            'checkpointed_frames': checkpointed_frames,
+        })
+
+    def _incremental_vacuum(self, conn):
+        if not self.vacuum_pages or conn.execute('PRAGMA auto_vacuum').scalar() != 2:
+            return
+
+        freelist_count = conn.execute('PRAGMA freelist_count').scalar()
+        if not freelist_count:
+            return
+
+        started_at = time.perf_counter()
+        # Every page is freed by a step of the statement, while execute() only
+        # steps once for a statement without result rows
+        conn.connection.executescript('PRAGMA incremental_vacuum(%d);' % self.vacuum_pages)
+        duration = time.perf_counter() - started_at
+
+        self.stats.record('incremental_vacuums', duration)
+        self.stats.increase('vacuumed_pages', freelist_count - conn.execute('PRAGMA freelist_count').scalar())
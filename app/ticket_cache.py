@@ -0,0 +1,103 @@
+import collections
+import time
+
+from app import models as m
+
+
+class TicketCache:
+    # Bounded LRU of ticket -> log_ticket.id. Tickets are immutable once
+    # issued, so cached ids never go stale. Unknown tickets are cached in a
+    # separate LRU, so a flood of bogus tickets neither hits the DB nor
+    # evicts valid tickets. They expire after `negative_ttl` seconds, since a
+    # ticket issued by another worker may be unknown to this one for a moment.
+
+    def __init__(self, max_size, negative_max_size, negative_ttl):
+        self.max_size = max_size
+        self.negative_max_size = negative_max_size
+        self.negative_ttl = negative_ttl
+
+        self.hit_count = 0
+        self.negative_hit_count = 0
+        self.miss_count = 0
+        self.eviction_count = 0
+
+        self._entries = collections.OrderedDict()
+        self._negative_entries = collections.OrderedDict()
+
+    def get(self, ticket):
+        # Returns (is_cached, log_ticket_id). log_ticket_id is None for an unknown ticket.
+        try:
+            log_ticket_id = self._entries[ticket]
+        except KeyError:
+            pass
+        else:
+            self._entries.move_to_end(ticket)
+            self.hit_count += 1
+            return True, log_ticket_id
+
+        expire_at = self._negative_entries.get(ticket)
+        if expire_at is not None:
+            if expire_at > time.monotonic():
+                self.negative_hit_count += 1
+                return True, None
+            del self._negative_entries[ticket]
+
+        self.miss_count += 1
+        return False, None
+
+    def put(self, ticket, log_ticket_id):
+        self._negative_entries.pop(ticket, None)
+
+        self._entries[ticket] = log_ticket_id
+        self._entries.move_to_end(ticket)
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.eviction_count += 1
+
+    def put_unknown(self, ticket):
+        self._negative_entries[ticket] = time.monotonic() + self.negative_ttl
+        self._negative_entries.move_to_end(ticket)
+        if len(self._negative_entries) > self.negative_max_size:
+            self._negative_entries.popitem(last=False)
+
+    def stats(self):
+        lookup_count = self.hit_count + self.negative_hit_count + self.miss_count
+        return {
+            'size': len(self._entries),
+            'negative_size': len(self._negative_entries),
+            'hits': self.hit_count,
+            'negative_hits': self.negative_hit_count,
+            'misses': self.miss_count,
+            'evictions': self.eviction_count,
+            'hit_rate': (self.hit_count + self.negative_hit_count) / lookup_count if lookup_count else None,
+        }
+
+
+def _query_log_ticket_id(session, ticket):
+    log_ticket = session \
+        .query(m.LogTicket.id) \
+        .filter(m.LogTicket.ticket == ticket) \
+        .first()
+
+    if log_ticket is None:
+        return None
+
+    return log_ticket.id
+
+
+async def resolve_ticket(request, ticket):
+    # Returns log_ticket.id of the ticket, or None if the ticket does not exist
+    ticket_cache = request.app['ticket_cache']
+
+    is_cached, log_ticket_id = ticket_cache.get(ticket)
+    if is_cached:
+        return log_ticket_id
+
+    log_ticket_id = await request['db'].run(_query_log_ticket_id, ticket)
+
+    if log_ticket_id is None:
+        ticket_cache.put_unknown(ticket)
+    else:
+        ticket_cache.put(ticket, log_ticket_id)
+
+    return log_ticket_id
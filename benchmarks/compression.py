@@ -0,0 +1,131 @@
+# Measure the bandwidth and CPU saved by response compression on synthetic
+# GET /elicast/{id} bodies (OT arrays and base64 voice blobs, as in
+# benchmarks.load). Reports, per available encoding:
+#
+#   - ratio and speed of compressing one body at the per-request and the
+#     cached level
+#   - a stream of requests with Zipf popularity through app.compression,
+#     compressing every response vs. caching compressed immutable elicasts
+#
+#   CONFIG_PATH=configs/dev.py python3 -m benchmarks.compression --elicasts 20 --requests 500
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import random
+import time
+
+from app import compression
+from benchmarks import stats
+from benchmarks.load import make_ots, make_voice_blobs
+
+
+def make_bodies(rng, count, ot_count, voice_size, voice_chunks):
+    bodies = []
+    for elicast_id in range(1, count + 1):
+        bodies.append(json.dumps({
+            'elicast': {
+                'id': elicast_id,
+                'created': 1503363045000,
+                'title': 'Lecture %d' % elicast_id,
+                'teacher': None,
+                'is_protected': True,
+            },
+            'ots': make_ots(rng, ot_count),
+            'voice_blobs': make_voice_blobs(rng, voice_size, voice_chunks),
+        }).encode('utf-8'))
+    return bodies
+
+
+def _measure_body(body, encoding, level, repeat):
+    started_at = time.process_time()
+    for _ in range(repeat):
+        compressed = compression.compress(body, encoding, level)
+    cpu_time = (time.process_time() - started_at) / repeat
+    return {
+        'level': level,
+        'original_bytes': len(body),
+        'compressed_bytes': len(compressed),
+        'ratio': round(len(compressed) / len(body), 4),
+        'cpu_ms': round(cpu_time * 1000, 3),
+        'mb_per_sec': round(len(body) / 1024 ** 2 / cpu_time, 1) if cpu_time > 0 else None,
+    }
+
+
+async def _stream(compressor, bodies, request_ids, encoding, use_cache, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    sent_bytes = 0
+
+    async def _one(elicast_id):
+        nonlocal sent_bytes
+        async with semaphore:
+            etag = '"elicast-%d"' % elicast_id if use_cache else None
+            compressed = await compressor.compress(bodies[elicast_id - 1], encoding, etag)
+            sent_bytes += len(compressed)
+
+    started_at = time.perf_counter()
+    cpu_started_at = time.process_time()
+    await asyncio.gather(*(_one(elicast_id) for elicast_id in request_ids))
+    return {
+        'sent_bytes': sent_bytes,
+        'cpu_sec': round(time.process_time() - cpu_started_at, 3),
+        'elapsed_sec': round(time.perf_counter() - started_at, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--elicasts', type=int, default=20)
+    parser.add_argument('--ots', type=int, default=3000, help='OTs per elicast')
+    parser.add_argument('--voice-size', type=int, default=2 * 1024 ** 2, help='bytes of voice per elicast')
+    parser.add_argument('--voice-chunks', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--zipf', type=float, default=1.1, help='exponent of the popularity of elicasts')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--repeat', type=int, default=3, help='compressions per body to measure')
+    parser.add_argument('--encodings', nargs='+', default=['br', 'zstd', 'gzip'])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help='append JSON lines to this file instead of stdout')
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    bodies = make_bodies(rng, args.elicasts, args.ots, args.voice_size, args.voice_chunks)
+
+    weights = [1 / (rank ** args.zipf) for rank in range(1, args.elicasts + 1)]
+    request_ids = rng.choices(range(1, args.elicasts + 1), weights=weights, k=args.requests)
+    identity_bytes = sum(len(bodies[elicast_id - 1]) for elicast_id in request_ids)
+
+    loop = asyncio.get_event_loop()
+    executor = concurrent.futures.ThreadPoolExecutor(8)
+
+    for encoding in compression.available_encodings(args.encodings):
+        result = {
+            'benchmark': 'compression',
+            'encoding': encoding,
+            'elicasts': args.elicasts,
+            'requests': args.requests,
+            'body': {
+                'request': _measure_body(bodies[0], encoding, compression.LEVELS[encoding], args.repeat),
+                'cached': _measure_body(bodies[0], encoding, compression.CACHED_LEVELS[encoding], args.repeat),
+            },
+            'identity_bytes': identity_bytes,
+        }
+
+        for name, use_cache in [('uncached', False), ('cached', True)]:
+            compressor = compression.Compressor([encoding],
+                                                min_size=0,
+                                                cache_size=1024 ** 3,
+                                                executor=executor)
+            stream = loop.run_until_complete(_stream(compressor, bodies, request_ids, encoding,
+                                                     use_cache, args.concurrency))
+            stream['saved_bytes_ratio'] = round(1 - stream['sent_bytes'] / identity_bytes, 4)
+            result[name] = stream
+
+        result['cpu_saved_by_cache_sec'] = round(result['uncached']['cpu_sec'] - result['cached']['cpu_sec'], 3)
+        stats.dump(result, args.output)
+
+    executor.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+# Run code through the multi-host docker backend against several fake Engine
+# API servers (benchmarks.fake_docker) with different memory sizes. The first
+# host fails `--create-failure-rate` of its container creations and the last
+# one is unhealthy for `--outage` sec in the middle of the runs, so placement,
+# retries, ejection and re-admission can be checked without a docker daemon.
+#
+#   CONFIG_PATH=configs/dev.py python3 -m benchmarks.docker_hosts --runs 200 --concurrency 24
+import argparse
+import asyncio
+import concurrent.futures
+import time
+
+from app.sandbox import RUN_CODE_MAX_MEMORY
+from app.sandbox.docker_engine import DockerBackend
+from benchmarks import stats
+from benchmarks.fake_docker import FakeDockerEngine
+from benchmarks.load import _free_port
+
+SNIPPET = 'print("hello world!")'
+
+
+async def _outage(engine, start, duration):
+    await asyncio.sleep(start)
+    engine.is_healthy = False
+    await asyncio.sleep(duration)
+    engine.is_healthy = True
+
+
+async def _bench(backend, engines, runs, concurrency, outage):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = []
+
+    async def _one():
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                output, exit_code = await backend.run(SNIPPET)
+                if exit_code != 0:
+                    raise Exception('exit code %d' % exit_code, output)
+            except Exception as e:
+                errors.append(repr(e))
+                return
+            latencies.append(time.perf_counter() - start)
+
+    # memory of the hosts is known after the first health check
+    await backend.check_health()
+
+    outage_task = asyncio.ensure_future(_outage(engines[-1], backend.health_check_interval, outage))
+
+    start = time.perf_counter()
+    await asyncio.gather(*(_one() for _ in range(runs)))
+    elapsed = time.perf_counter() - start
+
+    await outage_task
+    # until the last host is admitted again
+    await asyncio.sleep(backend.health_check_interval * (backend.readmit_successes + 1))
+
+    result = stats.summarize_latencies(latencies, elapsed)
+    result.update({
+        'benchmark': 'docker_hosts',
+        'runs': runs,
+        'concurrency': concurrency,
+        'errors': len(errors),
+        'error_samples': sorted(set(errors))[:5],
+        'hosts': [],
+    })
+    for host, engine in zip(backend.hosts, engines):
+        host_stats = host.stats()
+        host_stats['capacity'] = engine.mem_total // RUN_CODE_MAX_MEMORY
+        host_stats['max_running'] = engine.stats['max_running']
+        host_stats['engine_create_failures'] = engine.stats['create_failures']
+        host_stats['leaked_containers'] = len(engine.containers)
+        result['hosts'].append(host_stats)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--hosts', type=int, default=3)
+    parser.add_argument('--runs', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=24)
+    parser.add_argument('--run-delay', type=float, default=0.2, help='sec of every code run')
+    parser.add_argument('--create-failure-rate', type=float, default=0.3, help='of the first host')
+    parser.add_argument('--outage', type=float, default=2.0, help='sec the last host is unhealthy')
+    parser.add_argument('--health-check-interval', type=float, default=0.5)
+    parser.add_argument('--output', default=None, help='append JSON lines to this file instead of stdout')
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    executor = concurrent.futures.ThreadPoolExecutor(args.concurrency * 2 + args.hosts)
+
+    # 4, 8, 16, ... runs of RUN_CODE_MAX_MEMORY fit in the hosts
+    engines = [FakeDockerEngine(run_delay=args.run_delay,
+                                create_failure_rate=args.create_failure_rate if idx == 0 else 0.0,
+                                mem_total=RUN_CODE_MAX_MEMORY * 4 * 2 ** idx)
+               for idx in range(args.hosts)]
+    ports = []
+    for engine in engines:
+        port = _free_port()
+        loop.run_until_complete(engine.serve('127.0.0.1', port))
+        ports.append(port)
+
+    backend = DockerBackend(executor,
+                            ['tcp://127.0.0.1:%d' % port for port in ports],
+                            health_check_interval=args.health_check_interval,
+                            eject_failures=3,
+                            readmit_successes=2,
+                            memory_overcommit=1.0)
+    loop.run_until_complete(backend.start())
+    try:
+        result = loop.run_until_complete(_bench(backend, engines, args.runs, args.concurrency, args.outage))
+    finally:
+        backend.close()
+        for engine in engines:
+            loop.run_until_complete(engine.close())
+        executor.shutdown(wait=False)
+
+    stats.dump(result, args.output)
+
+
+if __name__ == '__main__':
+    main()
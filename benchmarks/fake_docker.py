@@ -0,0 +1,225 @@
+# A fake Docker Engine API which serves the calls of the docker backend
+# (create/put_archive/start/inspect/wait/logs/remove) without a docker daemon.
+# Every "container" sleeps for `run_delay` sec and prints a fixed line, or runs
+# the copied code file with a local python if `execute` is set.
+#
+#   python3 -m benchmarks.fake_docker --port 2375 --run-delay 0.2
+#   (DOCKER_URI = 'tcp://127.0.0.1:2375')
+import argparse
+import asyncio
+import itertools
+import io
+import os
+import random
+import struct
+import sys
+import tarfile
+import tempfile
+
+from aiohttp import web
+
+FAKE_OUTPUT = 'hello from fake docker\n'
+FAKE_MEM_TOTAL = 8 * 1024 ** 3
+
+
+class FakeDockerEngine:
+
+    def __init__(self, run_delay=0.0, execute=False, python=sys.executable,
+                 create_failure_rate=0.0, mem_total=FAKE_MEM_TOTAL, ncpu=4):
+        self.run_delay = run_delay
+        self.execute = execute
+        self.python = python
+        self.create_failure_rate = create_failure_rate
+        self.mem_total = mem_total
+        self.ncpu = ncpu
+        # Unhealthy engines answer every call with 500
+        self.is_healthy = True
+
+        self.containers = {}
+        self.stats = {
+            'created': 0,
+            'create_failures': 0,
+            'removed': 0,
+            'max_running': 0,
+        }
+
+        self._ids = itertools.count(1)
+        self._runner = None
+
+        self.app = web.Application(middlewares=[self._health_middleware])
+        self.app.router.add_get('/_ping', self.ping)
+        self.app.router.add_get('/{version}/_ping', self.ping)
+        self.app.router.add_get('/{version}/version', self.version)
+        self.app.router.add_get('/{version}/info', self.info)
+        self.app.router.add_post('/{version}/containers/create', self.create)
+        self.app.router.add_get('/{version}/containers/{id}/json', self.inspect)
+        self.app.router.add_put('/{version}/containers/{id}/archive', self.put_archive)
+        self.app.router.add_post('/{version}/containers/{id}/start', self.start)
+        self.app.router.add_post('/{version}/containers/{id}/wait', self.wait)
+        self.app.router.add_get('/{version}/containers/{id}/logs', self.logs)
+        self.app.router.add_delete('/{version}/containers/{id}', self.remove)
+
+    @web.middleware
+    async def _health_middleware(self, request, handler):
+        if not self.is_healthy:
+            return web.json_response({'message': 'fake engine is unhealthy'}, status=500)
+        return await handler(request)
+
+    async def serve(self, host, port):
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+
+    async def close(self):
+        for container in self.containers.values():
+            if container['task'] is not None:
+                container['task'].cancel()
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    def _running_count(self):
+        return sum(1 for c in self.containers.values() if c['state'] == 'running')
+
+    def _container(self, request):
+        container = self.containers.get(request.match_info['id'])
+        if container is None:
+            raise web.HTTPNotFound(text='{"message": "No such container"}', content_type='application/json')
+        return container
+
+    async def ping(self, request):
+        return web.Response(text='OK')
+
+    async def version(self, request):
+        return web.json_response({'ApiVersion': '1.35', 'Version': '18.03.0-fake'})
+
+    async def info(self, request):
+        return web.json_response({
+            'NCPU': self.ncpu,
+            'MemTotal': self.mem_total,
+            'Containers': len(self.containers),
+            'ContainersRunning': self._running_count(),
+        })
+
+    async def create(self, request):
+        if random.random() < self.create_failure_rate:
+            self.stats['create_failures'] += 1
+            return web.json_response({'message': 'fake create failure'}, status=500)
+
+        spec = await request.json()
+        container_id = '%064x' % next(self._ids)
+        self.containers[container_id] = {
+            'spec': spec,
+            'state': 'created',
+            'task': None,
+            'files': {},
+            'output': b'',
+            'exit_code': None,
+        }
+        self.stats['created'] += 1
+        return web.json_response({'Id': container_id, 'Warnings': []}, status=201)
+
+    async def inspect(self, request):
+        container = self._container(request)
+        return web.json_response({
+            'Id': request.match_info['id'],
+            'Name': '/fake',
+            'Config': dict(container['spec'], Tty=False),
+            'HostConfig': container['spec'].get('HostConfig', {}),
+            'State': {
+                'Status': container['state'],
+                'Running': container['state'] == 'running',
+                'ExitCode': container['exit_code'] or 0,
+            },
+        })
+
+    async def put_archive(self, request):
+        container = self._container(request)
+        directory = request.query.get('path', '/')
+        with tarfile.open(fileobj=io.BytesIO(await request.read())) as tar:
+            for member in tar.getmembers():
+                if member.isfile():
+                    path = os.path.join(directory, member.name)
+                    container['files'][path] = tar.extractfile(member).read()
+        return web.Response(status=200)
+
+    async def start(self, request):
+        container = self._container(request)
+        container['state'] = 'running'
+        container['task'] = asyncio.ensure_future(self._run(container))
+        self.stats['max_running'] = max(self.stats['max_running'], self._running_count())
+        return web.Response(status=204)
+
+    async def _run(self, container):
+        try:
+            if self.execute:
+                container['output'], container['exit_code'] = await self._execute(container['files'])
+            else:
+                await asyncio.sleep(self.run_delay)
+                container['output'], container['exit_code'] = FAKE_OUTPUT.encode('utf-8'), 0
+        finally:
+            container['state'] = 'exited'
+
+    async def _execute(self, files):
+        code = files.get('/codefile.py')
+        if code is None:
+            return b'', 1
+
+        with tempfile.NamedTemporaryFile(suffix='.py') as codefile:
+            codefile.write(code)
+            codefile.flush()
+
+            process = await asyncio.create_subprocess_exec(self.python, '-u', codefile.name,
+                                                           stdout=asyncio.subprocess.PIPE,
+                                                           stderr=asyncio.subprocess.STDOUT)
+            output, _ = await process.communicate()
+        return output, process.returncode
+
+    async def wait(self, request):
+        container = self._container(request)
+        if container['task'] is not None:
+            await asyncio.shield(container['task'])
+        return web.json_response({'StatusCode': container['exit_code'], 'Error': None})
+
+    async def logs(self, request):
+        container = self._container(request)
+        output = container['output']
+        # Multiplexed stream of a non-tty container: 1 (stdout), 0, 0, 0, size
+        body = struct.pack('>BxxxL', 1, len(output)) + output if output else b''
+        return web.Response(body=body, content_type='application/vnd.docker.raw-stream')
+
+    async def remove(self, request):
+        container = self._container(request)
+        if container['task'] is not None:
+            container['task'].cancel()
+        del self.containers[request.match_info['id']]
+        self.stats['removed'] += 1
+        return web.Response(status=204)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=2375)
+    parser.add_argument('--run-delay', type=float, default=0.0, help='sec of every code run')
+    parser.add_argument('--execute', action='store_true', help='run the code with a local python')
+    parser.add_argument('--create-failure-rate', type=float, default=0.0)
+    parser.add_argument('--mem-total', type=int, default=FAKE_MEM_TOTAL, help='bytes reported by /info')
+    args = parser.parse_args()
+
+    engine = FakeDockerEngine(run_delay=args.run_delay,
+                              execute=args.execute,
+                              create_failure_rate=args.create_failure_rate,
+                              mem_total=args.mem_total)
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(engine.serve(args.host, args.port))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.run_until_complete(engine.close())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+# A stand-in for the ffmpeg calls of the audio controller. It copies the
+# input (or the concatenated inputs of `-f concat`) to the output, cut by
+# `-ss`/`-t` assuming FAKE_FFMPEG_BITRATE bytes per sec, after sleeping
+# FAKE_FFMPEG_DELAY sec.
+#
+#   FFMPEG_PATH = '/path/to/fake-ffmpeg'  (a script which runs this module,
+#   see benchmarks.load.write_fake_ffmpeg)
+import os
+import sys
+import time
+
+
+def _concat_inputs(list_path):
+    data = b''
+    with open(list_path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line.startswith("file '") and line.endswith("'"):
+                with open(line[6:-1], 'rb') as source_f:
+                    data += source_f.read()
+    return data
+
+
+def main(args):
+    delay = float(os.environ.get('FAKE_FFMPEG_DELAY', '0'))
+    bitrate = int(os.environ.get('FAKE_FFMPEG_BITRATE', '8000'))
+
+    options = {}
+    idx = 0
+    while idx < len(args) - 1:
+        if args[idx].startswith('-') and args[idx] != '-y':
+            options[args[idx]] = args[idx + 1]
+            idx += 2
+        else:
+            idx += 1
+    output_path = args[-1]
+
+    if options.get('-f') == 'concat':
+        data = _concat_inputs(options['-i'])
+    else:
+        with open(options['-i'], 'rb') as f:
+            data = f.read()
+
+    if '-ss' in options or '-t' in options:
+        start = int(float(options.get('-ss', 0)) * bitrate)
+        end = start + int(float(options['-t']) * bitrate) if '-t' in options else len(data)
+        data = data[start:end]
+
+    time.sleep(delay)
+
+    with open(output_path, 'wb') as f:
+        f.write(data)
+
+    print('fake ffmpeg: %d bytes -> %s' % (len(data), output_path))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
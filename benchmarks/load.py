@@ -0,0 +1,530 @@
+# Load test of the whole server. Starts gunicorn with a temporary config (a
+# fresh sqlite DB, a fake Docker Engine API, and a fake ffmpeg unless the real
+# one is found), seeds synthetic elicasts, then drives every endpoint alone
+# ("isolated" phase) and all of them together ("mixed" phase).
+#
+#   python3 -m benchmarks.load --concurrency 16 --duration 20 --output bench.jsonl
+#   python3 -m benchmarks.load --phases mixed --mix get=10,list=5,log_submit=20
+#
+# Prints one JSON line per phase and endpoint with p50/p95/p99 latency,
+# throughput, errors and the peak RSS of the server processes.
+import argparse
+import asyncio
+import base64
+import json
+import os
+import os.path
+import random
+import shutil
+import signal
+import socket
+import stat
+import string
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+
+import aiohttp
+
+from benchmarks import stats
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ENDPOINTS = ['list', 'get', 'save', 'split', 'download', 'code_run', 'log_submit']
+DEFAULT_MIX = 'list=20,get=20,save=5,split=2,download=2,code_run=10,log_submit=41'
+# need a seeded elicast
+_ELICAST_ENDPOINTS = ('get', 'save', 'download')
+
+WEBM_BASE64_HEADER = 'data:audio/webm;base64'
+FORM_CONTENT_TYPE = 'application/x-www-form-urlencoded'
+
+# Same as benchmarks.sandbox, which cannot be imported without a config
+SNIPPETS = [
+    'print("hello world!")',
+    'print(sum(i * i for i in range(100000)))',
+    'def fib(n):\n    return n if n < 2 else fib(n - 1) + fib(n - 2)\nprint(fib(20))',
+    'print("hello asdf!"); assert(1 == 0)',
+]
+
+_CODE_TOKENS = ['def ', 'return ', 'for i in range(10):\n    ', 'print(', ')', 'x = ', '1', ' + ',
+                'if x > 0:\n    ', 'else:\n    ', '\n', 'answer', '"hello"', '[]', 'len(', ', ']
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       cwd=REPO_DIR,
+                                       stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def make_ots(rng, count):
+    # Text changes as recorded by the editor, with some selections in between
+    code = ''
+    ots = []
+    ts = 0
+    for _ in range(count):
+        ts += rng.randint(30, 800)
+        r = rng.random()
+        if r < 0.1:
+            from_pos = rng.randint(0, len(code))
+            ots.append({'ts': ts, 'fromPos': from_pos, 'toPos': rng.randint(from_pos, len(code))})
+        elif r < 0.25 and code:
+            from_pos = rng.randint(0, len(code) - 1)
+            to_pos = min(len(code), from_pos + rng.randint(1, 8))
+            ots.append({'ts': ts, 'fromPos': from_pos, 'toPos': to_pos,
+                        'insertedText': '', 'removedText': code[from_pos:to_pos]})
+            code = code[:from_pos] + code[to_pos:]
+        else:
+            pos = len(code) if r < 0.8 else rng.randint(0, len(code))
+            text = rng.choice(_CODE_TOKENS)
+            ots.append({'ts': ts, 'fromPos': pos, 'toPos': pos, 'insertedText': text, 'removedText': ''})
+            code = code[:pos] + text + code[pos:]
+    return ots
+
+
+def make_real_webm(ffmpeg_path, size, path):
+    # ~64 kbit/s opus noise of about `size` bytes
+    subprocess.run([ffmpeg_path, '-f', 'lavfi', '-i', 'anoisesrc=d=%d' % max(1, size // 8000),
+                    '-acodec', 'libopus', '-b:a', '64k', '-y', path],
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def make_voice_blobs(rng, total_size, chunks, real_webm=None):
+    chunk_size = max(1, total_size // chunks)
+    voice_blobs = []
+    for _ in range(chunks):
+        if real_webm is not None:
+            data = real_webm
+        else:
+            data = rng.getrandbits(chunk_size * 8).to_bytes(chunk_size, 'little')
+        voice_blobs.append(WEBM_BASE64_HEADER + ',' + base64.b64encode(data).decode('ascii'))
+    return voice_blobs
+
+
+def _form(fields):
+    return urllib.parse.urlencode(fields).encode('ascii')
+
+
+def write_fake_ffmpeg(directory, delay):
+    path = os.path.join(directory, 'fake-ffmpeg')
+    with open(path, 'w') as f:
+        f.write('#!/bin/sh\nFAKE_FFMPEG_DELAY=%s exec "%s" "%s" "$@"\n'
+                % (delay, sys.executable, os.path.join(REPO_DIR, 'benchmarks', 'fake_ffmpeg.py')))
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return path
+
+
+def write_config(base_config_path, directory, overrides):
+    # Copy of the base config with every 'db/...' path moved into `directory`
+    with open(base_config_path, encoding='utf-8') as f:
+        source = f.read()
+
+    names = {}
+    exec(compile(source, base_config_path, 'exec'), names)
+
+    lines = [source, '', '# benchmarks.load']
+    for name, value in sorted(names.items()):
+        if name.isupper() and isinstance(value, str) and value.startswith('db/'):
+            lines.append('%s = %r' % (name, os.path.join(directory, value[3:])))
+    for name, value in sorted(overrides.items()):
+        lines.append('%s = %r' % (name, value))
+
+    path = os.path.join(directory, 'config.py')
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('\n'.join(lines) + '\n')
+    return path
+
+
+def _read_rss(pid):
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def _child_pids(pid):
+    pids = []
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % name) as f:
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        if ppid == pid:
+            pids.append(int(name))
+    return pids
+
+
+class RssSampler:
+    # Peak of the summed RSS of the gunicorn master and its workers (not of
+    # the ffmpeg subprocesses), sampled every `interval` sec
+
+    def __init__(self, pid, interval=0.05):
+        self.pid = pid
+        self.interval = interval
+        self.peak = 0
+
+        self._is_supported = os.path.exists('/proc/%d/status' % pid)
+        self._pids = [pid] + _child_pids(pid) if self._is_supported else []
+        self._task = None
+
+    def sample(self):
+        rss = sum(_read_rss(pid) for pid in self._pids)
+        self.peak = max(self.peak, rss)
+        return rss
+
+    def start(self):
+        self.peak = 0
+        if self._is_supported:
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if not self._is_supported:
+            return None
+        self.sample()
+        return round(self.peak / 1024 ** 2, 1)
+
+    async def _run(self):
+        while True:
+            self.sample()
+            await asyncio.sleep(self.interval)
+
+
+class Workload:
+
+    def __init__(self, session, base_url, rng, corpus, elicast_ids, split_body, ticket):
+        self.session = session
+        self.base_url = base_url
+        self.rng = rng
+        self.corpus = corpus
+        self.elicast_ids = elicast_ids
+        self.split_body = split_body
+        self.ticket = ticket
+
+    async def _request(self, method, path, **kwargs):
+        async with self.session.request(method, self.base_url + path, **kwargs) as response:
+            body = await response.read()
+            return response.status, len(body)
+
+    def _elicast_idx(self):
+        return self.rng.randrange(len(self.elicast_ids))
+
+    async def list(self):
+        return await self._request('GET', '/elicast', params={'page': self.rng.randint(0, 2), 'count': 20})
+
+    async def get(self):
+        return await self._request('GET', '/elicast/%d' % self.elicast_ids[self._elicast_idx()])
+
+    async def save(self):
+        idx = self._elicast_idx()
+        return await self._request('POST', '/elicast/%d' % self.elicast_ids[idx],
+                                   data=self.corpus[idx], headers={'Content-Type': FORM_CONTENT_TYPE})
+
+    async def split(self):
+        return await self._request('POST', '/audio/split',
+                                   data=self.split_body, headers={'Content-Type': FORM_CONTENT_TYPE})
+
+    async def download(self):
+        return await self._request('GET', '/audio/download/%d' % self.elicast_ids[self._elicast_idx()])
+
+    async def code_run(self):
+        return await self._request('POST', '/code/run', data={'code': self.rng.choice(SNIPPETS)})
+
+    async def log_submit(self):
+        data = json.dumps({'type': 'seek', 'ts': self.rng.randint(0, 600000)})
+        return await self._request('POST', '/log/submit', data={'ticket': self.ticket, 'data': data})
+
+
+async def _drive(workload, mix, concurrency, duration, max_requests, sampler):
+    ops = list(mix)
+    weights = [mix[op] for op in ops]
+    results = {op: {'latencies': [], 'errors': 0, 'bytes': 0} for op in ops}
+    issued = [0]
+
+    started_at = time.perf_counter()
+    deadline = started_at + duration
+
+    async def _worker():
+        while time.perf_counter() < deadline:
+            if max_requests is not None:
+                if issued[0] >= max_requests:
+                    return
+                issued[0] += 1
+
+            op = workload.rng.choices(ops, weights)[0]
+            result = results[op]
+            op_started_at = time.perf_counter()
+            try:
+                status, size = await getattr(workload, op)()
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                result['errors'] += 1
+                continue
+
+            if status >= 400:
+                result['errors'] += 1
+            else:
+                result['latencies'].append(time.perf_counter() - op_started_at)
+                result['bytes'] += size
+
+    sampler.start()
+    await asyncio.gather(*(_worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started_at
+    peak_rss_mb = await sampler.stop()
+
+    records = []
+    for op in ops:
+        record = stats.summarize_latencies(results[op]['latencies'], elapsed)
+        record.update({
+            'endpoint': op,
+            'errors': results[op]['errors'],
+            'bytes_received': results[op]['bytes'],
+            'peak_rss_mb': peak_rss_mb,
+        })
+        records.append(record)
+
+    if len(ops) > 1:
+        record = stats.summarize_latencies([t for op in ops for t in results[op]['latencies']], elapsed)
+        record.update({
+            'endpoint': 'all',
+            'errors': sum(results[op]['errors'] for op in ops),
+            'bytes_received': sum(results[op]['bytes'] for op in ops),
+            'peak_rss_mb': peak_rss_mb,
+        })
+        records.append(record)
+
+    return records
+
+
+async def _wait_until_ready(base_url, process, timeout):
+    deadline = time.perf_counter() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.perf_counter() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError('Server exited with %d' % process.returncode)
+            try:
+                async with session.get(base_url + '/elicast') as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError('Server is not ready in %d sec' % timeout)
+
+
+async def _seed(session, base_url, corpus, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def _put(body):
+        async with semaphore:
+            async with session.put(base_url + '/elicast', data=body,
+                                   headers={'Content-Type': FORM_CONTENT_TYPE}) as response:
+                if response.status != 200:
+                    message = await response.text()
+                    raise RuntimeError('Failed to seed an elicast: %d %s' % (response.status, message))
+                return (await response.json())['elicast']['id']
+
+    elicast_ids = await asyncio.gather(*(_put(body) for body in corpus))
+
+    async with session.post(base_url + '/log/ticket', data={'name': 'benchmark'}) as response:
+        ticket = (await response.json())['ticket']
+
+    return list(elicast_ids), ticket
+
+
+async def _bench(args, base_url, server_process, corpus, split_body, common):
+    mix = {}
+    for item in args.mix.split(','):
+        op, weight = item.split('=')
+        if op not in ENDPOINTS:
+            raise ValueError('Unknown endpoint %s' % op)
+        mix[op] = float(weight)
+
+    sampler = RssSampler(server_process.pid)
+
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    timeout = aiohttp.ClientTimeout(total=args.request_timeout)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        elicast_ids, ticket = await _seed(session, base_url, corpus, args.concurrency)
+        if not elicast_ids:
+            skipped_ops = [op for op in mix if op in _ELICAST_ENDPOINTS]
+            if skipped_ops:
+                print('No elicasts are seeded, skipping %s' % ', '.join(skipped_ops), file=sys.stderr)
+            mix = {op: weight for op, weight in mix.items() if op not in _ELICAST_ENDPOINTS}
+        workload = Workload(session, base_url, random.Random(args.seed), corpus, elicast_ids, split_body, ticket)
+
+        # warm up
+        for op in mix:
+            await getattr(workload, op)()
+
+        records = []
+        if 'isolated' in args.phases:
+            for op in mix:
+                for record in await _drive(workload, {op: 1}, args.concurrency, args.duration,
+                                           args.requests, sampler):
+                    records.append(dict(record, phase='isolated'))
+        if 'mixed' in args.phases:
+            for record in await _drive(workload, mix, args.concurrency, args.duration,
+                                       args.requests, sampler):
+                records.append(dict(record, phase='mixed'))
+
+    for record in records:
+        record.update(common)
+        stats.dump(record, args.output)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', default=os.path.join(REPO_DIR, 'configs', 'dev.py'),
+                        help='base config; DB and file paths are replaced with temporary ones')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn worker processes')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=10, help='sec of every phase')
+    parser.add_argument('--requests', type=int, default=None, help='max. requests of every phase')
+    parser.add_argument('--phases', default='isolated,mixed')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='endpoint=weight,... (%s)' % ', '.join(ENDPOINTS))
+    parser.add_argument('--elicasts', type=int, default=10, help='number of seeded elicasts')
+    parser.add_argument('--ots', type=int, default=5000, help='OTs per elicast')
+    parser.add_argument('--voice-mb', type=float, default=2, help='voice size per elicast')
+    parser.add_argument('--voice-chunks', type=int, default=4)
+    parser.add_argument('--ffmpeg', default='auto', help="'fake', 'auto' or path of a real ffmpeg")
+    parser.add_argument('--fake-ffmpeg-delay', type=float, default=0.05)
+    parser.add_argument('--fake-docker-delay', type=float, default=0.2)
+    parser.add_argument('--fake-docker-execute', action='store_true', help='run the code with a local python')
+    parser.add_argument('--quotas', action='store_true', help='keep QUOTA_LIMITS of the base config')
+    parser.add_argument('--request-timeout', type=float, default=120)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--keep', action='store_true', help='keep the temporary directory')
+    parser.add_argument('--output', default=None, help='append JSON lines to this file instead of stdout')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='elicast-bench-')
+    processes = []
+    try:
+        if args.ffmpeg == 'fake':
+            ffmpeg_path = None
+        elif args.ffmpeg == 'auto':
+            ffmpeg_path = shutil.which('ffmpeg')
+        else:
+            ffmpeg_path = args.ffmpeg
+
+        rng = random.Random(args.seed)
+        voice_size = int(args.voice_mb * 1024 ** 2)
+        real_webm = None
+        if ffmpeg_path is not None:
+            real_webm = make_real_webm(ffmpeg_path, voice_size // args.voice_chunks,
+                                       os.path.join(directory, 'voice.webm'))
+        else:
+            ffmpeg_path = write_fake_ffmpeg(directory, args.fake_ffmpeg_delay)
+
+        corpus = []
+        for idx in range(args.elicasts):
+            voice_blobs = make_voice_blobs(rng, voice_size, args.voice_chunks, real_webm)
+            corpus.append(_form({
+                'title': 'benchmark %d %s' % (idx, ''.join(rng.choice(string.ascii_lowercase) for _ in range(8))),
+                'ots': json.dumps(make_ots(rng, args.ots)),
+                'voice_blobs': json.dumps(voice_blobs),
+                'teacher': 'teacher%d' % (idx % 3),
+            }))
+
+        # two chunks of the same size as those of the corpus, also with --elicasts 0
+        split_body = _form({
+            'segments': json.dumps([[0, 1000], [1000, 2500]]),
+            'audio_blobs': json.dumps(make_voice_blobs(rng, voice_size // args.voice_chunks * 2, 2, real_webm)),
+        })
+
+        docker_port = _free_port()
+        docker_command = [sys.executable, '-m', 'benchmarks.fake_docker',
+                          '--port', str(docker_port),
+                          '--run-delay', str(args.fake_docker_delay)]
+        if args.fake_docker_execute:
+            docker_command.append('--execute')
+        processes.append(subprocess.Popen(docker_command, cwd=REPO_DIR))
+
+        overrides = {
+            'DB_URI': 'sqlite:///%s' % os.path.join(directory, 'bench.sqlite3'),
+            'DOCKER_URI': 'tcp://127.0.0.1:%d' % docker_port,
+            'RUN_CODE_BACKEND': 'docker',
+            'FFMPEG_PATH': ffmpeg_path,
+            'IS_EDIT_BLOCKED': False,
+        }
+        if not args.quotas:
+            # every request comes from one client
+            overrides['QUOTA_LIMITS'] = {}
+        config_path = write_config(args.config, directory, overrides)
+
+        port = _free_port()
+        with open(os.path.join(directory, 'server.log'), 'wb') as server_log:
+            server_process = subprocess.Popen(
+                # same as the `gunicorn` script, with this python
+                [sys.executable, '-c', 'from gunicorn.app.wsgiapp import run; run()', 'server:webserver.app',
+                 '-k', 'aiohttp.worker.GunicornWebWorker',
+                 '-b', '127.0.0.1:%d' % port,
+                 '-w', str(args.workers),
+                 '--timeout', str(int(args.request_timeout))],
+                cwd=REPO_DIR,
+                env=dict(os.environ, CONFIG_PATH=config_path),
+                stdout=server_log,
+                stderr=subprocess.STDOUT
+            )
+        processes.append(server_process)
+
+        base_url = 'http://127.0.0.1:%d' % port
+        loop = asyncio.get_event_loop()
+        loop.run_until_complete(_wait_until_ready(base_url, server_process, timeout=60))
+        # every worker has to be up to be counted in the RSS
+        loop.run_until_complete(asyncio.sleep(1))
+
+        common = {
+            'benchmark': 'load',
+            'commit': _git_commit(),
+            'workers': args.workers,
+            'concurrency': args.concurrency,
+            'elicasts': args.elicasts,
+            'ots': args.ots,
+            'voice_mb': args.voice_mb,
+            'ffmpeg': 'real' if real_webm is not None else 'fake',
+            'seed': args.seed,
+        }
+        loop.run_until_complete(_bench(args, base_url, server_process, corpus, split_body, common))
+    finally:
+        for process in reversed(processes):
+            if process.poll() is None:
+                process.send_signal(signal.SIGTERM)
+                try:
+                    process.wait(timeout=30)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+
+        if args.keep:
+            print('Temporary files are kept in %s' % directory, file=sys.stderr)
+        else:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+# Compare latency/throughput of the code run sandbox backends.
+#
+#   CONFIG_PATH=configs/dev.py python3 -m benchmarks.sandbox local docker --runs 50 --concurrency 4
+import argparse
+import asyncio
+import concurrent.futures
+import time
+
+from app import sandbox
+from benchmarks import stats
+
+SNIPPETS = [
+    'print("hello world!")',
+    'print(sum(i * i for i in range(100000)))',
+    'def fib(n):\n    return n if n < 2 else fib(n - 1) + fib(n - 2)\nprint(fib(20))',
+    'print("hello asdf!"); assert(1 == 0)',
+]
+
+
+async def _bench_backend(backend, runs, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    errors = 0
+
+    async def _one(idx):
+        nonlocal errors
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                await backend.run(SNIPPETS[idx % len(SNIPPETS)])
+            except Exception:
+                errors += 1
+                return
+            latencies.append(time.perf_counter() - start)
+
+    # warm up (image pull, page cache, ...)
+    await backend.run(SNIPPETS[0])
+
+    start = time.perf_counter()
+    await asyncio.gather(*(_one(idx) for idx in range(runs)))
+    elapsed = time.perf_counter() - start
+
+    result = stats.summarize_latencies(latencies, elapsed)
+    result.update({
+        'benchmark': 'sandbox',
+        'backend': backend.name,
+        'runs': runs,
+        'concurrency': concurrency,
+        'errors': errors,
+    })
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('backends', nargs='+', choices=['docker', 'local'])
+    parser.add_argument('--runs', type=int, default=50)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--output', default=None, help='append JSON lines to this file instead of stdout')
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    executor = concurrent.futures.ThreadPoolExecutor(max(args.concurrency * 2, 4))
+
+    for backend_name in args.backends:
+        backend = sandbox.create_backend(backend_name, executor)
+        loop.run_until_complete(backend.start())
+        try:
+            result = loop.run_until_complete(_bench_backend(backend, args.runs, args.concurrency))
+        finally:
+            backend.close()
+        stats.dump(result, args.output)
+
+
+if __name__ == '__main__':
+    main()
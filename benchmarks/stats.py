@@ -0,0 +1,43 @@
+import json
+import math
+import sys
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    k = (len(sorted_values) - 1) * p / 100
+    lower = math.floor(k)
+    upper = math.ceil(k)
+    if lower == upper:
+        return sorted_values[int(k)]
+    return sorted_values[lower] * (upper - k) + sorted_values[upper] * (k - lower)
+
+
+def summarize_latencies(latencies, elapsed):
+    values = sorted(latencies)
+    return {
+        'count': len(values),
+        'throughput': len(values) / elapsed if elapsed > 0 else None,
+        'latency_ms': {
+            'mean': _ms(sum(values) / len(values) if values else None),
+            'p50': _ms(percentile(values, 50)),
+            'p95': _ms(percentile(values, 95)),
+            'p99': _ms(percentile(values, 99)),
+            'max': _ms(values[-1] if values else None),
+        },
+    }
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+def dump(result, output=None):
+    # One JSON object per line, so results of several commits can be concatenated and compared
+    line = json.dumps(result, sort_keys=True)
+    if output is None:
+        print(line, file=sys.stdout)
+    else:
+        with open(output, 'a', encoding='utf-8') as f:
+            f.write(line + '\n')
@@ -2,7 +2,115 @@ LOGGING_LOGGER_NAME = 'elicast-server(nonlinear)'
 LOGGING_FORMAT = '[%(levelname)1.1s %(asctime)s P%(process)d %(threadName)s %(module)s:%(lineno)d] %(message)s'
 
 DB_URI = 'sqlite:///db/nonlinear.sqlite3'
+# Threads which run the DB work off the event loop
+DB_POOL_SIZE = 4
+DB_SLOW_CALL_THRESHOLD = 0.5  # sec
+# sqlite pragmas applied to every connection (None to keep the defaults)
+DB_SQLITE_PROFILE = {
+    'auto_vacuum': 'INCREMENTAL',  # needs a VACUUM to take effect on an existing DB
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,  # ms
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -64 * 1024,  # KiB
+}
+# WAL checkpoint and incremental vacuum in the background
+DB_SQLITE_MAINTENANCE_INTERVAL = 60  # sec
+DB_SQLITE_INCREMENTAL_VACUUM_PAGES = 1000
 
+# A URI, or a list of them to spread the code runs over several hosts
 DOCKER_URI = 'unix://var/run/docker.sock'
+DOCKER_HEALTH_CHECK_INTERVAL = 10  # sec
+DOCKER_EJECT_FAILURES = 3  # failures in a row to stop using a host
+DOCKER_READMIT_SUCCESSES = 2  # health checks in a row to use it again
+DOCKER_MEMORY_OVERCOMMIT = 1.0  # ratio of MemTotal of a host reservable by runs
+
+# 'docker' or 'local' (rlimited subprocess, does not need a docker daemon)
+RUN_CODE_BACKEND = 'docker'
+RUN_CODE_LOCAL_PYTHON = '/usr/bin/python3'
+RUN_CODE_LOCAL_TMPFS = '/dev/shm'
+RUN_CODE_LOCAL_MAX_PROCESSES = 32
+RUN_CODE_LOCAL_REQUIRE_ISOLATION = True
+
+FFMPEG_PATH = '/usr/bin/ffmpeg'
 
 IS_EDIT_BLOCKED = False
+
+# Serve GET /elicast, /elicast/{id} and /elicast/{id}/voice/{chunk_idx} from a
+# memory-mapped snapshot file built by `manage.py build-snapshot` instead of
+# the DB (None to disable). Needs IS_EDIT_BLOCKED; restart to load a new one.
+SNAPSHOT_PATH = None
+
+# GET /elicast/search over an SQLite FTS5 index of titles and final code
+SEARCH_ENABLED = True
+
+# Compress responses by Accept-Encoding; 'br' and 'zstd' need the brotli and
+# zstandard modules and are skipped without them
+COMPRESSION_ENABLED = True
+COMPRESSION_ENCODINGS = ['br', 'zstd', 'gzip']  # preferred first
+COMPRESSION_MIN_SIZE = 1024  # bytes
+COMPRESSION_CACHE_SIZE = 128 * 1024 ** 2  # bytes of compressed immutable elicasts per worker
+
+# Log entries are stored in one sqlite file per period ('day' or 'week')
+LOG_PARTITION_DIR = 'db/nonlinear-log'
+LOG_PARTITION_PERIOD = 'week'
+LOG_PARTITION_SEAL_DELAY = 10 * 60  # sec after the end of a period
+
+# Write-behind buffer of /log/submit
+LOG_BUFFER_MAX_BATCH = 1000
+LOG_BUFFER_FLUSH_INTERVAL = 1.0  # sec
+LOG_BUFFER_MAX_PENDING = 100000
+
+# LRU of issued log tickets (and of unknown tickets, for NEGATIVE_TTL sec)
+LOG_TICKET_CACHE_SIZE = 100000
+LOG_TICKET_CACHE_NEGATIVE_SIZE = 10000
+LOG_TICKET_CACHE_NEGATIVE_TTL = 60  # sec
+
+# Max. number of events in a /log/submit_batch request
+LOG_BATCH_MAX_EVENTS = 1000
+
+# GET /export/{table} (`manage.py export` is not affected)
+IS_EXPORT_BLOCKED = False
+EXPORT_BATCH_SIZE = 1000
+
+# GET /metrics. Each worker process writes its metrics to a file in
+# METRICS_DIR every METRICS_FLUSH_INTERVAL sec, which are aggregated on scrape
+# (None: metrics of the serving process only). Clear the directory on deploy.
+METRICS_DIR = 'db/nonlinear-metrics'
+METRICS_FLUSH_INTERVAL = 5  # sec
+
+# Per-request profiling (the middleware is not installed if disabled).
+# Requests with the 'X-Elicast-Profile' header ('cprofile' to run cProfile as
+# well) are always saved; a PROFILING_SAMPLE_RATE fraction of the others is
+# traced and saved if slower than PROFILING_SLOW_THRESHOLD.
+PROFILING_ENABLED = False
+PROFILING_SAMPLE_RATE = 1.0
+PROFILING_SLOW_THRESHOLD = 1.0  # sec
+PROFILING_DIR = 'db/nonlinear-profiles'
+PROFILING_MAX_FILES = 200
+
+# Quotas of expensive endpoints (route path -> limits per kind of client),
+# shared by the worker processes through QUOTA_DB_PATH. A request counts for
+# its IP ('ip') and, if it has a log ticket ('ticket' form field or
+# 'X-Elicast-Ticket' header), for the ticket ('ticket'). Each client has a
+# token bucket of 'burst' requests refilled by 'rate' requests per sec, and at
+# most 'max_in_flight' requests running at once; a kind without limits is not
+# limited. A classroom behind NAT shares one IP, so the IP limits only stop
+# floods. Leases of in-flight requests expire after QUOTA_LEASE_TTL sec in
+# case a worker dies. Empty to disable.
+QUOTA_LIMITS = {
+    '/code/run': {
+        'ip': {'rate': 20.0, 'burst': 200, 'max_in_flight': 64},
+        'ticket': {'rate': 1.0, 'burst': 10, 'max_in_flight': 2},
+    },
+    '/code/answer/{elicast_id}': {
+        'ip': {'rate': 20.0, 'burst': 200, 'max_in_flight': 64},
+        'ticket': {'rate': 1.0, 'burst': 10, 'max_in_flight': 2},
+    },
+    '/audio/split': {
+        'ip': {'rate': 0.2, 'burst': 3, 'max_in_flight': 1},
+    },
+}
+QUOTA_DB_PATH = 'db/nonlinear-quota.sqlite3'
+QUOTA_LEASE_TTL = 600  # sec
+QUOTA_RETENTION = 86400  # sec, usage of idle clients is forgotten after
@@ -0,0 +1,139 @@
+import argparse
+import os.path
+import sys
+
+from app import exercise_stats, export, helper, log_store, search, snapshot, storage
+
+config = helper.config
+
+
+def _log_store():
+    return log_store.LogPartitionStore(
+        config.LOG_PARTITION_DIR,
+        config.LOG_PARTITION_PERIOD,
+        config.DB_SQLITE_PROFILE,
+        config.DB_URI,
+        seal_delay=config.LOG_PARTITION_SEAL_DELAY
+    )
+
+
+def _export(args):
+    engine = storage.create_readonly_engine(config.DB_URI, config.DB_SQLITE_PROFILE)
+
+    try:
+        filters = export.parse_filters(args.table, vars(args))
+        table_export = export.Export(engine, args.table, filters, args.batch_size, _log_store())
+        encoder = export.Encoder(table_export.column_names, args.format, args.gzip)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+
+    output = open(args.output, 'wb') if args.output else sys.stdout.buffer
+    try:
+        for rows in table_export:
+            output.write(encoder.encode(rows))
+        output.write(encoder.finish())
+    finally:
+        if args.output:
+            output.close()
+
+
+def _log_partitions(args):
+    store = _log_store()
+
+    try:
+        if args.action == 'list':
+            for name in store.partitions():
+                start, end = store.period_of(name)
+                print('%s\t%s\t%d bytes\t%s' % (
+                    name,
+                    'sealed' if store.is_sealed(name) else 'open',
+                    os.path.getsize(store.path(name)),
+                    store.path(name)
+                ))
+        elif args.action == 'seal':
+            if args.name:
+                store.seal(args.name)
+            else:
+                store.seal_ended()
+        elif args.action == 'archive':
+            if not args.name or not args.target:
+                raise ValueError('archive -- name and target directory are required')
+            store.archive(args.name, args.target)
+        elif args.action == 'drop':
+            if not args.name:
+                raise ValueError('drop -- name is required')
+            store.drop(args.name)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+
+
+def _build_snapshot(args):
+    engine = storage.create_readonly_engine(config.DB_URI, config.DB_SQLITE_PROFILE)
+
+    result = snapshot.build(engine, args.output)
+    print('%d elicasts\t%d bytes\t%s' % (result['elicasts'], result['size'], args.output))
+
+
+def _rebuild_search_index(args):
+    engine = storage.create_engine(config.DB_URI, config.DB_SQLITE_PROFILE)
+
+    if not search.is_supported(engine):
+        print('SQLite FTS5 is not available', file=sys.stderr)
+        sys.exit(1)
+
+    print('%d elicasts indexed' % search.rebuild(engine))
+
+
+def _backfill_exercise_stats(args):
+    engine = storage.create_engine(config.DB_URI, config.DB_SQLITE_PROFILE)
+
+    print('%d exercises' % exercise_stats.backfill(engine))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    export_parser = subparsers.add_parser('export', help='stream rows of a table as NDJSON or CSV')
+    export_parser.add_argument('table', choices=export.TABLES)
+    export_parser.add_argument('--format', choices=sorted(export.FORMATS), default='ndjson')
+    export_parser.add_argument('--gzip', action='store_true')
+    export_parser.add_argument('--output', '-o', default=None, help='default: stdout')
+    export_parser.add_argument('--batch-size', type=int, default=config.EXPORT_BATCH_SIZE)
+    export_parser.add_argument('--ticket-name', dest='ticket_name')
+    export_parser.add_argument('--elicast-id', dest='elicast_id')
+    export_parser.add_argument('--ex-id', dest='ex_id')
+    export_parser.add_argument('--created-from', dest='created_from', help='timestamp in ms, inclusive')
+    export_parser.add_argument('--created-to', dest='created_to', help='timestamp in ms, exclusive')
+    export_parser.set_defaults(func=_export)
+
+    log_partitions_parser = subparsers.add_parser('log-partitions', help='manage log partition files')
+    log_partitions_parser.add_argument('action', choices=['list', 'seal', 'archive', 'drop'])
+    log_partitions_parser.add_argument('name', nargs='?', help='partition name, e.g. 2018-11-05')
+    log_partitions_parser.add_argument('target', nargs='?', help='target directory of archive')
+    log_partitions_parser.set_defaults(func=_log_partitions)
+
+    build_snapshot_parser = subparsers.add_parser('build-snapshot',
+                                                  help='compile non-deleted elicasts into a snapshot file')
+    build_snapshot_parser.add_argument('--output', '-o', default=config.SNAPSHOT_PATH,
+                                       required=config.SNAPSHOT_PATH is None,
+                                       help='default: SNAPSHOT_PATH')
+    build_snapshot_parser.set_defaults(func=_build_snapshot)
+
+    rebuild_search_index_parser = subparsers.add_parser('rebuild-search-index',
+                                                        help='index titles and final code of all elicasts again')
+    rebuild_search_index_parser.set_defaults(func=_rebuild_search_index)
+
+    backfill_exercise_stats_parser = subparsers.add_parser('backfill-exercise-stats',
+                                                           help='recompute exercise stats from all answers')
+    backfill_exercise_stats_parser.set_defaults(func=_backfill_exercise_stats)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
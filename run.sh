@@ -9,12 +9,10 @@ if [ ! -d $(pwd)/db ]; then
 fi
 
 # Run docker image
-# -v /tmp:/tmp : to pass source code in code controller
 # -v /var/run/docker.sock:/var/run/docker.sock : to execute docker commands in the server
 # -v $(pwd)/db:/elicast-server-wdir/db/ : to access DB inside of the container
 docker run \
     -p ${HTTP_PORT:-8080}:8080 \
-    -v /tmp:/tmp \
     -v /var/run/docker.sock:/var/run/docker.sock \
     -v $(pwd)/db:/elicast-server-wdir/db/ \
     -e CONFIG_PATH \
@@ -0,0 +1,186 @@
+import asyncio
+import concurrent.futures
+import socket
+
+import pytest
+
+from app.sandbox import RUN_CODE_MAX_MEMORY, SandboxUnavailable
+from app.sandbox.docker_engine import DockerBackend
+from benchmarks.fake_docker import FAKE_OUTPUT, FakeDockerEngine
+
+EJECT_FAILURES = 3
+READMIT_SUCCESSES = 2
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def with_backend(*engine_kwargs):
+    # Runs the test coroutine with (backend, engines) on fake Engine API
+    # servers, one per kwargs. Health is only checked once at start, and then
+    # by the test.
+    def decorator(test):
+        def wrapper():
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            executor = concurrent.futures.ThreadPoolExecutor(32)
+            try:
+                loop.run_until_complete(_run(test, executor, engine_kwargs))
+            finally:
+                executor.shutdown(wait=False)
+                loop.close()
+                asyncio.set_event_loop(None)
+        return wrapper
+    return decorator
+
+
+async def _run(test, executor, engine_kwargs):
+    engines = [FakeDockerEngine(**kwargs) for kwargs in engine_kwargs]
+    uris = []
+    for engine in engines:
+        port = _free_port()
+        await engine.serve('127.0.0.1', port)
+        uris.append('tcp://127.0.0.1:%d' % port)
+
+    backend = DockerBackend(executor,
+                            uris,
+                            health_check_interval=3600,
+                            eject_failures=EJECT_FAILURES,
+                            readmit_successes=READMIT_SUCCESSES,
+                            memory_overcommit=1.0)
+    try:
+        await backend.start()
+        while any(host.mem_total is None for host in backend.hosts):
+            await asyncio.sleep(0.01)
+
+        await test(backend, engines)
+    finally:
+        backend.close()
+        for engine in engines:
+            await engine.close()
+
+
+async def _check_health(backend, times):
+    for _ in range(times):
+        await backend.check_health()
+
+
+@with_backend({'run_delay': 1.0, 'mem_total': RUN_CODE_MAX_MEMORY * 2},
+              {'run_delay': 1.0, 'mem_total': RUN_CODE_MAX_MEMORY * 4})
+async def test_least_loaded_placement(backend, engines):
+    small, large = backend.hosts
+
+    # 6 runs fill both hosts by memory; the 7th waits for one of them
+    runs = [asyncio.ensure_future(backend.run('print(1)')) for _ in range(7)]
+    await asyncio.sleep(0.3)
+
+    assert (small.in_flight, large.in_flight) == (2, 4)
+    assert small.reserved_memory == RUN_CODE_MAX_MEMORY * 2
+    assert large.reserved_memory == RUN_CODE_MAX_MEMORY * 4
+    assert [engine.stats['created'] for engine in engines] == [2, 4]
+
+    for output, exit_code in await asyncio.gather(*runs):
+        assert (output, exit_code) == (FAKE_OUTPUT, 0)
+
+    assert (small.in_flight, large.in_flight) == (0, 0)
+    assert (small.reserved_memory, large.reserved_memory) == (0, 0)
+    assert [engine.stats['max_running'] for engine in engines] == [2, 4]
+    assert sum(engine.stats['created'] for engine in engines) == 7
+    assert [len(engine.containers) for engine in engines] == [0, 0]
+
+
+@with_backend({'mem_total': RUN_CODE_MAX_MEMORY * 8},
+              {'mem_total': RUN_CODE_MAX_MEMORY * 8})
+async def test_tie_is_broken_by_in_flight_runs(backend, engines):
+    first, second = backend.hosts
+    first.in_flight = 1
+
+    assert await backend.run('print(1)') == (FAKE_OUTPUT, 0)
+    assert [engine.stats['created'] for engine in engines] == [0, 1]
+
+
+@with_backend({'create_failure_rate': 1.0},
+              {})
+async def test_retry_on_create_failure(backend, engines):
+    failing, working = backend.hosts
+
+    for _ in range(EJECT_FAILURES):
+        assert await backend.run('print(1)') == (FAKE_OUTPUT, 0)
+
+    assert engines[0].stats['create_failures'] >= 1
+    assert engines[1].stats['created'] == EJECT_FAILURES
+    assert failing.create_failures == engines[0].stats['create_failures']
+    assert working.runs == EJECT_FAILURES
+
+
+@with_backend({'create_failure_rate': 1.0},
+              {'create_failure_rate': 1.0})
+async def test_unavailable_when_every_create_fails(backend, engines):
+    with pytest.raises(SandboxUnavailable):
+        await backend.run('print(1)')
+
+    assert [engine.stats['create_failures'] for engine in engines] == [1, 1]
+    assert [host.in_flight for host in backend.hosts] == [0, 0]
+
+
+@with_backend({}, {})
+async def test_eject_and_readmit(backend, engines):
+    host = backend.hosts[1]
+
+    engines[1].is_healthy = False
+    await _check_health(backend, EJECT_FAILURES - 1)
+    assert host.is_healthy
+
+    await _check_health(backend, 1)
+    assert not host.is_healthy
+    assert host.ejections == 1
+
+    # runs only go to the admitted host
+    for _ in range(3):
+        assert await backend.run('print(1)') == (FAKE_OUTPUT, 0)
+    assert [engine.stats['created'] for engine in engines] == [3, 0]
+
+    engines[1].is_healthy = True
+    await _check_health(backend, READMIT_SUCCESSES - 1)
+    assert not host.is_healthy
+
+    await _check_health(backend, 1)
+    assert host.is_healthy
+
+    backend.hosts[0].in_flight = 1
+    assert await backend.run('print(1)') == (FAKE_OUTPUT, 0)
+    assert engines[1].stats['created'] == 1
+
+
+@with_backend({}, {}, {})
+async def test_unavailable_when_every_host_is_down(backend, engines):
+    for engine in engines:
+        engine.is_healthy = False
+    await _check_health(backend, EJECT_FAILURES)
+    assert not any(host.is_healthy for host in backend.hosts)
+
+    with pytest.raises(SandboxUnavailable):
+        await backend.run('print(1)')
+    assert [engine.stats['created'] for engine in engines] == [0, 0, 0]
+
+
+@with_backend({'run_delay': 0.5, 'mem_total': RUN_CODE_MAX_MEMORY})
+async def test_waiting_run_fails_when_host_is_ejected(backend, engines):
+    running = asyncio.ensure_future(backend.run('print(1)'))
+    await asyncio.sleep(0.1)
+
+    # full, so the next run waits until the host is ejected
+    waiting = asyncio.ensure_future(backend.run('print(1)'))
+    await asyncio.sleep(0.1)
+    assert not waiting.done()
+
+    engines[0].is_healthy = False
+    await _check_health(backend, EJECT_FAILURES)
+
+    with pytest.raises(SandboxUnavailable):
+        await waiting
+    with pytest.raises(SandboxUnavailable):
+        await running
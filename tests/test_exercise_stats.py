@@ -0,0 +1,196 @@
+import pytest
+import sqlalchemy as sa
+from sqlalchemy.orm import sessionmaker
+
+from app import exercise_stats
+from app import models as m
+
+ELICAST_ID = 1
+EX_ID = 2
+
+
+@pytest.fixture
+def engine(tmpdir):
+    engine = sa.create_engine('sqlite:///%s' % tmpdir.join('test.sqlite3'))
+    m.Base.metadata.create_all(engine)
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def session(engine):
+    session = sessionmaker(bind=engine)()
+    yield session
+    session.close()
+
+
+def _answer(session, log_ticket_id, is_passed, created, ex_id=EX_ID):
+    # Same as the unit of work of /code/answer
+    code_run_exercise = m.CodeRunExercise(
+        elicast_id=ELICAST_ID,
+        ex_id=ex_id,
+        solve_ots='[]',
+        code='',
+        output='',
+        exit_code=0 if is_passed else 1,
+        created=created
+    )
+    session.add(code_run_exercise)
+    session.flush()
+    exercise_stats.record_answer(session, ELICAST_ID, ex_id, log_ticket_id, is_passed, created)
+    session.commit()
+
+
+def _stats(session, ex_id=EX_ID):
+    for stats in exercise_stats.exercise_stats(session, ELICAST_ID):
+        if stats['ex_id'] == ex_id:
+            return stats
+    return None
+
+
+def _ticket_stats(session, log_ticket_id, ex_id=EX_ID):
+    for stats in exercise_stats.ticket_exercise_stats(session, ELICAST_ID, log_ticket_id):
+        if stats['ex_id'] == ex_id:
+            return stats
+    return None
+
+
+def _rows(session):
+    # Rows of exercise_stats without `created`, which backfill takes from the
+    # first answer
+    columns = [column for column in m.ExerciseStats.__table__.c if column.name != 'created']
+    return session.execute(
+        sa.select(columns).order_by(m.ExerciseStats.elicast_id, m.ExerciseStats.ex_id)
+    ).fetchall()
+
+
+def test_first_pass_after_attempts(session):
+    _answer(session, 10, False, 1000)
+    _answer(session, 10, False, 2000)
+    _answer(session, 10, True, 4000)
+
+    ticket_stats = _ticket_stats(session, 10)
+    assert ticket_stats['attempt_count'] == 3
+    assert ticket_stats['pass_count'] == 1
+    assert ticket_stats['first_attempt'] == 1000
+    assert ticket_stats['first_pass'] == 4000
+    assert ticket_stats['first_pass_attempts'] == 3
+
+    stats = _stats(session)
+    assert stats['attempt_count'] == 3
+    assert stats['pass_count'] == 1
+    assert stats['last_attempt'] == 4000
+    assert stats['learner_count'] == 1
+    assert stats['passed_learner_count'] == 1
+    assert stats['mean_attempts_to_first_pass'] == 3
+    assert stats['mean_time_to_first_pass'] == 3000
+
+
+def test_pass_at_first_attempt(session):
+    _answer(session, 10, True, 1000)
+
+    ticket_stats = _ticket_stats(session, 10)
+    assert ticket_stats['first_pass'] == 1000
+    assert ticket_stats['first_pass_attempts'] == 1
+
+    stats = _stats(session)
+    assert stats['passed_learner_count'] == 1
+    assert stats['mean_attempts_to_first_pass'] == 1
+    assert stats['mean_time_to_first_pass'] == 0
+
+
+def test_repeat_passes(session):
+    _answer(session, 10, False, 1000)
+    _answer(session, 10, True, 2000)
+    _answer(session, 10, True, 3000)
+    _answer(session, 10, False, 4000)
+    _answer(session, 10, True, 5000)
+
+    ticket_stats = _ticket_stats(session, 10)
+    assert ticket_stats['attempt_count'] == 5
+    assert ticket_stats['pass_count'] == 3
+    assert ticket_stats['last_attempt'] == 5000
+    assert ticket_stats['first_pass'] == 2000
+    assert ticket_stats['first_pass_attempts'] == 2
+
+    stats = _stats(session)
+    assert stats['attempt_count'] == 5
+    assert stats['pass_count'] == 3
+    assert stats['pass_rate'] == 0.6
+    assert stats['learner_count'] == 1
+    assert stats['passed_learner_count'] == 1
+    assert stats['mean_attempts_to_first_pass'] == 2
+    assert stats['mean_time_to_first_pass'] == 1000
+
+
+def test_answers_without_ticket(session):
+    _answer(session, None, False, 1000)
+    _answer(session, None, True, 2000)
+
+    stats = _stats(session)
+    assert stats['attempt_count'] == 2
+    assert stats['pass_count'] == 1
+    assert stats['last_attempt'] == 2000
+    assert stats['learner_count'] == 0
+    assert stats['passed_learner_count'] == 0
+    assert stats['learner_pass_rate'] is None
+    assert stats['mean_attempts_to_first_pass'] is None
+    assert stats['mean_time_to_first_pass'] is None
+
+
+def test_learners(session):
+    # 10 passes at the 3rd attempt, 11 at the 1st, 12 never; answers without
+    # a ticket only count in the totals
+    _answer(session, 10, False, 1000)
+    _answer(session, 11, True, 1500)
+    _answer(session, 10, False, 2000)
+    _answer(session, None, True, 2500)
+    _answer(session, 12, False, 3000)
+    _answer(session, 10, True, 4000)
+    _answer(session, 12, False, 4500)
+
+    stats = _stats(session)
+    assert stats['attempt_count'] == 7
+    assert stats['pass_count'] == 3
+    assert stats['learner_count'] == 3
+    assert stats['passed_learner_count'] == 2
+    assert stats['learner_pass_rate'] == 0.667
+    assert stats['mean_attempts_to_first_pass'] == 2
+    assert stats['mean_time_to_first_pass'] == 1500
+
+    assert _ticket_stats(session, 12)['first_pass'] is None
+    assert _ticket_stats(session, 11, ex_id=EX_ID + 1) is None
+
+
+def test_backfill_equals_incremental(engine, session):
+    _answer(session, 10, False, 1000)
+    _answer(session, 11, True, 1500)
+    _answer(session, 10, True, 2000)
+    _answer(session, 10, True, 2500)
+    _answer(session, None, False, 3000)
+    _answer(session, 12, False, 3500)
+    _answer(session, 11, False, 1000, ex_id=EX_ID + 1)
+    _answer(session, None, True, 4000, ex_id=EX_ID + 1)
+
+    incremental = _rows(session)
+    session.close()
+
+    assert exercise_stats.backfill(engine) == 2
+    assert _rows(session) == incremental
+
+
+def test_backfill_without_aggregates(engine, session):
+    # Answers saved before the aggregates existed
+    for created, exit_code in [(1000, 1), (2000, 0), (3000, 0)]:
+        session.add(m.CodeRunExercise(elicast_id=ELICAST_ID, ex_id=EX_ID, solve_ots='[]',
+                                      code='', output='', exit_code=exit_code, created=created))
+    session.commit()
+    session.close()
+
+    assert exercise_stats.backfill(engine) == 1
+
+    stats = _stats(session)
+    assert stats['attempt_count'] == 3
+    assert stats['pass_count'] == 2
+    assert stats['last_attempt'] == 3000
+    assert stats['learner_count'] == 0
@@ -0,0 +1,142 @@
+import asyncio
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from app import quota
+
+ENDPOINT = '/code/run'
+IP = 'ip:10.0.0.1'
+TICKET = 'ticket:%s' % ('0' * 36)
+
+
+def _limit(rate, burst, max_in_flight):
+    return {'rate': rate, 'burst': burst, 'max_in_flight': max_in_flight}
+
+
+def _call(store, fn, *args):
+    # At a given time, on the thread which owns the connection
+    return store._executor.submit(fn, *args).result()
+
+
+def _acquire(store, clients, now):
+    return _call(store, store._acquire, ENDPOINT, clients, now)
+
+
+def _release(store, lease_ids):
+    _call(store, store._release, lease_ids)
+
+
+def _usage(store, client, now):
+    return _call(store, store._usage, client, now)
+
+
+@pytest.fixture
+def make_store(tmpdir):
+    stores = []
+
+    def _make_store(limits, lease_ttl=600):
+        store = quota.QuotaStore(str(tmpdir.join('quota.sqlite3')), limits, lease_ttl=lease_ttl, retention=86400)
+        stores.append(store)
+        return store
+
+    yield _make_store
+
+    for store in stores:
+        store.close()
+
+
+def test_bucket_refill(make_store):
+    store = make_store({ENDPOINT: {'ip': _limit(0.5, 2, 100)}})
+
+    assert _acquire(store, [IP], 0)[0]
+    assert _acquire(store, [IP], 0)[0]
+    assert _acquire(store, [IP], 0) == (None, 2.0, 'rate')
+    assert _acquire(store, [IP], 1) == (None, 1.0, 'rate')
+    assert _acquire(store, [IP], 2)[0]
+
+    # refilled up to `burst` only
+    assert _acquire(store, [IP], 1000)[0]
+    assert _acquire(store, [IP], 1000)[0]
+    assert _acquire(store, [IP], 1000)[0] is None
+
+
+def test_in_flight_lease_release(make_store):
+    store = make_store({ENDPOINT: {'ip': _limit(100.0, 100, 1)}})
+
+    lease_ids, _, _ = _acquire(store, [IP], 0)
+    assert _acquire(store, [IP], 0) == (None, 1, 'in_flight')
+
+    _release(store, lease_ids)
+    lease_ids, _, _ = _acquire(store, [IP], 0)
+    assert lease_ids
+
+    assert _usage(store, IP, 0)[0]['in_flight'] == 1
+    _release(store, lease_ids)
+    assert _usage(store, IP, 0)[0]['in_flight'] == 0
+
+
+def test_in_flight_lease_expires(make_store):
+    # a lease of a dead worker is never released
+    store = make_store({ENDPOINT: {'ip': _limit(100.0, 100, 1)}}, lease_ttl=10)
+
+    assert _acquire(store, [IP], 0)[0]
+    assert _acquire(store, [IP], 5)[0] is None
+    assert _acquire(store, [IP], 11)[0]
+
+
+def test_tickets_behind_one_ip(make_store):
+    store = make_store({ENDPOINT: {
+        'ip': _limit(0.001, 5, 100),
+        'ticket': _limit(0.001, 1, 100),
+    }})
+    tickets = ['ticket:%036d' % i for i in range(6)]
+
+    # every learner has a bucket of its own, and the IP only stops floods
+    for ticket in tickets[:5]:
+        assert _acquire(store, [IP, ticket], 0)[0]
+    assert _acquire(store, [IP, tickets[0]], 0)[2] == 'rate'
+    assert _acquire(store, [IP, tickets[5]], 0)[2] == 'rate'
+
+    # a rejected request does not take a token of the other client
+    assert _usage(store, tickets[5], 0)[0]['tokens'] == 1
+
+
+def test_kind_without_limits(make_store):
+    store = make_store({ENDPOINT: {'ip': _limit(0.001, 1, 100)}})
+
+    assert len(_acquire(store, [IP, TICKET], 0)[0]) == 1
+    assert _usage(store, TICKET, 0) == []
+
+
+def test_retry_after(make_store):
+    store = make_store({ENDPOINT: {'ip': _limit(0.25, 1, 100)}})
+
+    async def _code_run(request):
+        return web.json_response({})
+
+    async def _run():
+        app = web.Application(middlewares=[quota.quota_middleware])
+        app['quota_store'] = store
+        app.router.add_post(ENDPOINT, _code_run)
+
+        client = TestClient(TestServer(app))
+        await client.start_server()
+        try:
+            response = await client.post(ENDPOINT)
+            assert response.status == 200
+
+            response = await client.post(ENDPOINT)
+            assert response.status == 429
+            # 1 token at 0.25 per sec, rounded up to whole seconds
+            assert response.headers['Retry-After'] == '4'
+            assert await response.text() == 'quota -- Too many requests'
+        finally:
+            await client.close()
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(_run())
+    finally:
+        loop.close()
@@ -0,0 +1,121 @@
+import asyncio
+import concurrent.futures
+import os
+import sys
+import textwrap
+
+import pytest
+
+from app import helper
+from app.sandbox.local_process import LocalProcessBackend
+
+
+@pytest.fixture(scope='module')
+def backend():
+    python_path = helper.config.RUN_CODE_LOCAL_PYTHON
+    if not os.access(python_path, os.X_OK):
+        python_path = sys.executable
+
+    executor = concurrent.futures.ThreadPoolExecutor(2)
+    try:
+        backend = LocalProcessBackend(executor,
+                                      python_path=python_path,
+                                      tmpfs_dir=helper.config.RUN_CODE_LOCAL_TMPFS,
+                                      max_processes=32,
+                                      require_isolation=True)
+    except Exception as e:
+        executor.shutdown()
+        pytest.skip('local sandbox is not supported here: %s' % (e,))
+
+    yield backend
+
+    backend.close()
+    executor.shutdown()
+
+
+def _run(backend, code):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(backend.run(textwrap.dedent(code)))
+    finally:
+        loop.close()
+
+
+def test_run(backend):
+    assert _run(backend, 'print(6 * 7)') == ('42\n', 0)
+
+
+def test_network_is_unreachable(backend):
+    output, exit_code = _run(backend, '''
+        import socket
+        try:
+            socket.create_connection(('1.1.1.1', 53), timeout=5)
+            print('connected')
+        except OSError:
+            print('blocked')
+    ''')
+    assert (output, exit_code) == ('blocked\n', 0)
+
+
+def test_host_files_are_unreachable(backend, tmp_path):
+    secret_path = tmp_path / 'secret.sqlite3'
+    secret_path.write_text('secret')
+
+    output, exit_code = _run(backend, '''
+        import os
+        for path in [%r, %r, %r]:
+            print(os.path.exists(path))
+    ''' % (str(secret_path), os.path.abspath('configs'), os.path.abspath('db')))
+    assert (output, exit_code) == ('False\nFalse\nFalse\n', 0)
+
+
+def test_writes_outside_workdir_fail(backend, tmp_path):
+    output, exit_code = _run(backend, '''
+        import os
+        for path in ['/evil', '/usr/evil', '/dev/evil', %r]:
+            try:
+                with open(path, 'w') as f:
+                    f.write('evil')
+                print('written')
+            except OSError:
+                print('denied')
+    ''' % str(tmp_path / 'evil'))
+    assert (output, exit_code) == ('denied\n' * 4, 0)
+    assert not (tmp_path / 'evil').exists()
+
+
+def test_workdir_is_writable(backend):
+    output, exit_code = _run(backend, '''
+        with open('output.txt', 'w') as f:
+            f.write('ok')
+        with open('output.txt') as f:
+            print(f.read())
+    ''')
+    assert (output, exit_code) == ('ok\n', 0)
+
+
+def test_denied_syscalls_fail(backend):
+    if not backend.seccomp:
+        pytest.skip('seccomp module is not installed')
+
+    output, exit_code = _run(backend, '''
+        import ctypes
+        import errno
+        import socket
+
+        try:
+            socket.socket()
+            print('socket')
+        except PermissionError:
+            print('denied')
+
+        libc = ctypes.CDLL(None, use_errno=True)
+        for name, args in [('unshare', (0x10000000,)),
+                           ('mount', (b'none', b'/tmp', b'tmpfs', 0, None)),
+                           ('chroot', (b'/tmp',))]:
+            if getattr(libc, name)(*args) == -1 and ctypes.get_errno() == errno.EPERM:
+                print('denied')
+            else:
+                print(name)
+    ''')
+    assert (output, exit_code) == ('denied\n' * 4, 0)